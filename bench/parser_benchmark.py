@@ -0,0 +1,106 @@
+#############################################################################################
+# Microbenchmark of the TCP server request parsing
+#
+# Compares the cost per request of the legacy byte-by-byte receive loop against the
+# incremental HttpRequestParser, both reading from a local socket pair.
+#############################################################################################
+
+
+import argparse
+import json
+import pathlib
+import socket
+import sys
+import time
+
+# Make the server modules importable
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath('src')))
+
+from httpfs_tcp import DiscardedBody, HttpRequestParser
+
+
+# Build a representative request with a given number of headers and body bytes
+def build_request(header_count, body_size):
+    lines = ['POST /upload/benchmark.txt HTTP/1.1', 'Host: localhost:1773']
+    for i in range(header_count):
+        lines.append(f'X-Benchmark-Header-{i}: {"v" * 24}')
+    lines.append(f'Content-Length: {body_size}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + b'x' * body_size
+
+
+# Legacy implementation: one recv() per header byte and a full rescan after every byte
+def legacy_parse(sock):
+    headers = b''
+    while b'\r\n\r\n' not in headers:
+        headers += sock.recv(1)
+
+    header_strings = headers[:-4].decode().splitlines()[1:]
+    header_dictionary = {}
+    for string in header_strings:
+        header = string.split(': ')
+        header_dictionary[header[0]] = header[1]
+
+    content_length = int(header_dictionary.get('Content-Length', 0))
+    body = b''
+    while len(body) < content_length:
+        body += sock.recv(content_length - len(body))
+
+    return headers, body
+
+
+# Incremental implementation: large reads fed to the parser until a request is complete
+def incremental_parse(sock, parser):
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        parser.feed(sock.recv(65536))
+
+
+# Time the parsing of a number of requests sent one at a time over a socket pair
+def run(name, request, iterations, parse):
+    client, server = socket.socketpair()
+    try:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            client.sendall(request)
+            parse(server)
+        elapsed = time.perf_counter() - start
+    finally:
+        client.close()
+        server.close()
+
+    return {
+        'name': name,
+        'iterations': iterations,
+        'total_seconds': elapsed,
+        'microseconds_per_request': elapsed / iterations * 1e6
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="parser_benchmark")
+
+    parser.add_argument("-n", "--iterations", help="Number of requests to parse", type=int, default=2000)
+    parser.add_argument("--headers", help="Number of extra headers per request", type=int, default=10)
+    parser.add_argument("--body", help="Number of body bytes per request", type=int, default=512)
+
+    args = parser.parse_args()
+    request = build_request(args.headers, args.body)
+
+    # The body is only counted so the benchmark measures the parsing itself
+    request_parser = HttpRequestParser(lambda request: DiscardedBody())
+    results = [
+        run('legacy', request, args.iterations, legacy_parse),
+        run('incremental', request, args.iterations, lambda sock: incremental_parse(sock, request_parser))
+    ]
+
+    print(json.dumps({
+        'request_bytes': len(request),
+        'results': results,
+        'speedup': results[0]['total_seconds'] / results[1]['total_seconds']
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
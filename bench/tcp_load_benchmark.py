@@ -0,0 +1,295 @@
+#############################################################################################
+# Load generator for the TCP server
+#
+# Opens concurrent connections that replay a weighted mix of file downloads, uploads and
+# directory listings, with file sizes drawn from a weighted distribution, and reports the
+# requests per second, the throughput and the latency percentiles (overall and by kind of
+# request) as JSON. Without --port, the server is started on a copy of shared/. A running
+# server given with --port keeps the files the benchmark writes (the server can't delete
+# them), so they are only written with --allow-writes, in a directory unique to the run.
+#############################################################################################
+
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+REPOSITORY_PATH = pathlib.Path(__file__).parent.parent
+# Prefix of the directory of the served files the benchmark creates, unique to every run
+LOAD_DIRECTORY = 'load'
+
+
+def parse_weights(cast):
+    def parse(value):
+        weights = {}
+        for item in value.split(','):
+            key, _, weight = item.partition('=')
+            weights[cast(key)] = float(weight or 1)
+        return weights
+    return parse
+
+
+# Nearest-rank percentiles of sorted latencies, in milliseconds
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+
+    latencies = sorted(latencies)
+    percentile = lambda p: latencies[min(len(latencies) - 1, max(0, round(p / 100 * len(latencies)) - 1))] * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'p999_ms': percentile(99.9),
+        'max_ms': latencies[-1] * 1000
+    }
+
+
+# Minimal HTTP/1.1 client connection, reopened whenever the server closes it
+class Client:
+    def __init__(self, host, port, keep_alive):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.reader = None
+        self.writer = None
+
+    # Send a request and read the whole response, return the status and the size of the body
+    async def request(self, verb, path, body = b''):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        try:
+            head = f'{verb} {path} HTTP/1.1\r\n' \
+                   f'Host: {self.host}:{self.port}\r\n' \
+                   f'Connection: {"keep-alive" if self.keep_alive else "close"}\r\n' \
+                   f'Content-Length: {len(body)}\r\n\r\n'
+            self.writer.write(head.encode() + body)
+            await self.writer.drain()
+            status, size, reusable = await self.__read_response()
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            await self.close()
+            raise
+
+        if not (reusable and self.keep_alive):
+            await self.close()
+        return status, size
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def __read_response(self):
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        lines = head.split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        reusable = headers.get('connection', '').lower() != 'close'
+
+        # Bodies are delimited by their length, by chunks or by the end of the connection
+        size = 0
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                await self.reader.readexactly(chunk_size + 2)
+                size += chunk_size
+                if not chunk_size:
+                    break
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            await self.reader.readexactly(size)
+        else:
+            size = len(await self.reader.read())
+            reusable = False
+
+        return status, size, reusable
+
+
+# Send requests from one connection until the deadline, recording the latency of each one
+async def run_worker(worker, args, files, sizes, deadline, results):
+    generator = random.Random(args.seed + worker)
+    client = Client(args.host, args.port, args.keep_alive)
+    kinds, kind_weights = zip(*args.mix.items())
+    size_values, size_weights = zip(*sizes.items())
+    upload_path = f'/{args.load_directory}/upload-{worker}.bin'
+
+    try:
+        while time.perf_counter() < deadline:
+            kind = generator.choices(kinds, kind_weights)[0]
+            body = b''
+            if kind == 'get':
+                size = generator.choices(size_values, size_weights)[0]
+                path = f'/{args.load_directory}/{generator.choice(files[size])}'
+                verb = 'GET'
+            elif kind == 'post':
+                size = generator.choices(size_values, size_weights)[0]
+                body = os.urandom(16) * (size // 16) + os.urandom(size % 16)
+                path = upload_path
+                verb = 'POST'
+            else:
+                path = generator.choice(['/', f'/{args.load_directory}'])
+                verb = 'GET'
+
+            start = time.perf_counter()
+            try:
+                status, size = await client.request(verb, path, body)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                results['errors'] += 1
+                continue
+            latency = time.perf_counter() - start
+
+            if status >= 400:
+                results['errors'] += 1
+            results['bytes'] += size + len(body)
+            results['latencies'][kind].append(latency)
+    finally:
+        await client.close()
+
+
+# Upload the files downloaded by the benchmark, a few of every size
+async def create_files(args, sizes):
+    client = Client(args.host, args.port, True)
+    files = {}
+    try:
+        for size in sizes:
+            files[size] = [f'{size}-{i}.bin' for i in range(args.files)]
+            for name in files[size]:
+                status, _ = await client.request('POST', f'/{args.load_directory}/{name}', os.urandom(size))
+                if status >= 400:
+                    raise RuntimeError(f'Could not create /{args.load_directory}/{name}: HTTP {status}')
+    finally:
+        await client.close()
+    return files
+
+
+async def benchmark(args):
+    sizes = args.sizes
+    files = await create_files(args, sizes)
+
+    # The first requests of the warmup are not counted
+    if args.warmup > 0:
+        warmup = {'errors': 0, 'bytes': 0, 'latencies': {kind: [] for kind in args.mix}}
+        deadline = time.perf_counter() + args.warmup
+        await asyncio.gather(*(run_worker(worker, args, files, sizes, deadline, warmup)
+                               for worker in range(args.concurrency)))
+
+    results = {'errors': 0, 'bytes': 0, 'latencies': {kind: [] for kind in args.mix}}
+    start = time.perf_counter()
+    await asyncio.gather(*(run_worker(worker, args, files, sizes, start + args.duration, results)
+                           for worker in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for kind in results['latencies'].values() for latency in kind]
+    return {
+        'config': {
+            'concurrency': args.concurrency,
+            'duration_seconds': args.duration,
+            'keep_alive': args.keep_alive,
+            'mix': args.mix,
+            'sizes': sizes,
+            'server_args': args.server_args,
+            'seed': args.seed,
+            'load_directory': f'/{args.load_directory}'
+        },
+        'elapsed_seconds': elapsed,
+        'requests': len(latencies),
+        'errors': results['errors'],
+        'requests_per_second': len(latencies) / elapsed,
+        'throughput_bytes_per_second': results['bytes'] / elapsed,
+        'latency': summarize(latencies),
+        'latency_by_kind': {kind: summarize(values) for kind, values in results['latencies'].items()}
+    }
+
+
+# Start the server on a copy of shared/ and wait until it accepts connections
+def start_server(args, directory):
+    shutil.copytree(REPOSITORY_PATH.joinpath('shared'), directory, dirs_exist_ok=True)
+
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        args.port = sock.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, str(REPOSITORY_PATH.joinpath('src', 'httpfs_tcp.py')),
+                               '-p', str(args.port), '-d', directory, *shlex.split(args.server_args)],
+                              stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError('The server did not start')
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="tcp_load_benchmark")
+
+    parser.add_argument("--host", help="Host of the server", default='localhost')
+    parser.add_argument("-p", "--port", help="Port of a running server (otherwise one is started)", type=int)
+    parser.add_argument("--server-args", help="Extra arguments of the server started", default='')
+    parser.add_argument("-c", "--concurrency", help="Number of concurrent connections", type=int, default=32)
+    parser.add_argument("-d", "--duration", help="Seconds of measurement", type=float, default=10)
+    parser.add_argument("--warmup", help="Seconds of load before the measurement", type=float, default=1)
+    parser.add_argument("--mix", help="Weights of the requests, as get=W,post=W,list=W",
+                        type=parse_weights(str), default={'get': 70, 'post': 10, 'list': 20})
+    parser.add_argument("--sizes", help="Weights of the file sizes in bytes, as SIZE=W,SIZE=W",
+                        type=parse_weights(int), default={1024: 50, 64 * 1024: 35, 1024 * 1024: 15})
+    parser.add_argument("--files", help="Number of files of every size downloaded", type=int, default=4)
+    parser.add_argument("--no-keep-alive", help="Open a connection per request", dest='keep_alive',
+                        action='store_false')
+    parser.add_argument("--seed", help="Seed of the requests chosen", type=int, default=1)
+    parser.add_argument("--allow-writes", help="Write the files of the benchmark on the running server of --port, "
+                        "where they are left", action='store_true')
+
+    args = parser.parse_args()
+    unknown_kinds = set(args.mix) - {'get', 'post', 'list'}
+    if unknown_kinds:
+        parser.error(f'Unknown request kinds: {", ".join(sorted(unknown_kinds))}')
+    # The files downloaded are uploaded first, so every workload writes to the server
+    if args.port is not None and not args.allow_writes:
+        parser.error('The benchmark uploads its files to the server and can\'t delete them, pass --allow-writes to '
+                     'write them on a running server')
+    args.load_directory = f'{LOAD_DIRECTORY}-{uuid.uuid4().hex[:8]}'
+
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            if args.port is None:
+                server = start_server(args, directory)
+            report = asyncio.run(benchmark(args))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
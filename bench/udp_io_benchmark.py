@@ -0,0 +1,151 @@
+#############################################################################################
+# Microbenchmark of the UDP server datagram I/O
+#
+# Compares the packets per second of the per-packet path (a new header and payload
+# concatenated for every packet, one recvfrom() and one parse per datagram) against the
+# batched PacketIO (packets built in place in a send ring, flushed in bursts, and received
+# into a preallocated buffer ring), both over local UDP sockets.
+#
+# The per-packet path is the transport of the server right before PacketIO, reproduced
+# line for line: its header packed with struct and concatenated with a memoryview payload.
+# The original server had no packet transport (it answered one datagram with one datagram
+# and built the request headers byte by byte), so it is not a baseline of this benchmark.
+#
+# Python has no sendmmsg()/recvmmsg(), so a burst still makes one system call per packet:
+# the gain comes from the allocations and copies saved around them.
+#############################################################################################
+
+
+import argparse
+import json
+import pathlib
+import selectors
+import socket
+import struct
+import sys
+import time
+
+# Make the server modules importable
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.joinpath('src')))
+
+from httpfs_udp import PacketIO, PacketType
+
+HEADER = struct.Struct('!BI4sH')
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+# Both send a number of packets of the largest payload size, and return the packets received as (type, sequence number,
+# peer, payload, router address) tuples like the server reads them
+
+# Per-packet implementation (ReliableConnection before PacketIO): every packet built by concatenating a new header
+# and its payload, sent on its own, then received and parsed into new bytes objects one datagram at a time
+def per_packet_send(sock, address, datagram):
+    try:
+        sock.sendto(datagram, address)
+    except BlockingIOError:
+        pass
+
+
+def per_packet_parse(datagram):
+    if len(datagram) < HEADER.size:
+        raise ValueError(f'Packet too short: {len(datagram)} bytes')
+
+    packet_type, seq, peer_ip, peer_port = HEADER.unpack_from(datagram)
+    return PacketType(packet_type), seq, (socket.inet_ntoa(peer_ip), peer_port), datagram[HEADER.size:]
+
+
+def per_packet_round(sender, receiver, address, peer, payload, count, first_seq):
+    for seq in range(first_seq, first_seq + count):
+        per_packet_send(sender, address, HEADER.pack(PacketType.DATA, seq, peer[0], peer[1]) + payload)
+
+    packets = []
+    while True:
+        try:
+            datagram, router = receiver.recvfrom(PacketIO.PACKET_SIZE)
+        except BlockingIOError:
+            return len(packets)
+
+        packets.append((*per_packet_parse(datagram), router))
+
+
+# Batched implementation: the same work through the send and receive rings of PacketIO
+def batched_round(sender, receiver, address, peer, payload, count, first_seq):
+    for seq in range(first_seq, first_seq + count):
+        sender.send(address, peer, PacketType.DATA, seq, payload)
+    sender.flush()
+
+    received = 0
+    while True:
+        packets = receiver.receive()
+        if not packets:
+            return received
+        received += len(packets)
+
+
+def run(name, packet_count, batch_size, payload, make_endpoint, exchange):
+    send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receive_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ready = selectors.DefaultSelector()
+
+    try:
+        for sock in (send_sock, receive_sock):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.setblocking(False)
+        receive_sock.bind(('127.0.0.1', 0))
+        ready.register(receive_sock, selectors.EVENT_READ)
+
+        address = receive_sock.getsockname()
+        peer = (socket.inet_aton(address[0]), address[1])
+        sender = make_endpoint(send_sock, batch_size)
+        receiver = make_endpoint(receive_sock, batch_size)
+
+        # Send in rounds of one batch so the socket buffers never overflow
+        received = 0
+        start = time.perf_counter()
+        for first_seq in range(0, packet_count, batch_size):
+            count = min(batch_size, packet_count - first_seq)
+            ready.select(0)
+            received += exchange(sender, receiver, address, peer, payload, count, first_seq)
+        while ready.select(0.01):
+            received += exchange(sender, receiver, address, peer, payload, 0, 0)
+        elapsed = time.perf_counter() - start
+    finally:
+        ready.close()
+        send_sock.close()
+        receive_sock.close()
+
+    return {
+        'name': name,
+        'packets_sent': packet_count,
+        'packets_received': received,
+        'total_seconds': elapsed,
+        'packets_per_second': received / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="udp_io_benchmark")
+
+    parser.add_argument("-n", "--packets", help="Number of packets to send", type=int, default=200000)
+    parser.add_argument("--batch", help="Number of packets per burst", type=int, default=256)
+
+    args = parser.parse_args()
+
+    # Both paths send the same view of a single payload for every packet, like the slices of a message the connections
+    # send, without allocating the whole message
+    payload = memoryview(b'x' * PacketIO.MAX_PAYLOAD)
+    results = [
+        run('per-packet', args.packets, args.batch, payload, lambda sock, batch_size: sock, per_packet_round),
+        run('batched', args.packets, args.batch, payload, PacketIO, batched_round)
+    ]
+
+    print(json.dumps({
+        'packet_bytes': PacketIO.PACKET_SIZE,
+        'results': results,
+        'speedup': results[1]['packets_per_second'] / results[0]['packets_per_second']
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
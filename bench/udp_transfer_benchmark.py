@@ -0,0 +1,160 @@
+#############################################################################################
+# Benchmark of the UDP server transfers under loss and delay
+#
+# Starts the UDP server on a directory of generated files and downloads them through the
+# router simulator, for every combination of the drop rates and delays given, then reports
+# the completion time and goodput (body bytes per second) of the transfers of each setting.
+# The router decisions are seeded, so the same settings give the same losses.
+#############################################################################################
+
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Make the server modules importable
+SOURCE_PATH = pathlib.Path(__file__).parent.parent.joinpath('src')
+sys.path.insert(0, str(SOURCE_PATH))
+
+from httpfs_router import RouterSimulator
+from httpfs_udp import send_request
+
+
+# Reserve a free UDP port on localhost
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def parse_list(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+
+# Start the server in its own process and wait until it answers
+def start_server(directory, port, router_port):
+    server = subprocess.Popen([sys.executable, str(SOURCE_PATH.joinpath('httpfs_udp.py')), '-p', str(port),
+                               '-d', str(directory)], stdout=subprocess.DEVNULL)
+
+    router = RouterSimulator(router_port, host='localhost')
+    router.start()
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                send_request(b'GET / HTTP/1.0\r\n\r\n', 'localhost', port, router_port=router_port, timeout=1)
+                return server
+            except ConnectionError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    server.kill()
+                    raise
+    finally:
+        router.stop()
+
+
+# Download every file through a router with the given settings
+def run(settings, files, port, repeat, timeout, router_options):
+    router_port = free_port()
+    router = RouterSimulator(router_port, drop_rate=settings[0], max_delay=settings[1] / 1000, host='localhost',
+                             **router_options)
+    thread = router.start()
+
+    results = []
+    try:
+        for name, body in files.items():
+            times = []
+            failures = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    response = send_request(f'GET /{name} HTTP/1.0\r\n\r\n'.encode(), 'localhost', port,
+                                            router_port=router_port, timeout=timeout)
+                except ConnectionError:
+                    failures += 1
+                    continue
+                elapsed = time.perf_counter() - start
+
+                if response[response.find(b'\r\n\r\n') + 4:] != body:
+                    failures += 1
+                    continue
+                times.append(elapsed)
+
+            median = statistics.median(times) if times else None
+            results.append({
+                'size': len(body),
+                'transfers': len(times),
+                'failures': failures,
+                'median_seconds': median,
+                'max_seconds': max(times) if times else None,
+                'goodput_bytes_per_second': len(body) / median if median else None
+            })
+    finally:
+        router.stop()
+        thread.join()
+
+    return {
+        'drop_rate': settings[0],
+        'max_delay_ms': settings[1],
+        'router': router.stats,
+        'files': results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="udp_transfer_benchmark")
+
+    parser.add_argument("--sizes", help="Comma separated sizes in bytes of the files downloaded",
+                        type=parse_list(int), default=[10 * 1024, 256 * 1024, 2 * 1024 * 1024])
+    parser.add_argument("--drop-rates", help="Comma separated drop rates of the router", type=parse_list(float),
+                        default=[0.0, 0.01, 0.05, 0.1])
+    parser.add_argument("--delays", help="Comma separated maximum delays of the router in milliseconds",
+                        type=parse_list(float), default=[0.0, 5.0, 20.0])
+    parser.add_argument("--delay-distribution", help="Distribution of the delays",
+                        choices=RouterSimulator.DELAY_DISTRIBUTIONS, default='uniform')
+    parser.add_argument("--reorder-rate", help="Probability of a packet to be held back", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", help="Probability of a packet to be sent twice", type=float, default=0.0)
+    parser.add_argument("--bandwidth", help="Bytes per second of the links of the router", type=float)
+    parser.add_argument("-n", "--repeat", help="Number of downloads of each file per setting", type=int, default=3)
+    parser.add_argument("--timeout", help="Seconds of silence before a download fails", type=float, default=10)
+    parser.add_argument("--seed", help="Seed of the router decisions", type=int, default=1)
+
+    args = parser.parse_args()
+    router_options = {
+        'delay_distribution': args.delay_distribution,
+        'reorder_rate': args.reorder_rate,
+        'duplicate_rate': args.duplicate_rate,
+        'bandwidth': args.bandwidth,
+        'seed': args.seed
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = {}
+        for size in args.sizes:
+            files[f'{size}.bin'] = os.urandom(size)
+            pathlib.Path(directory).joinpath(f'{size}.bin').write_bytes(files[f'{size}.bin'])
+
+        port = free_port()
+        server = start_server(directory, port, free_port())
+        try:
+            results = [run(settings, files, port, args.repeat, args.timeout, router_options)
+                       for settings in itertools.product(args.drop_rates, args.delays)]
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps({
+        'router_options': router_options,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#############################################################################################
+# Metrics and access log
+#
+# Shared by the TCP and UDP servers: the request counters and latency histograms rendered in
+# the Prometheus text format, and the access log written as JSON lines in the background.
+# Each server extends the metrics with its stages and the counters of its transport.
+#############################################################################################
+
+
+import bisect
+import datetime
+import json
+import random
+import threading
+import time
+
+
+# Counters and latency histograms of a server, rendered in the Prometheus text format
+# Every value is preallocated and indexed by position, so recording a request doesn't build any key
+class Metrics:
+    # Upper bounds in seconds of the latency histogram buckets (the last bucket is +Inf)
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+    # Stages observed and the description of their histogram, defined by the servers
+    STAGES = ()
+    STAGES_HELP = 'Time spent in the stages of the requests.'
+    # Labels of the request counters (the unknown verbs are counted as the last one), defined by the servers
+    VERBS = ('OTHER',)
+    STATUSES = ()
+
+    def __init__(self):
+        self.verb_indexes = {verb: i for i, verb in enumerate(self.VERBS)}
+        self.status_indexes = {status: i for i, status in enumerate(self.STATUSES)}
+        # Requests answered by verb and status
+        self.requests = [0] * (len(self.VERBS) * len(self.STATUSES))
+        # Observations of every stage by bucket and their total duration
+        self.buckets = [[0] * (len(self.LATENCY_BUCKETS) + 1) for _ in self.STAGES]
+        self.durations = [0.0] * len(self.STAGES)
+        # The requests may be counted and the stages observed by other threads than the event loop
+        self.lock = threading.Lock()
+
+    # Count a request answered with a status
+    def count_request(self, verb, status):
+        index = self.verb_indexes.get(verb, len(self.VERBS) - 1) * len(self.STATUSES) + self.status_indexes[status[0]]
+        with self.lock:
+            self.requests[index] += 1
+
+    # Record the duration of a stage of a request
+    def observe(self, stage, seconds):
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.buckets[stage][bucket] += 1
+            self.durations[stage] += seconds
+
+    # Get the other values of the server as (name, type, help, value) tuples
+    def values(self):
+        return []
+
+    # Render the metrics, followed by (name, type, help, value) tuples of the other components
+    def render(self, extra = ()):
+        lines = [
+            '# HELP httpfs_requests_total Requests answered by verb and status.',
+            '# TYPE httpfs_requests_total counter'
+        ]
+        with self.lock:
+            requests = list(self.requests)
+            buckets = [list(counts) for counts in self.buckets]
+            durations = list(self.durations)
+
+        for i, count in enumerate(requests):
+            if count:
+                verb, status = self.VERBS[i // len(self.STATUSES)], self.STATUSES[i % len(self.STATUSES)]
+                lines.append(f'httpfs_requests_total{{verb="{verb}",status="{status}"}} {count}')
+
+        lines += [
+            f'# HELP httpfs_stage_duration_seconds {self.STAGES_HELP}',
+            '# TYPE httpfs_stage_duration_seconds histogram'
+        ]
+        for stage, name in enumerate(self.STAGES):
+            total = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',), buckets[stage]):
+                total += count
+                lines.append(f'httpfs_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {total}')
+            lines.append(f'httpfs_stage_duration_seconds_sum{{stage="{name}"}} {durations[stage]}')
+            lines.append(f'httpfs_stage_duration_seconds_count{{stage="{name}"}} {total}')
+
+        for name, metric_type, description, value in (*self.values(), *extra):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+
+        return ('\n'.join(lines) + '\n').encode()
+
+
+# Log of the requests and debug messages, written as JSON lines by a background thread
+# The records wait in a fixed-size ring buffer and are dropped (and counted) when it is full, so a slow terminal or
+# disk never blocks the event loop
+class AccessLog:
+    # Levels of the records, the ones below the level of the log are ignored
+    DEBUG = 10
+    INFO = 20
+    LEVELS = {'debug': DEBUG, 'info': INFO}
+    # Seconds between two writes of the buffered records
+    FLUSH_INTERVAL = 0.2
+
+    def __init__(self, stream, level = INFO, sample_rate = 1.0, capacity = 8192):
+        self.stream = stream
+        self.level = level
+        # Fraction of the requests logged
+        self.sample_rate = sample_rate
+        # Ring buffer of the records waiting to be written, as (time, level, values) tuples
+        self.records = [None] * capacity
+        self.first = 0
+        self.count = 0
+        # The records are added by the event loop (and the threads of the I/O pool of the TCP server)
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        # Wakes up the writer thread early when the buffer fills up or when the log is closed
+        self.wakeup = threading.Event()
+        self.closed = False
+        # Counters exposed through stats()
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.thread = threading.Thread(target=self.__write_forever, name='httpfs-log', daemon=True)
+        self.thread.start()
+
+    # Log a debug message
+    def debug(self, message):
+        if self.level <= self.DEBUG:
+            self.__append((time.time(), self.DEBUG, message))
+
+    # Log a request answered, with the client address, the size of the response body and the seconds it took
+    def access(self, peer, verb, path, status, size, duration):
+        if self.level > self.INFO:
+            return
+        if self.sample_rate < 1 and self.random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        self.__append((time.time(), self.INFO, (peer, verb, path, status, size, duration)))
+
+    # Write the remaining records and stop the writer thread
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+
+    # Get the log counters
+    def stats(self):
+        return {
+            'buffered': self.count,
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out
+        }
+
+    def __append(self, record):
+        capacity = len(self.records)
+        with self.lock:
+            if self.count == capacity:
+                self.dropped += 1
+                return
+            self.records[(self.first + self.count) % capacity] = record
+            self.count += 1
+            if self.count == capacity // 2:
+                self.wakeup.set()
+
+    def __write_forever(self):
+        while True:
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+            closed = self.closed
+            self.__write()
+            if closed:
+                return
+
+    # Take the buffered records and write them at once, outside of the lock
+    def __write(self):
+        capacity = len(self.records)
+        with self.lock:
+            records = []
+            for i in range(self.count):
+                index = (self.first + i) % capacity
+                records.append(self.records[index])
+                self.records[index] = None
+            self.first = (self.first + self.count) % capacity
+            self.count = 0
+
+        if not records:
+            return
+
+        lines = []
+        for timestamp, level, values in records:
+            line = {'time': datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(
+                timespec='milliseconds')}
+            if level == self.DEBUG:
+                line['level'] = 'debug'
+                line['message'] = values
+            else:
+                peer, verb, path, status, size, duration = values
+                line.update({
+                    'level': 'info',
+                    'peer': f'{peer[0]}:{peer[1]}' if peer else None,
+                    'verb': verb,
+                    'path': path,
+                    'status': status,
+                    'bytes': size,
+                    'duration_ms': round(duration * 1000, 3)
+                })
+            lines.append(json.dumps(line) + '\n')
+
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (OSError, ValueError):
+            # The records are lost but the server keeps running
+            self.dropped += len(records)
+            return
+        self.written += len(records)
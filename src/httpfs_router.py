@@ -0,0 +1,251 @@
+#############################################################################################
+# Router simulator
+#
+# Stand-in for the router of router/source/router.go: it forwards the packets between the
+# applications and swaps the peer address of their header from the destination to the
+# sender. Every decision (drops, delays, reordering, duplicates) comes from a seeded random
+# generator, and the links to each destination can be capped to a bandwidth.
+#############################################################################################
+
+
+import argparse
+import heapq
+import ipaddress
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+
+
+#############################################################################################
+# Library Implementation
+#############################################################################################
+
+
+class RouterSimulator:
+    # Router header: type, sequence number, peer IPv4 address and peer port (big endian)
+    HEADER = struct.Struct('!BI4sH')
+    # Largest packet accepted
+    MAX_PACKET_SIZE = 1024
+    # Distributions of the delays, between 0 and the maximum delay
+    DELAY_DISTRIBUTIONS = ('uniform', 'exponential', 'constant')
+    # Longest wait of the loop, so stop() is noticed quickly
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, port, drop_rate = 0.0, max_delay = 0.0, delay_distribution = 'uniform', reorder_rate = 0.0,
+                 reorder_delay = 0.01, duplicate_rate = 0.0, bandwidth = None, queue_size = 256 * 1024, seed = None,
+                 host = '', verbose = False):
+        if delay_distribution not in self.DELAY_DISTRIBUTIONS:
+            raise ValueError(f'Unknown delay distribution: {delay_distribution}')
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+        # Probability of a packet to be dropped, held back behind the next packets or sent twice
+        self.drop_rate = drop_rate
+        self.reorder_rate = reorder_rate
+        self.reorder_delay = reorder_delay
+        self.duplicate_rate = duplicate_rate
+        # Delay of every packet in seconds
+        self.max_delay = max_delay
+        self.delay_distribution = delay_distribution
+        # Bytes per second of the link to each destination (unlimited if None) and bytes queued before a tail drop
+        self.bandwidth = bandwidth
+        self.queue_size = queue_size
+        self.verbose = verbose
+
+        self.random = random.Random(seed)
+        # Packets waiting for their delivery, as (delivery time, arrival order, datagram, destination)
+        self.scheduled = []
+        self.arrivals = 0
+        # Time at which the link to each destination is done sending the packets queued
+        self.link_free_at = {}
+
+        self.running = False
+        self.stats = {
+            'received': 0,
+            'invalid': 0,
+            'dropped': 0,
+            'queue_dropped': 0,
+            'reordered': 0,
+            'duplicated': 0,
+            'delivered': 0
+        }
+
+    # Forward the packets until stop() is called
+    def serve_forever(self):
+        ready = selectors.DefaultSelector()
+        ready.register(self.sock, selectors.EVENT_READ)
+        self.running = True
+
+        try:
+            while self.running:
+                wait = self.POLL_INTERVAL
+                if self.scheduled:
+                    wait = min(wait, max(self.scheduled[0][0] - time.monotonic(), 0))
+
+                if ready.select(wait):
+                    self.__receive()
+                self.__deliver()
+        finally:
+            ready.close()
+            self.sock.close()
+
+    # Forward the packets from a daemon thread, return the thread
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+
+    def __receive(self):
+        while True:
+            try:
+                datagram, sender = self.sock.recvfrom(2 * self.MAX_PACKET_SIZE)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                # ICMP port unreachable of a previous packet
+                continue
+
+            self.stats['received'] += 1
+            try:
+                packet, destination = self.__route(datagram, sender)
+            except ValueError as e:
+                self.stats['invalid'] += 1
+                self.__log(f'invalid packet: {e}')
+                continue
+
+            self.__process(packet, destination)
+            if self.random.random() < self.duplicate_rate:
+                self.stats['duplicated'] += 1
+                self.__process(packet, destination)
+
+    # Swap the peer address of the header from the destination to the sender
+    def __route(self, datagram, sender):
+        if len(datagram) < self.HEADER.size:
+            raise ValueError(f'packet is too short: {len(datagram)} bytes')
+        if len(datagram) > self.MAX_PACKET_SIZE:
+            raise ValueError(f'packet is exceeded max length: {len(datagram)} bytes')
+
+        packet_type, seq, peer_ip, peer_port = self.HEADER.unpack_from(datagram)
+        destination_ip = socket.inet_ntoa(peer_ip)
+        # A loopback destination is on the same host as the sender
+        if ipaddress.ip_address(destination_ip).is_loopback:
+            destination_ip = sender[0]
+
+        header = self.HEADER.pack(packet_type, seq, socket.inet_aton(sender[0]), sender[1])
+        return header + datagram[self.HEADER.size:], (destination_ip, peer_port)
+
+    # Drop the packet or schedule its delivery
+    def __process(self, packet, destination):
+        if self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            self.__log(f'packet of {len(packet)} bytes to {destination} is dropped')
+            return
+
+        now = time.monotonic()
+        departure = now
+
+        # Packets wait for the link to be done sending the previous ones, unless the queue is full
+        if self.bandwidth:
+            free_at = max(self.link_free_at.get(destination, now), now)
+            if (free_at - now) * self.bandwidth + len(packet) > self.queue_size:
+                self.stats['queue_dropped'] += 1
+                self.__log(f'packet of {len(packet)} bytes to {destination} is dropped by the full queue')
+                return
+            departure = free_at + len(packet) / self.bandwidth
+            self.link_free_at[destination] = departure
+
+        delay = self.__sample_delay()
+        if self.reorder_rate and self.random.random() < self.reorder_rate:
+            self.stats['reordered'] += 1
+            delay += self.reorder_delay
+
+        self.arrivals += 1
+        heapq.heappush(self.scheduled, (departure + delay, self.arrivals, packet, destination))
+        self.__log(f'packet of {len(packet)} bytes to {destination} is delayed for {delay * 1000:.3f}ms')
+
+    def __sample_delay(self):
+        if self.max_delay <= 0:
+            return 0.0
+        if self.delay_distribution == 'constant':
+            return self.max_delay
+        if self.delay_distribution == 'exponential':
+            # Mostly short delays with a long tail, cut at the maximum
+            return min(self.random.expovariate(4 / self.max_delay), self.max_delay)
+        return self.random.uniform(0, self.max_delay)
+
+    # Send the packets whose delivery time has come
+    def __deliver(self):
+        now = time.monotonic()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, _, packet, destination = heapq.heappop(self.scheduled)
+            try:
+                self.sock.sendto(packet, destination)
+                self.stats['delivered'] += 1
+            except OSError as e:
+                self.__log(f'failed to deliver packet to {destination}: {e}')
+
+    def __log(self, message):
+        if self.verbose:
+            print(f'[ROUTER] {message}')
+
+
+#############################################################################################
+# CLI Tool Implementation
+#############################################################################################
+
+
+# Parse a duration in the format of the Go router (5ms, 4s, 1m) into seconds
+def __parse_duration(value):
+    units = {'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60}
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * units[unit]
+    return float(value)
+
+
+# Access a values by doing "args.port" or "args.drop_rate", etc.
+def __parse_flags():
+    parser = argparse.ArgumentParser(prog="router")
+
+    parser.add_argument("-v", "--verbose", help="Log every packet", action="store_true")
+    parser.add_argument("--port", help="Port to listen on for the packets", type=int, default=3000)
+    parser.add_argument("--drop-rate", help="Probability of a packet to be dropped", type=float, default=0.0)
+    parser.add_argument("--max-delay", help="Maximum delay of a packet (eg. 5ms, 4s or 1m)", type=__parse_duration,
+                        default=0.0)
+    parser.add_argument("--delay-distribution", help="Distribution of the delays",
+                        choices=RouterSimulator.DELAY_DISTRIBUTIONS, default='uniform')
+    parser.add_argument("--reorder-rate", help="Probability of a packet to be held back behind the next ones",
+                        type=float, default=0.0)
+    parser.add_argument("--reorder-delay", help="Extra delay of the packets held back", type=__parse_duration,
+                        default=0.01)
+    parser.add_argument("--duplicate-rate", help="Probability of a packet to be sent twice", type=float, default=0.0)
+    parser.add_argument("--bandwidth", help="Bytes per second of the link to each destination", type=float)
+    parser.add_argument("--queue-size", help="Bytes queued on a link before the packets are dropped", type=int,
+                        default=256 * 1024)
+    parser.add_argument("--seed", help="Seed of the random decisions", type=int)
+
+    return parser.parse_args()
+
+
+# CLI Entry Point
+if __name__ == "__main__":
+    flags = __parse_flags()
+
+    router = RouterSimulator(flags.port, flags.drop_rate, flags.max_delay, flags.delay_distribution,
+                             flags.reorder_rate, flags.reorder_delay, flags.duplicate_rate, flags.bandwidth,
+                             flags.queue_size, flags.seed, verbose=flags.verbose)
+    print(f'[INIT] Router is listening at {router.address[0]}:{router.address[1]}')
+
+    try:
+        router.serve_forever()
+    except KeyboardInterrupt:
+        pass
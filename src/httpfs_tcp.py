@@ -6,18 +6,68 @@
 
 
 import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import ctypes
 import datetime
+import email.utils
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import itertools
 import json
 import mimetypes
 import os
 import pathlib
+import posixpath
 import re
 import selectors
+import shutil
+import signal
 import socket
+import struct
+import sys
+import tarfile
+import threading
+import time
+import traceback
 import types
+import urllib.parse
+import uuid
+import zipfile
 from enum import Enum
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 from wsgiref.handlers import format_date_time
 
+from httpfs_metrics import AccessLog, Metrics
+
+# Faster event loop for the asyncio engine, when it is installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Locks shared by the workers on the records of the resumable uploads, when the platform has them
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Extra content encodings, when they are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 #############################################################################################
 # Library Implementation
@@ -28,24 +78,1687 @@ from wsgiref.handlers import format_date_time
 class HttpStatus(Enum):
     OK = (200, "OK")
     CREATED = (201, "Created")
+    ACCEPTED = (202, "Accepted")
+    PARTIAL_CONTENT = (206, "Partial Content")
+    NOT_MODIFIED = (304, "Not Modified")
     FORBIDDEN = (403, "Forbidden")
     BAD_REQUEST = (400, "Bad Request")
     NOT_FOUND = (404, "Not Found")
+    CONFLICT = (409, "Conflict")
+    PRECONDITION_FAILED = (412, "Precondition Failed")
+    RANGE_NOT_SATISFIABLE = (416, "Range Not Satisfiable")
     INTERNAL_SERVER_ERROR = (500, "Internal Server Error")
+    SERVICE_UNAVAILABLE = (503, "Service Unavailable")
 
 
 # Subset of the valid HTTP Verbs
 class HttpVerb(Enum):
     GET = "GET"
     POST = "POST"
+    PUT = "PUT"
+    PATCH = "PATCH"
+
+
+# Incremental parser for the requests received on a single connection
+class HttpRequestParser:
+    # Pattern of the first line of a request (e.g. "GET /file.txt HTTP/1.1")
+    REQUEST_LINE = re.compile(r'^([A-Z]+) (.+) HTTP/(\d\.?\d?)$')
+    # Maximum number of bytes in the headers or in a chunk size line
+    MAX_LINE_SIZE = 65536
+
+    # States of a chunked body
+    CHUNK_SIZE = 'size'
+    CHUNK_DATA = 'data'
+    CHUNK_END = 'end'
+    CHUNK_TRAILER = 'trailer'
+
+    def __init__(self, create_body):
+        # Function returning the destination of a request body once its headers are received
+        self.create_body = create_body
+        # Bytes received from the client that were not consumed yet
+        self.buffer = bytearray()
+        # Offset from which the search for the end of the headers resumes
+        self.scan_index = 0
+        # Request currently being received (None while waiting for its headers)
+        self.request = None
+        # Destination of the body of the current request
+        self.body = None
+        # Number of body bytes left to receive for the current request (or the current chunk)
+        self.remaining = 0
+        # State of the current request body if it uses the chunked transfer encoding
+        self.chunk_state = None
+        # Whether the client is waiting for a "100 Continue" before sending the body
+        self.expect_continue = False
+
+    # Add the bytes received from the socket to the buffer
+    def feed(self, data):
+        self.buffer += data
+
+    # Return the next complete request from the buffer, or None if more bytes are needed
+    def next_request(self):
+        # Wait for the end of the headers
+        if self.request is None:
+            end = self.buffer.find(b'\r\n\r\n', self.scan_index)
+            if end == -1:
+                if len(self.buffer) > self.MAX_LINE_SIZE:
+                    raise ValueError('The request headers are too large.')
+                # Only the last 3 bytes can be the start of a terminator split across reads
+                self.scan_index = max(0, len(self.buffer) - 3)
+                return None
+
+            # Parse the headers and keep the leftover bytes for the body or the next request
+            self.request = self.__parse_head(bytes(self.buffer[:end]))
+            del self.buffer[:end + 4]
+            self.scan_index = 0
+            self.body = self.create_body(self.request)
+
+            # A body refused before the client sends it isn't waited for, the refusal is the final response
+            if self.expect_continue and isinstance(self.body, DiscardedBody) and self.body.status is not None:
+                self.expect_continue = False
+                self.chunk_state = None
+                self.remaining = 0
+                self.request['body_skipped'] = True
+
+        # Move the received body bytes to their destination, so only a chunk is ever kept in memory
+        if self.chunk_state is not None:
+            complete = self.__read_chunks()
+        else:
+            complete = self.__read_body()
+        if not complete:
+            return None
+
+        request = self.request
+        request['body'] = self.body
+        self.body.finish()
+
+        # Reset the state for the next request on the connection
+        self.request = None
+        self.body = None
+        self.chunk_state = None
+        self.expect_continue = False
+
+        return request
+
+    # Determine if part of a request was received
+    def has_partial_request(self):
+        return self.request is not None or len(self.buffer) > 0
+
+    # Discard the body of a request that will never be completed
+    def close(self):
+        if self.body is not None:
+            self.body.discard()
+            self.body = None
+
+    # Build a request dictionary from the request line and the headers
+    def __parse_head(self, head):
+        lines = head.decode('iso-8859-1').split('\r\n')
+
+        # Use REGEX to parse the request pattern
+        match = self.REQUEST_LINE.search(lines[0])
+        if match is None:
+            raise ValueError(f'Malformed request line: {lines[0]!r}')
+
+        # Build a dictionary from the header lines (names are case-insensitive)
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # A chunked body ends with an empty chunk, otherwise its length is known in advance
+        transfer_encoding = headers.get('transfer-encoding', '').lower()
+        if transfer_encoding == 'chunked':
+            self.chunk_state = self.CHUNK_SIZE
+        elif transfer_encoding:
+            raise ValueError(f'Unsupported Transfer-Encoding: {transfer_encoding!r}')
+        else:
+            try:
+                self.remaining = int(headers.get('content-length', 0))
+            except ValueError:
+                raise ValueError(f'Invalid Content-Length: {headers["content-length"]!r}')
+            if self.remaining < 0:
+                raise ValueError(f'Invalid Content-Length: {self.remaining}')
+
+        # The client waits for an interim response before sending a body it announced
+        self.expect_continue = headers.get('expect', '').lower() == '100-continue' and (
+            self.chunk_state is not None or self.remaining > 0)
+
+        # Split the query string from the path
+        target = urllib.parse.urlsplit(match.group(2))
+
+        return {
+            'verb': match.group(1),
+            'path': urllib.parse.unquote(target.path),
+            'query': dict(urllib.parse.parse_qsl(target.query, keep_blank_values=True)),
+            'version': match.group(3),
+            'headers': headers,
+            'body_skipped': False
+        }
+
+    # Move the available bytes of a body with a known length, return True once it is complete
+    def __read_body(self):
+        self.__write_body(min(self.remaining, len(self.buffer)))
+        return self.remaining == 0
+
+    # Decode the available bytes of a chunked body, return True once it is complete
+    def __read_chunks(self):
+        while True:
+            # Line with the size of the next chunk in hexadecimal (extensions are ignored)
+            if self.chunk_state == self.CHUNK_SIZE:
+                line = self.__read_line()
+                if line is None:
+                    return False
+                try:
+                    self.remaining = int(line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise ValueError(f'Invalid chunk size: {line!r}')
+                self.chunk_state = self.CHUNK_DATA if self.remaining > 0 else self.CHUNK_TRAILER
+
+            # Contents of the chunk
+            elif self.chunk_state == self.CHUNK_DATA:
+                self.__write_body(min(self.remaining, len(self.buffer)))
+                if self.remaining > 0:
+                    return False
+                self.chunk_state = self.CHUNK_END
+
+            # Line break following the contents of the chunk
+            elif self.chunk_state == self.CHUNK_END:
+                line = self.__read_line()
+                if line is None:
+                    return False
+                if line:
+                    raise ValueError('Missing line break after a chunk.')
+                self.chunk_state = self.CHUNK_SIZE
+
+            # Optional trailer headers (ignored) up to an empty line
+            else:
+                line = self.__read_line()
+                if line is None:
+                    return False
+                if not line:
+                    return True
+
+    # Consume a line from the buffer, or return None if it wasn't completely received
+    def __read_line(self):
+        end = self.buffer.find(b'\r\n')
+        if end == -1:
+            if len(self.buffer) > self.MAX_LINE_SIZE:
+                raise ValueError('A line of the request body is too large.')
+            return None
+
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 2]
+        return line
+
+    # Move a number of bytes from the buffer to the request body
+    def __write_body(self, count):
+        if count == 0:
+            return
+
+        # Release the view before resizing the buffer
+        with memoryview(self.buffer) as view, view[:count] as chunk:
+            self.body.write(chunk)
+        del self.buffer[:count]
+        self.remaining -= count
+
+
+# Request body streamed to a temporary file next to its destination
+class TemporaryFileBody:
+    def __init__(self, path, hashed = False):
+        # Create all the parent directories required
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Hidden file in the same directory, so it can be renamed atomically to its destination
+        while True:
+            self.temp_path = path.parent.joinpath(f'.{path.name}.{uuid.uuid4().hex[:16]}.part')
+            try:
+                fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+                break
+            except FileExistsError:
+                continue
+
+        self.file = os.fdopen(fd, 'wb')
+        # Number of bytes received
+        self.size = 0
+        # Error that prevented the body from being stored
+        self.error = None
+        # SHA-256 of the body computed while it is received (for the blob store)
+        self.hash = hashlib.sha256() if hashed else None
+
+    # Write a chunk of the body (the rest of the body is ignored after an error)
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.file.write(data)
+            except OSError as e:
+                self.error = e
+                self.discard()
+        if self.hash is not None:
+            self.hash.update(data)
+        self.size += len(data)
+
+    # Flush the file once the whole body is received
+    def finish(self):
+        try:
+            self.file.close()
+        except OSError as e:
+            self.error = e
+            self.discard()
+
+    # Replace the destination with the received body
+    def commit(self, path):
+        if self.error is not None:
+            raise self.error
+        os.replace(self.temp_path, path)
+        self.temp_path = None
+
+    # Delete the temporary file if it wasn't committed
+    def discard(self):
+        if self.temp_path is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+
+# Request body that is received but not kept (e.g. unused or unwritable)
+class DiscardedBody:
+    def __init__(self, error = None, status = None):
+        # Error that prevented the body from being stored
+        self.error = error
+        # Status of the response if the write was refused before the body was received
+        self.status = status
+        # Number of bytes received
+        self.size = 0
+        self.hash = None
+
+    def write(self, data):
+        self.size += len(data)
+
+    def finish(self):
+        pass
+
+    def commit(self, path):
+        raise self.error or IOError('The request body was not stored.')
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+# Request body written in place at an offset of a file as it is received (partial writes and resumable uploads)
+class RangeBody:
+    def __init__(self, path, start, length, record = None, run = None):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+        # Offset of the first byte of the range and number of bytes in the range
+        self.start = start
+        self.length = length
+        # Function called with the file and the (start, end) bytes written once they are on the disk, even if the body
+        # is cut short, and function running it in the background when it is
+        self.record = record
+        self.run = run
+        # Number of bytes received and written
+        self.size = 0
+        self.written = 0
+        # Error that prevented the body from being written
+        self.error = None
+        self.hash = None
+
+    # Write a chunk of the body at its offset (the bytes after the end of the range or after an error are ignored)
+    def write(self, data):
+        if self.error is None and self.written < self.length:
+            chunk = memoryview(data)[:self.length - self.written]
+            try:
+                while chunk:
+                    count = os.pwrite(self.fd, chunk, self.start + self.written)
+                    self.written += count
+                    chunk = chunk[count:]
+            except OSError as e:
+                self.error = e
+        self.size += len(data)
+
+    # The file stays open until the request is handled, so the bytes are recorded outside of the event loop
+    def finish(self):
+        pass
+
+    def commit(self, path):
+        raise IOError('A range of a file is written in place.')
+
+    # Record the bytes written and close the file
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is None:
+            return
+        try:
+            if self.record is not None and self.written:
+                os.fsync(fd)
+                self.record(fd, self.start, self.start + self.written)
+        except OSError as e:
+            self.error = self.error or e
+        finally:
+            os.close(fd)
+
+    # The bytes already written are kept, so an interrupted upload can be resumed after them
+    def discard(self):
+        if self.fd is not None and self.record is not None and self.written:
+            self.run(self.close)
+        else:
+            self.close()
+
+
+# Write-only buffer the streamed archives are written to, emptied every time a chunk of the archive is sent
+# It can't seek, so the zip files are written with data descriptors instead of going back to their headers
+class ArchiveBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Remove and return the bytes written since the last call
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return data
+
+
+# Queue of the bytes and file ranges waiting to be sent back on a connection
+class ResponseQueue:
+    # Let the kernel copy the file contents straight to the socket when the platform supports it
+    SENDFILE = hasattr(os, 'sendfile')
+
+    def __init__(self, chunk_size, generate = None):
+        # Segments waiting to be sent, as [bytes, offset], [file, offset, remaining, close] or [iterator] lists
+        self.segments = collections.deque()
+        # Maximum number of bytes sent from a file at once
+        self.chunk_size = chunk_size
+        # Reusable buffer used to read the files when sendfile isn't available
+        self.buffer = None
+        # Function generating the next chunk of a stream in the background (None to generate it in the loop), called
+        # with the stream, resume() must be called with the chunk once it is generated
+        self.generate = generate
+        # Stream whose next chunk is being generated in the background
+        self.generating = None
+
+    def __bool__(self):
+        return bool(self.segments)
+
+    # Determine if there is something to send right now (not waiting for the next chunk of a stream)
+    def is_ready(self):
+        return bool(self.segments) and self.generating is None
+
+    # Queue bytes to be sent
+    def append_bytes(self, data):
+        if data:
+            self.segments.append([data, 0])
+
+    # Queue a range of an open file to be sent, the file can be closed once the range is sent
+    def append_file(self, file, offset, count, close = True):
+        if count > 0:
+            self.segments.append([file, offset, count, close])
+        elif close:
+            file.close()
+
+    # Queue the chunks produced by an iterator, they are only generated once the previous segments are sent
+    # The chunks are bytes or (file, offset, count) ranges of files to send, the files are closed once sent
+    def append_stream(self, chunks):
+        self.segments.append([chunks])
+
+    # Move the segments of another queue to the end of this one
+    def extend(self, other):
+        self.segments.extend(other.segments)
+        other.segments.clear()
+
+    # Send as much as possible without blocking and return the number of bytes sent
+    # At most one chunk of a stream is generated per call, so a stream faster than the socket can't hold up the loop
+    def send(self, sock):
+        total = 0
+        generated = False
+
+        while self.segments and self.generating is None:
+            segment = self.segments[0]
+
+            # Generate the next chunk of a stream in front of it
+            if len(segment) == 1:
+                if generated:
+                    break
+                if self.generate is not None:
+                    self.generating = segment[0]
+                    self.generate(segment[0])
+                    break
+                try:
+                    chunk = next(segment[0], None)
+                except OSError as e:
+                    raise ConnectionAbortedError(f'The response could not be generated: {e}')
+                self.__queue_chunk(chunk)
+                generated = True
+                continue
+
+            try:
+                if len(segment) == 2:
+                    sent, attempted, done = self.__send_bytes(sock, segment)
+                else:
+                    sent, attempted, done = self.__send_file(sock, segment)
+            except BlockingIOError:
+                break
+            total += sent
+
+            if done:
+                self.segments.popleft()
+                if len(segment) == 4 and segment[3]:
+                    segment[0].close()
+            # Stop once the socket buffer is full
+            elif sent < attempted:
+                break
+
+        return total
+
+    # Queue the chunk generated in the background in front of its stream (the result is an exception if it failed)
+    def resume(self, result):
+        stream = self.generating
+        self.generating = None
+
+        # The queue was closed while the chunk was generated
+        if not self.segments or self.segments[0][0] is not stream:
+            stream.close()
+            if isinstance(result, tuple):
+                result[0].close()
+            return
+
+        if isinstance(result, Exception):
+            raise ConnectionAbortedError(f'The response could not be generated: {result}')
+        self.__queue_chunk(result)
+
+    # Close the files that were not sent (the stream being generated is closed once its chunk is done)
+    def close(self):
+        for segment in self.segments:
+            if len(segment) != 2 and segment[0] is not self.generating:
+                segment[0].close()
+        self.segments.clear()
+
+    # Queue the next chunk of the stream in front of the queue, or remove the stream at its end (None)
+    def __queue_chunk(self, chunk):
+        if chunk is None:
+            self.segments.popleft()
+        elif isinstance(chunk, tuple):
+            self.segments.appendleft([*chunk, True])
+        else:
+            self.segments.appendleft([chunk, 0])
+
+    # Send the rest of a bytes segment without copying it
+    def __send_bytes(self, sock, segment):
+        data, offset = segment
+        with memoryview(data) as view:
+            sent = sock.send(view[offset:])
+        segment[1] += sent
+        return sent, len(data) - offset, segment[1] == len(data)
+
+    # Send the next chunk of a file segment
+    def __send_file(self, sock, segment):
+        file, offset, remaining, _ = segment
+        count = min(remaining, self.chunk_size)
+
+        if self.SENDFILE:
+            sent = os.sendfile(sock.fileno(), file.fileno(), offset, count)
+        else:
+            # Read the chunk into the reusable buffer, the unsent part is read again on the next call
+            if self.buffer is None:
+                self.buffer = bytearray(self.chunk_size)
+            file.seek(offset)
+            with memoryview(self.buffer) as view:
+                read = file.readinto(view[:count])
+                sent = sock.send(view[:read]) if read else 0
+
+        # The file was truncated since the response headers were sent
+        if sent == 0:
+            raise ConnectionAbortedError(f'Unexpected end of file {file.name}')
+
+        segment[1] += sent
+        segment[2] -= sent
+        return sent, count, segment[2] == 0
+
+
+# Size-bounded LRU cache of the contents of small files
+class FileCache:
+    def __init__(self, max_bytes, max_entry_size):
+        # Cached files by path, from the least to the most recently used
+        self.entries = collections.OrderedDict()
+        # Maximum number of body bytes kept in the cache
+        self.max_bytes = max_bytes
+        # Files larger than this are never cached
+        self.max_entry_size = max_entry_size
+        # Number of body bytes currently cached
+        self.size = 0
+        # The cache is shared by the threads of the I/O pool
+        self.lock = threading.RLock()
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached entry of a file if it is still up to date, otherwise None
+    def get(self, key, stat):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Files that changed since they were cached are reloaded
+            if entry is not None and (entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size):
+                self.invalidate(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    # Cache the contents of a file and the values derived from them, return the new entry
+    def put(self, key, stat, body, mime_type, content_disposition, headers):
+        with self.lock:
+            entry = types.SimpleNamespace(
+                body=body,
+                mime_type=mime_type,
+                content_disposition=content_disposition,
+                headers=headers,
+                mtime=stat.st_mtime_ns,
+                size=stat.st_size,
+                # Encodings without a precompressed file, not looked for again while the entry is cached
+                missing_variants=set()
+            )
+            if len(body) > self.max_entry_size or len(body) > self.max_bytes:
+                return entry
+
+            self.invalidate(key)
+            self.entries[key] = entry
+            self.size += len(body)
+
+            # Evict the least recently used files until the cache fits in its budget
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+            return entry
+
+    # Return the cached entry of a file if it is still up to date, without counting it as a hit
+    def peek(self, key, stat):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+                return entry
+            return None
+
+    # Remove a file from the cache (e.g. when it is overwritten)
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.body)
+
+    # Get the cache counters
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+# LRU cache of the contents of the most recently listed directories
+class ListingCache:
+    def __init__(self, max_directories):
+        # Cached listings by directory path, from the least to the most recently used
+        self.entries = collections.OrderedDict()
+        # Maximum number of directories kept in the cache
+        self.max_directories = max_directories
+        # The cache is shared by the threads of the I/O pool
+        self.lock = threading.RLock()
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached listing of a directory if it didn't change since, otherwise None
+    def get(self, key, stat):
+        with self.lock:
+            listing = self.entries.get(key)
+
+            # Adding, removing or renaming a child updates the modification time of the directory
+            if listing is not None and listing.mtime != stat.st_mtime_ns:
+                self.invalidate(key)
+                listing = None
+
+            if listing is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return listing
+
+    # Cache the listing of a directory
+    def put(self, key, listing):
+        with self.lock:
+            self.entries[key] = listing
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used directories
+            while len(self.entries) > self.max_directories:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # Remove a directory from the cache (e.g. when a file is written in it)
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # Get the cache counters
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+# Size-bounded LRU cache of the compressed versions of the text files, with the CPU budget of the compression
+class CompressionCache:
+    # Content encodings of the compressed bodies, by order of preference
+    ENCODINGS = ('br', 'zstd', 'gzip')
+
+    def __init__(self, max_bytes, max_entry_size, cpu_share):
+        # Compressed bodies by (path, encoding), from the least to the most recently used
+        self.entries = collections.OrderedDict()
+        # Maximum number of compressed bytes kept in the cache
+        self.max_bytes = max_bytes
+        # Files larger than this are never compressed on the fly
+        self.max_entry_size = max_entry_size
+        # Number of compressed bytes currently cached
+        self.size = 0
+        # Seconds of CPU the compression may use per second, saved up to one second for the bursts
+        self.cpu_share = cpu_share
+        self.credit = 1.0
+        self.refilled = time.monotonic()
+        # The cache is shared by the threads of the I/O pool
+        self.lock = threading.RLock()
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.over_budget = 0
+
+    # Return the cached compressed body of a file if the file didn't change since, otherwise None
+    def get(self, key, encoding, stat):
+        with self.lock:
+            entry = self.entries.get((key, encoding))
+
+            if entry is not None and (entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size):
+                self.invalidate(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end((key, encoding))
+            return entry.body
+
+    # Cache the compressed body of a file
+    def put(self, key, encoding, stat, body):
+        with self.lock:
+            if len(body) > self.max_bytes:
+                return
+
+            self.__remove((key, encoding))
+            self.entries[(key, encoding)] = types.SimpleNamespace(body=body, mtime=stat.st_mtime_ns,
+                                                                  size=stat.st_size)
+            self.size += len(body)
+
+            # Evict the least recently used bodies until the cache fits in its budget
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+    # Determine if there is CPU left for compressing a body now
+    def has_budget(self):
+        with self.lock:
+            now = time.monotonic()
+            self.credit = min(self.credit + (now - self.refilled) * self.cpu_share, 1.0)
+            self.refilled = now
+            if self.credit > 0:
+                return True
+
+            self.over_budget += 1
+            return False
+
+    # Count the CPU time spent compressing a body
+    def charge(self, seconds):
+        with self.lock:
+            self.credit -= seconds
+
+    # Remove every compressed version of a file (e.g. when it is overwritten)
+    def invalidate(self, key):
+        with self.lock:
+            for encoding in self.ENCODINGS:
+                self.__remove((key, encoding))
+
+    # Get the cache counters
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'over_budget': self.over_budget
+            }
+
+    def __remove(self, cache_key):
+        entry = self.entries.pop(cache_key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+
+# Content-addressed store of the uploaded files: every body is stored once under its SHA-256 and the files written are
+# hard links to their blob, so identical uploads share their blocks and a client can skip sending contents already stored
+class BlobStore:
+    def __init__(self, root):
+        self.root = pathlib.Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Bodies stored, bodies replaced by a link to a blob already stored, and bytes they would have used
+        self.stored = 0
+        self.deduplicated = 0
+        self.saved_bytes = 0
+        # Bodies stored without a blob because the file system can't link them
+        self.unlinked = 0
+
+    # Path of the blob of a SHA-256 digest (in hex)
+    def path(self, digest):
+        return self.root.joinpath('sha256', digest[:2], digest)
+
+    # Replace the destination with a received body, return True if its blob was already stored
+    def commit(self, content, digest, path):
+        if content.error is not None:
+            raise content.error
+
+        blob = self.path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(content.temp_path, blob)
+        except FileExistsError:
+            # The contents are already stored, the received copy is dropped for a link to them
+            if self.link(digest, path, content.size):
+                content.discard()
+                return True
+            content.commit(path)
+            return False
+        except OSError as e:
+            # Other file system or too many links to the blob
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOTSUP):
+                raise
+            content.commit(path)
+            with self.lock:
+                self.unlinked += 1
+            return False
+
+        content.commit(path)
+        with self.lock:
+            self.stored += 1
+        return False
+
+    # Replace the destination with a link to a blob, return False if the blob isn't stored
+    def link(self, digest, path, size = 0):
+        # Linked next to the destination first, so it is replaced atomically
+        temp_path = path.parent.joinpath(f'.{path.name}.{uuid.uuid4().hex[:16]}.part')
+        try:
+            os.link(self.path(digest), temp_path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+        with self.lock:
+            self.deduplicated += 1
+            self.saved_bytes += size or os.stat(path).st_size
+        return True
+
+    # Remove the blobs no file links to anymore, return the number removed
+    def collect(self):
+        removed = 0
+        for blob in self.root.glob('sha256/*/*'):
+            try:
+                if os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    # Get the store counters
+    def stats(self):
+        with self.lock:
+            return {
+                'stored': self.stored,
+                'deduplicated': self.deduplicated,
+                'saved_bytes': self.saved_bytes,
+                'unlinked': self.unlinked
+            }
+
+
+# In-memory index of the files of the shared directory, by path relative to it, kept up to date with inotify (or by
+# scanning the directory again periodically) so the search and stat queries never touch the disk
+class TreeIndex:
+    # inotify events watched on every directory
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | \
+        IN_DONT_FOLLOW
+    # Header of the inotify events: watch descriptor, mask, cookie and length of the name following it
+    EVENT = struct.Struct('iIII')
+    # Seconds between two scans without inotify
+    POLL_INTERVAL = 5
+    # Number of removed paths remembered for the modified-since queries
+    MAX_REMOVED = 10000
+
+    def __init__(self, root, use_inotify = True, poll_interval = POLL_INTERVAL):
+        self.root = str(root)
+        # Files and directories as (size, modification time in ns, is directory) tuples, the root is ''
+        self.entries = {}
+        # Names of the children and [bytes, files, directories] totals of the tree of every directory
+        self.children = {}
+        self.totals = {}
+        # Sorted (modification time, path) tuples, built once the first scan is done
+        self.by_mtime = None
+        # Time of removal of the paths removed since the index was built
+        self.removed = collections.OrderedDict()
+        # The index is updated by its thread and by the threads writing files, and read by the queries
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.poll_interval = poll_interval
+
+        # Directories watched by watch descriptor, when inotify is available
+        self.libc = None
+        self.inotify = None
+        self.watches = {}
+        if use_inotify:
+            self.__start_inotify()
+
+        self.thread = threading.Thread(target=self.__run, name='httpfs-index', daemon=True)
+        self.thread.start()
+
+    # Update the index after a file or a directory was changed through the server
+    def refresh(self, path):
+        # The first scan picks up the changes made before it is done
+        if not self.ready.is_set():
+            return
+        relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+        self.__refresh('' if relative == '.' else relative)
+
+    # Get the entry of a path and the totals of its tree (None for the files), or None if it isn't indexed
+    def get(self, relative):
+        with self.lock:
+            entry = self.entries.get(relative)
+            if entry is None:
+                return None
+            return entry, list(self.totals[relative]) if entry[2] else None
+
+    # List the paths of a tree (including its root) with their entries
+    def list(self, relative):
+        with self.lock:
+            if relative not in self.entries:
+                return []
+
+            paths = []
+            directories = [relative]
+            while directories:
+                directory = directories.pop()
+                paths.append((directory, self.entries[directory]))
+                for name in self.children.get(directory, ()):
+                    child = f'{directory}/{name}' if directory else name
+                    if self.entries[child][2]:
+                        directories.append(child)
+                    else:
+                        paths.append((child, self.entries[child]))
+            return paths
+
+    # Get the paths of a tree modified after a time (in ns) and the paths removed since, from the oldest to the newest
+    # change and up to a limit (one more is returned when there are more)
+    def modified_since(self, relative, since, limit):
+        prefix = relative + '/' if relative else ''
+        with self.lock:
+            modified = []
+            for _, path in itertools.islice(self.by_mtime, bisect.bisect_left(self.by_mtime, (since + 1,)), None):
+                if path.startswith(prefix) and path != relative:
+                    modified.append((path, self.entries[path]))
+                    if len(modified) > limit:
+                        break
+
+            removed = []
+            for path, time_removed in self.removed.items():
+                if time_removed > since and path.startswith(prefix):
+                    removed.append((path, time_removed))
+                    if len(removed) > limit:
+                        break
+            return modified, removed
+
+    # Stop updating the index
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+
+    # Get the index counters
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'watches': len(self.watches),
+                'mode': 'inotify' if self.inotify is not None else 'poll'
+            }
+
+    def __run(self):
+        try:
+            self.__scan('')
+            with self.lock:
+                self.by_mtime = sorted((entry[1], path) for path, entry in self.entries.items())
+            self.ready.set()
+
+            if self.inotify is not None:
+                self.__watch_forever()
+            while not self.closed.wait(self.poll_interval):
+                self.__scan('')
+        finally:
+            self.__stop_inotify()
+
+    # Synchronize the index with a path that changed, starting from its first ancestor not indexed yet
+    def __refresh(self, relative):
+        with self.lock:
+            while relative and relative.rpartition('/')[0] not in self.entries:
+                relative = relative.rpartition('/')[0]
+        self.__scan(relative)
+
+        # Adding or removing a child changes the modification time of its directory
+        if relative:
+            parent = relative.rpartition('/')[0]
+            try:
+                mtime = os.stat(os.path.join(self.root, parent)).st_mtime_ns
+            except OSError:
+                return
+            with self.lock:
+                if parent in self.entries:
+                    self.__set(parent, 0, mtime, True)
+
+    # Synchronize the index with a file or a directory tree on the disk
+    def __scan(self, relative):
+        path = os.path.join(self.root, relative)
+        name = relative.rpartition('/')[2]
+        try:
+            stat = os.lstat(path)
+            # The symbolic links to files are followed, the ones to directories are not
+            if S_ISLNK(stat.st_mode):
+                stat = os.stat(path)
+                if S_ISDIR(stat.st_mode):
+                    stat = None
+        except OSError:
+            stat = None
+
+        # Skip the uploads in progress
+        if stat is None or not (S_ISDIR(stat.st_mode) or S_ISREG(stat.st_mode)) or \
+                (name.startswith('.') and name.endswith('.part')):
+            if relative:
+                with self.lock:
+                    self.__remove(relative)
+            return
+
+        is_dir = S_ISDIR(stat.st_mode)
+        with self.lock:
+            self.__set(relative, 0 if is_dir else stat.st_size, stat.st_mtime_ns, is_dir)
+        if not is_dir:
+            return
+
+        # Read the directories of the tree one at a time, watching them first so no change is missed
+        directories = [relative]
+        while directories and not self.closed.is_set():
+            directory = directories.pop()
+            self.__add_watch(directory)
+            try:
+                with os.scandir(os.path.join(self.root, directory)) as iterator:
+                    children = list(iterator)
+            except OSError:
+                continue
+
+            found = []
+            for child in children:
+                if child.name.startswith('.') and child.name.endswith('.part'):
+                    continue
+                try:
+                    if child.is_dir(follow_symlinks=False):
+                        found.append((child.name, 0, child.stat(follow_symlinks=False).st_mtime_ns, True))
+                    elif child.is_file():
+                        stat = child.stat()
+                        found.append((child.name, stat.st_size, stat.st_mtime_ns, False))
+                except OSError:
+                    continue
+
+            with self.lock:
+                # The directory was removed meanwhile
+                if directory not in self.entries:
+                    continue
+                names = {child[0] for child in found}
+                for name in self.children[directory] - names:
+                    self.__remove(f'{directory}/{name}' if directory else name)
+                for name, size, mtime, child_is_dir in found:
+                    child = f'{directory}/{name}' if directory else name
+                    self.__set(child, size, mtime, child_is_dir)
+                    if child_is_dir:
+                        directories.append(child)
+
+    # Add or update the entry of a path, its parent must be indexed (the lock must be held)
+    def __set(self, relative, size, mtime, is_dir):
+        entry = self.entries.get(relative)
+        if entry is not None and entry[2] != is_dir:
+            self.__remove(relative)
+            entry = None
+
+        if entry is not None:
+            if entry[0] == size and entry[1] == mtime:
+                return
+            self.__add_totals(relative, size - entry[0], 0, 0)
+            if self.by_mtime is not None:
+                self.by_mtime.pop(bisect.bisect_left(self.by_mtime, (entry[1], relative)))
+        else:
+            if relative:
+                parent, _, name = relative.rpartition('/')
+                self.children[parent].add(name)
+            if is_dir:
+                self.children[relative] = set()
+                self.totals[relative] = [0, 0, 0]
+            self.__add_totals(relative, size, 0 if is_dir else 1, 1 if is_dir else 0)
+            self.removed.pop(relative, None)
+
+        self.entries[relative] = (size, mtime, is_dir)
+        if self.by_mtime is not None:
+            bisect.insort(self.by_mtime, (mtime, relative))
+
+    # Remove a path and its tree from the index (the lock must be held)
+    def __remove(self, relative):
+        entry = self.entries.get(relative)
+        if entry is None or not relative:
+            return
+
+        if entry[2]:
+            for name in list(self.children[relative]):
+                self.__remove(f'{relative}/{name}')
+            del self.children[relative]
+            del self.totals[relative]
+
+        del self.entries[relative]
+        parent, _, name = relative.rpartition('/')
+        self.children[parent].discard(name)
+        self.__add_totals(relative, -entry[0], 0 if entry[2] else -1, -1 if entry[2] else 0)
+        if self.by_mtime is not None:
+            self.by_mtime.pop(bisect.bisect_left(self.by_mtime, (entry[1], relative)))
+
+        self.removed[relative] = time.time_ns()
+        if len(self.removed) > self.MAX_REMOVED:
+            self.removed.popitem(last=False)
+
+    # Add to the totals of the directories above a path (the lock must be held)
+    def __add_totals(self, relative, size, files, directories):
+        while relative:
+            relative = relative.rpartition('/')[0]
+            totals = self.totals[relative]
+            totals[0] += size
+            totals[1] += files
+            totals[2] += directories
+
+    def __start_inotify(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+
+        if fd >= 0:
+            self.libc = libc
+            self.inotify = fd
+
+    # Stop watching the directories, the index is then refreshed by polling
+    def __stop_inotify(self):
+        with self.lock:
+            if self.inotify is not None:
+                os.close(self.inotify)
+                self.inotify = None
+                self.watches.clear()
+
+    def __add_watch(self, relative):
+        if self.inotify is None:
+            return
+
+        # Watching a directory again (e.g. after it was renamed) returns the same descriptor
+        wd = self.libc.inotify_add_watch(self.inotify, os.fsencode(os.path.join(self.root, relative)),
+                                         self.WATCH_MASK)
+        if wd >= 0:
+            with self.lock:
+                self.watches[wd] = relative
+        # Poll instead when the watches run out (fs.inotify.max_user_watches)
+        elif ctypes.get_errno() == errno.ENOSPC:
+            self.__stop_inotify()
+
+    # Apply the inotify events until the index is closed (or the watches ran out)
+    def __watch_forever(self):
+        ready = selectors.DefaultSelector()
+        ready.register(self.inotify, selectors.EVENT_READ)
+
+        try:
+            while not self.closed.is_set() and self.inotify is not None:
+                if not ready.select(1):
+                    continue
+                try:
+                    data = os.read(self.inotify, 64 * 1024)
+                except BlockingIOError:
+                    continue
+
+                # Every path changed is scanned once per batch of events
+                changed = set()
+                overflow = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                    name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0'))
+                    offset += self.EVENT.size + length
+
+                    if mask & self.IN_Q_OVERFLOW:
+                        overflow = True
+                    elif mask & self.IN_IGNORED:
+                        with self.lock:
+                            self.watches.pop(wd, None)
+                    elif name and wd in self.watches:
+                        directory = self.watches[wd]
+                        changed.add(f'{directory}/{name}' if directory else name)
+
+                # Events were lost, scan everything again
+                if overflow:
+                    self.__scan('')
+                    continue
+                for relative in sorted(changed):
+                    self.__refresh(relative)
+        finally:
+            ready.close()
+
+
+# Pool of threads running the blocking file system operations outside of the selector loop
+class IoPool:
+    def __init__(self, threads, max_queued):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='httpfs-io')
+        # Number of threads and maximum number of operations submitted and not completed
+        self.threads = threads
+        self.max_queued = max_queued
+        # Number of operations submitted and not completed (only used by the selector loop)
+        self.queued = 0
+        # Results of the completed operations, waiting to be picked up by the selector loop
+        self.completions = collections.deque()
+        # Self-pipe waking up the selector loop when an operation completes
+        self.receiver, self.sender = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.sender.setblocking(False)
+        # Counters exposed through stats()
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # Determine if more operations can be submitted
+    def is_full(self):
+        return self.queued >= self.max_queued
+
+    # Run a function in the pool, its result is returned by drain() with the given context
+    def submit(self, function, context):
+        submitted = time.monotonic()
+        self.queued += 1
+
+        def run():
+            wait = time.monotonic() - submitted
+            try:
+                result = function()
+            except Exception as e:
+                result = e
+            self.completions.append((context, result, wait))
+
+            # Wake up the selector loop (a full pipe already guarantees it wakes up)
+            try:
+                self.sender.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+        self.executor.submit(run)
+
+    # Get the (context, result) pairs of the completed operations
+    def drain(self):
+        try:
+            while self.receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        results = []
+        while self.completions:
+            context, result, wait = self.completions.popleft()
+            self.queued -= 1
+            self.completed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            metrics.observe_queue_wait(wait)
+            results.append((context, result))
+
+        return results
+
+    # Get the pool counters (the waits are the time spent queued before a thread picked up the operation)
+    def stats(self):
+        return {
+            'threads': self.threads,
+            'queued': self.queued,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'average_queue_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_queue_wait': self.max_wait
+        }
+
+    # Wait for the running operations and release the threads
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.receiver.close()
+        self.sender.close()
+
+
+# Counters and latency histograms of the process, with the traffic of its connections and the waits of its I/O pool
+class ConnectionMetrics(Metrics):
+    # Stages of a request: parsing it, building its response and sending the response, and the wait of the file
+    # system operations for a thread of the I/O pool
+    STAGES = ('parse', 'handle', 'send', 'queue')
+    STAGES_HELP = 'Time spent parsing requests, building and sending responses, and waiting for an I/O thread.'
+    PARSE = 0
+    HANDLE = 1
+    SEND = 2
+    QUEUE = 3
+    # Labels of the request counters, the unknown verbs are counted together
+    VERBS = tuple(verb.value for verb in HttpVerb) + ('OTHER',)
+    STATUSES = tuple(status.value[0] for status in HttpStatus)
+
+    def __init__(self):
+        super().__init__()
+        # Updated by the threads of the I/O pool
+        self.max_queue_wait = 0.0
+
+        # Only updated by the event loop
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.connections_accepted = 0
+        self.io_rejected = 0
+
+    # Record the time a file system operation waited for a thread of the I/O pool
+    def observe_queue_wait(self, seconds):
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.buckets[self.QUEUE][bucket] += 1
+            self.durations[self.QUEUE] += seconds
+            self.max_queue_wait = max(self.max_queue_wait, seconds)
+
+    def values(self):
+        return [
+            ('httpfs_received_bytes_total', 'counter', 'Bytes received from the clients.', self.bytes_received),
+            ('httpfs_sent_bytes_total', 'counter', 'Bytes sent to the clients.', self.bytes_sent),
+            ('httpfs_open_connections', 'gauge', 'Client connections currently open.', self.connections),
+            ('httpfs_connections_total', 'counter', 'Client connections accepted.', self.connections_accepted),
+            ('httpfs_io_queue_wait_max_seconds', 'gauge', 'Longest wait of a file system operation for an I/O thread.',
+             self.max_queue_wait),
+            ('httpfs_io_rejected_total', 'counter', 'Requests rejected because the I/O queue was full.',
+             self.io_rejected)
+        ]
+
+
+# Connection of the asyncio engine, the requests are handled like in the selector loop
+class HttpProtocol(asyncio.Protocol):
+    # Size of the transport write buffer above which the responses are paused, and below which they resume
+    HIGH_WATER_MARK = 256 * 1024
+    LOW_WATER_MARK = 64 * 1024
+    # Number of responses waiting to be sent above which the connection stops reading requests
+    MAX_PENDING_RESPONSES = 16
+
+    def __init__(self, engine):
+        # Settings and functions shared by the connections of the server
+        self.engine = engine
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.addr = None
+        self.parser = HttpRequestParser(engine.create_body)
+        # Responses in the order of the requests, as (output, future of the keep-alive flag) tuples
+        self.responses = asyncio.Queue()
+        self.requests_left = engine.settings.max_requests
+        # Cleared while the transport write buffer is above its high water mark
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        # Task sending the responses, and whether it is sending one right now
+        self.writer = None
+        self.sending = False
+        # Whether the connection stopped reading (after its last request, or while too many responses wait)
+        self.closing = False
+        self.reading_paused = False
+        self.idle_timer = None
+        # Time spent parsing the request being received
+        self.parse_time = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(high=self.HIGH_WATER_MARK, low=self.LOW_WATER_MARK)
+        # asyncio only disables Nagle on sockets created with IPPROTO_TCP, not the ones accepted from our listener
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.engine.protocols.add(self)
+        metrics.connections += 1
+        metrics.connections_accepted += 1
+        self.writer = self.loop.create_task(self.__write_responses())
+        self.__reset_idle_timer()
+
+        if self.engine.verbose:
+            access_log.debug(f'[CONNECTION] Accepted connection from {self.addr}')
+
+    def data_received(self, data):
+        if self.closing:
+            return
+        self.__reset_idle_timer()
+        metrics.bytes_received += len(data)
+        start = time.perf_counter()
+        self.parser.feed(data)
+
+        try:
+            while not self.closing:
+                request = self.parser.next_request()
+                now = time.perf_counter()
+                self.parse_time += now - start
+                start = now
+                if request is None:
+                    break
+                metrics.observe(ConnectionMetrics.PARSE, self.parse_time)
+                self.parse_time = 0.0
+                request['peer'] = self.addr
+                request['received'] = now
+                if self.engine.verbose:
+                    access_log.debug('[CONNECTION] Request received')
+
+                # Keep the connection open if the client wants to and the request limit isn't reached
+                self.requests_left -= 1
+                keep_alive = self.engine.is_keep_alive(request) and self.requests_left > 0 and not self.engine.stopping
+
+                self.responses.put_nowait(self.engine.submit(request, keep_alive))
+                if not keep_alive:
+                    self.__stop_reading()
+
+        except ValueError as e:
+            # The request can't be parsed so reply with an error and stop reading
+            self.__queue_bytes(self.engine.build_error_response(
+                HttpStatus.BAD_REQUEST, 'The request could not be parsed.', str(e)), False)
+            self.__stop_reading()
+            return
+
+        # Let the client know it can send the body of the request being received
+        if self.parser.expect_continue:
+            self.parser.expect_continue = False
+            self.__queue_bytes(b'HTTP/1.1 100 Continue\r\n\r\n', True)
+
+        # Stop reading pipelined requests until the client reads the responses
+        if self.responses.qsize() >= self.MAX_PENDING_RESPONSES and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def connection_lost(self, exc):
+        self.engine.protocols.discard(self)
+        metrics.connections -= 1
+        self.parser.close()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if not self.writer.done():
+            self.writer.cancel()
+
+        if self.engine.verbose:
+            access_log.debug(f'[CONNECTION] Closed connection to {self.addr}')
+
+    # Write backpressure: wait for the transport buffer to drain below the low water mark
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    # Close the connection after the in-flight requests when the server stops
+    def shutdown(self):
+        if self.__is_idle():
+            self.transport.close()
+
+    # Determine if the connection has no request being received, handled or sent
+    def __is_idle(self):
+        return not self.sending and self.responses.empty() and not self.parser.has_partial_request()
+
+    # Stop reading requests, the connection closes after the queued responses
+    def __stop_reading(self):
+        self.closing = True
+        self.parser.close()
+
+    # Queue bytes after the responses of the previous requests
+    def __queue_bytes(self, content, keep_alive):
+        output = ResponseQueue(0)
+        output.append_bytes(content)
+        result = self.loop.create_future()
+        result.set_result(keep_alive)
+        self.responses.put_nowait((output, result))
+
+    # Close the connections without activity for too long
+    def __reset_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = self.loop.call_later(self.engine.settings.keep_alive_timeout, self.__on_idle)
+
+    def __on_idle(self):
+        if self.__is_idle():
+            if self.engine.verbose:
+                access_log.debug(f'[CONNECTION] Idle timeout reached for {self.addr}')
+            self.transport.close()
+        else:
+            self.__reset_idle_timer()
+
+    # Send the responses in the order of the requests
+    async def __write_responses(self):
+        output = None
+        result = None
+
+        try:
+            while True:
+                output, result = await self.responses.get()
+                self.sending = True
+
+                # An unexpected error occurred while handling the request
+                try:
+                    keep_alive = await result
+                except Exception as e:
+                    output.close()
+                    output.append_bytes(self.engine.build_error_response(
+                        HttpStatus.INTERNAL_SERVER_ERROR, 'An unknown error occurred while handling the request.',
+                        str(e)))
+                    keep_alive = False
+
+                start = time.perf_counter()
+                await self.__send(output)
+                metrics.observe(ConnectionMetrics.SEND, time.perf_counter() - start)
+                self.sending = False
+                output = None
+                self.__reset_idle_timer()
+                if self.engine.verbose:
+                    access_log.debug('[RESPONSE] Response sent to client')
+
+                # Read the pipelined requests again once the client caught up
+                if self.reading_paused and self.responses.qsize() < self.MAX_PENDING_RESPONSES // 2:
+                    self.reading_paused = False
+                    self.transport.resume_reading()
+
+                # Close the connection after its last response (or when the server stops and nothing is in-flight)
+                if not keep_alive or (self.engine.stopping and self.__is_idle()):
+                    break
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+        finally:
+            # Release the files of the responses that will never be sent
+            if output is not None:
+                self.__discard(output, result)
+            while not self.responses.empty():
+                self.__discard(*self.responses.get_nowait())
+            self.transport.close()
+
+    # Send the segments of a response, waiting for the transport when its buffer is full
+    async def __send(self, output):
+        while output.segments:
+            segment = output.segments.popleft()
+
+            # Bytes
+            if len(segment) == 2:
+                self.transport.write(segment[0])
+                metrics.bytes_sent += len(segment[0])
+
+            # Range of a file, sent with os.sendfile when the event loop supports it
+            elif len(segment) == 4:
+                file, offset, count, close = segment
+                try:
+                    await self.can_write.wait()
+                    sent = await self.loop.sendfile(self.transport, file, offset, count)
+                    metrics.bytes_sent += sent
+                    if sent < count:
+                        raise ConnectionAbortedError(f'Unexpected end of file {file.name}')
+                finally:
+                    if close:
+                        file.close()
+
+            # Generated chunks, the file ranges among them are sent like the other ranges before the rest of the stream
+            else:
+                stream = segment[0]
+                try:
+                    while True:
+                        # The chunks are generated in the I/O threads, or in the loop one at a time between the other
+                        # connections (waiting on the event doesn't yield while it is set)
+                        if self.engine.executor is not None:
+                            chunk = await self.loop.run_in_executor(self.engine.executor, next, stream, None)
+                        else:
+                            chunk = next(stream, None)
+                            await asyncio.sleep(0)
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, tuple):
+                            output.segments.appendleft(segment)
+                            output.segments.appendleft([*chunk, True])
+                            break
+                        self.transport.write(chunk)
+                        metrics.bytes_sent += len(chunk)
+                        await self.can_write.wait()
+                except BaseException:
+                    # A stream still running in a thread is closed once it is collected
+                    try:
+                        stream.close()
+                    except ValueError:
+                        pass
+                    raise
+
+            await self.can_write.wait()
+            if self.transport.is_closing():
+                raise ConnectionResetError('The connection was closed while sending the response')
+
+    # Close the files of a response once it is built
+    @staticmethod
+    def __discard(output, result):
+        if result.done():
+            output.close()
+        else:
+            result.add_done_callback(lambda future: output.close())
 
 
 # Default server host
 __SERVER_HOST = 'localhost'
 # Socket buffer size
-__BUFFER_SIZE = 1
+__BUFFER_SIZE = 65536
 # Number of non-accepted connections queued
 __CONNECTION_QUEUE = 5
+# Largest file kept in the file cache (in bytes)
+__CACHE_ENTRY_SIZE = 1024 * 1024
+# Number of directory listings kept in the listing cache
+__LISTING_CACHE_SIZE = 64
+# Number of directory entries encoded at once in a streamed listing
+__LISTING_BATCH_SIZE = 1000
+# Formats of the directory archives and their MIME types
+__ARCHIVE_FORMATS = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+# Content hash entity tags of the cached files, checked by hashing the files no longer cached
+__CONTENT_ETAG = re.compile(r'"[0-9a-f]{32}"')
+# Maximum number of ranges served for a single request (the Range header is ignored above it)
+__MAX_RANGES = 16
+# Seconds an idle persistent connection is kept open
+__KEEP_ALIVE_TIMEOUT = 15
+# Number of requests served on a persistent connection before it is closed
+__MAX_KEEP_ALIVE_REQUESTS = 100
+# Seconds between two checks for idle connections
+__IDLE_CHECK_INTERVAL = 1
+# Number of threads running the file system operations (0 to run them in the selector loop)
+__IO_THREADS = 4
+# Maximum number of file system operations waiting for a thread
+__IO_QUEUE_DEPTH = 256
+# Seconds given to the open connections to complete when the server stops
+__DRAIN_TIMEOUT = 30
+# Seconds between two checks of the connections left while the asyncio engine drains them
+__DRAIN_POLL_INTERVAL = 0.1
+# Reserved path of the metrics of the process, served without touching the file system
+__METRICS_PATH = '/_metrics'
+# Reserved path of the queries of the tree index, and number of paths they return by default
+__INDEX_PATH = '/_index'
+__INDEX_QUERY_LIMIT = 1000
+# Verbs writing the files: POST replaces them, PUT replaces them or writes a range of a resumable upload, PATCH
+# writes a range of them in place or appends to them
+__WRITE_VERBS = (HttpVerb.POST.value, HttpVerb.PUT.value, HttpVerb.PATCH.value)
+# Minimum number of seconds between two starts of a crashing worker
+__WORKER_RESTART_DELAY = 1
 # Mime types to return inline
 __INLINE_MIME_TYPES = [
     'text/css',
@@ -57,323 +1770,2453 @@ __INLINE_MIME_TYPES = [
     'application/xml',
     'text/xml'
 ]
+# Bytes of compressed bodies cached in memory, and seconds of CPU per second the compression may use
+__COMPRESSION_CACHE_SIZE = 16 * 1024 * 1024
+__COMPRESSION_CPU_SHARE = 0.25
+# Smallest and largest bodies compressed on the fly (in bytes)
+__COMPRESSION_MIN_SIZE = 512
+__COMPRESSION_MAX_SIZE = 1024 * 1024
+# Compressors of the content encodings available, by order of preference
+__ENCODERS = {}
+if brotli is not None:
+    __ENCODERS['br'] = functools.partial(brotli.compress, quality=5)
+if zstandard is not None:
+    __ENCODERS['zstd'] = functools.partial(zstandard.compress, level=3)
+__ENCODERS['gzip'] = functools.partial(gzip.compress, compresslevel=6, mtime=0)
+# Extensions of the precompressed files sent instead of the file they are next to, by order of preference
+__PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'zstd': '.zst', 'gzip': '.gz'}
 
 
 # Allow multi-connections
 selector = selectors.DefaultSelector()
+# Cache of the small files served (None when disabled)
+file_cache = None
+# Cache of the directory listings (None when disabled)
+listing_cache = None
+# Compressed versions of the text files (None when the compression on the fly is disabled)
+compression_cache = None
+# Index of the files of the shared directory (None when disabled, every worker has its own)
+tree_index = None
+# Content-addressed store the uploaded files are linked to (None when disabled)
+blob_store = None
+# Threads running the file system operations in the background (None when there are none)
+io_executor = None
+# Connections removed from the selector while they have nothing to read nor send (waiting for the I/O pool), by socket
+unwatched = {}
+# Threads running the file system operations (None when they run in the selector loop)
+io_pool = None
+# Counters and histograms of the process (every worker has its own)
+metrics = ConnectionMetrics()
+# Log of the requests written in the background (None when disabled)
+access_log = None
 
 
 # Initialize the server on the sockets
-def start_server(host, port, path, verbose = False):
+def start_server(host, port, path, verbose = False, keep_alive_timeout = __KEEP_ALIVE_TIMEOUT,
+                 max_requests = __MAX_KEEP_ALIVE_REQUESTS, cache_size = 0, cache_entry_size = __CACHE_ENTRY_SIZE,
+                 listing_cache_size = __LISTING_CACHE_SIZE, workers = 1, io_threads = __IO_THREADS,
+                 io_queue_depth = __IO_QUEUE_DEPTH, engine = 'selectors', access_log_path = None, log_level = 'info',
+                 log_sample_rate = 1.0, compression_cache_size = __COMPRESSION_CACHE_SIZE,
+                 compression_cpu_share = __COMPRESSION_CPU_SHARE, index = 'auto',
+                 index_poll_interval = TreeIndex.POLL_INTERVAL, blob_store_path = None):
+    global file_cache, listing_cache, compression_cache, blob_store
+
+    # Keep the contents of the most requested small files in memory
+    if cache_size > 0:
+        file_cache = FileCache(cache_size, cache_entry_size)
+    # Keep the contents of the most listed directories in memory
+    if listing_cache_size > 0:
+        listing_cache = ListingCache(listing_cache_size)
+    # Compress the text files and the listings for the clients accepting it (precompressed files are always served)
+    if compression_cache_size > 0 and compression_cpu_share > 0:
+        compression_cache = CompressionCache(compression_cache_size, __COMPRESSION_MAX_SIZE, compression_cpu_share)
+    # Store the uploaded files once per contents, without the blobs of the files removed while the server was stopped
+    if blob_store_path is not None:
+        blob_store = BlobStore(blob_store_path)
+        blob_store.collect()
+
+    # Options of the selector loop of every process
+    settings = types.SimpleNamespace(
+        keep_alive_timeout=keep_alive_timeout,
+        max_requests=max_requests,
+        io_threads=io_threads,
+        io_queue_depth=io_queue_depth,
+        engine=engine,
+        # The verbose messages go through the log, to the standard output unless a file is given
+        access_log_path=access_log_path or ('-' if verbose else None),
+        log_level=AccessLog.DEBUG if verbose else AccessLog.LEVELS[log_level],
+        log_sample_rate=log_sample_rate,
+        # Keep the index up to date with inotify when available ('auto'), by polling ('poll') or not at all ('off')
+        index=index,
+        index_poll_interval=index_poll_interval
+    )
+
+    # Spread the connections over several processes, each with its own selector loop
+    if workers > 1 and hasattr(os, 'fork'):
+        __supervise_workers(host, port, path, workers, settings, verbose)
+        return
+
     # Open the socket
+    listener = __open_listener(host, port, False)
+
+    if verbose:
+        # noinspection HttpUrlsUsage
+        print(f'[INIT] HTTP File System server is listening at http://{host}:{port}')
+
+    __serve(listener, path, settings, verbose)
+
+
+# Open a non-blocking listening socket
+def __open_listener(host, port, reuse_port):
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     try:
+        # Let several processes listen on the same port, the kernel balances the connections between them
+        if reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         # Start the server
         listener.bind((host, port))
         listener.listen(__CONNECTION_QUEUE)
+        listener.setblocking(False)
+    except OSError:
+        listener.close()
+        raise
 
-        if verbose:
-            # noinspection HttpUrlsUsage
-            print(f'[INIT] HTTP File System server is listening at http://{host}:{port}')
+    return listener
+
+
+# Run the selector loop of the process until it is asked to stop
+def __serve(listener, path, settings, verbose):
+    global io_pool, io_executor, access_log, tree_index
+
+    # Write the log from a background thread (threads don't survive a fork so every process has its own)
+    if settings.access_log_path is not None:
+        stream = sys.stdout if settings.access_log_path == '-' else open(settings.access_log_path, 'a')
+        access_log = AccessLog(stream, settings.log_level, settings.log_sample_rate)
+    # Index the shared directory in the background
+    if settings.index != 'off':
+        tree_index = TreeIndex(path, settings.index == 'auto', settings.index_poll_interval)
+
+    # Let asyncio drive the connections instead
+    if settings.engine == 'asyncio':
+        __serve_asyncio(listener, path, settings, verbose)
+        return
+
+    # Drain the open connections before exiting when asked to stop
+    shutdown = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown.set())
+    drain_deadline = None
+
+    # Run the file system operations in a pool of threads (threads don't survive a fork so every process has its own)
+    if settings.io_threads > 0:
+        mimetypes.init()
+        io_pool = IoPool(settings.io_threads, settings.io_queue_depth)
+        io_executor = io_pool.executor
 
+    try:
         # Setup multi-connection
-        listener.setblocking(False)
         selector.register(listener, selectors.EVENT_READ, data=None)
+        if io_pool is not None:
+            selector.register(io_pool.receiver, selectors.EVENT_READ, data=io_pool)
 
         # Listen to connections
+        last_idle_check = time.monotonic()
         while True:
-            events = selector.select(timeout=None)
+            events = selector.select(timeout=__IDLE_CHECK_INTERVAL)
             for key, mask in events:
                 if key.data is None:
                     # noinspection PyTypeChecker
-                    __accept_connection(key.fileobj, verbose)
+                    __accept_connection(key.fileobj, path, settings.max_requests, verbose)
+                elif key.data is io_pool:
+                    __complete_requests(verbose)
                 else:
                     __service_connection(key, mask, path, verbose)
 
+            # Close the persistent connections that have been idle for too long
+            now = time.monotonic()
+            if now - last_idle_check >= __IDLE_CHECK_INTERVAL:
+                last_idle_check = now
+                __close_idle_connections(now - settings.keep_alive_timeout, verbose)
+
+            # Stop accepting connections and let the in-flight requests complete
+            if shutdown.is_set() and drain_deadline is None:
+                drain_deadline = now + __DRAIN_TIMEOUT
+                __stop_accepting(listener, verbose)
+
+            # Exit once every connection is closed (or when they take too long to complete)
+            if drain_deadline is not None:
+                connections = __get_connections()
+                if not connections or now >= drain_deadline:
+                    if verbose:
+                        __log(f'[SHUTDOWN] Server stopped with {len(connections)} connections left')
+                    break
+
     finally:
         # Always close the socket
         listener.close()
         selector.close()
+        if io_pool is not None:
+            io_pool.close()
+        __close_log()
+        __close_index()
+
+
+# Run the asyncio event loop of the process until it is asked to stop
+def __serve_asyncio(listener, path, settings, verbose):
+    global io_executor
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Run the file system operations in a pool of threads
+    executor = None
+    if settings.io_threads > 0:
+        mimetypes.init()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.io_threads, thread_name_prefix='httpfs-io')
+        io_executor = executor
+
+    # State shared by the connections (the protocol can't call the private functions of the module)
+    engine = types.SimpleNamespace(
+        settings=settings,
+        verbose=verbose,
+        protocols=set(),
+        stopping=False,
+        queued=0,
+        executor=executor,
+        create_body=functools.partial(__create_request_body, path),
+        is_keep_alive=__is_keep_alive,
+        build_error_response=__build_error_response
+    )
+    engine.submit = functools.partial(__submit_request, engine, path)
+
+    try:
+        asyncio.run(__run_asyncio_server(listener, engine))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        __close_log()
+        __close_index()
+
+
+# Accept the connections until the process is asked to stop, then drain them
+async def __run_asyncio_server(listener, engine):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: HttpProtocol(engine), sock=listener)
+
+    # Drain the open connections before exiting when asked to stop
+    shutdown = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, shutdown.set)
+    except NotImplementedError:
+        signal.signal(signal.SIGTERM, lambda signum, frame: loop.call_soon_threadsafe(shutdown.set))
+
+    await shutdown.wait()
+    if engine.verbose:
+        __log('[SHUTDOWN] Draining the open connections')
+
+    # Stop accepting connections and close the connections that have nothing in-flight
+    server.close()
+    engine.stopping = True
+    for protocol in list(engine.protocols):
+        protocol.shutdown()
+
+    # Exit once every connection is closed (or when they take too long to complete)
+    deadline = loop.time() + __DRAIN_TIMEOUT
+    while engine.protocols and loop.time() < deadline:
+        await asyncio.sleep(__DRAIN_POLL_INTERVAL)
+
+    if engine.verbose:
+        __log(f'[SHUTDOWN] Server stopped with {len(engine.protocols)} connections left')
+
+
+# Build the response of a request for the asyncio engine, in the thread pool if there is one
+# Return the queue holding the response and a future of the keep-alive flag
+def __submit_request(engine, path, request, keep_alive):
+    loop = asyncio.get_running_loop()
+    output = ResponseQueue(__BUFFER_SIZE)
+
+    if engine.executor is None:
+        result = loop.create_future()
+        result.set_result(__build_response(request, path, keep_alive, output, engine.verbose))
+        return output, result
+
+    # Ask the client to come back later instead of queueing without limit
+    if engine.queued >= engine.settings.io_queue_depth:
+        metrics.io_rejected += 1
+        request['body'].discard()
+        __log_access(request, HttpStatus.SERVICE_UNAVAILABLE.value, None)
+        output.append_bytes(__build_error_response(
+            HttpStatus.SERVICE_UNAVAILABLE, 'The server is too busy to handle the request.', 'Retry later.'))
+        result = loop.create_future()
+        result.set_result(False)
+        return output, result
+
+    engine.queued += 1
+    submitted = time.monotonic()
+
+    def build():
+        metrics.observe_queue_wait(time.monotonic() - submitted)
+        return __build_response(request, path, keep_alive, output, engine.verbose)
+
+    result = loop.run_in_executor(engine.executor, build)
+
+    def release(future):
+        engine.queued -= 1
+
+    result.add_done_callback(release)
+    return output, result
+
+
+# Stop accepting connections and close the connections that have nothing in-flight
+def __stop_accepting(listener, verbose):
+    if verbose:
+        __log('[SHUTDOWN] Draining the open connections')
+
+    selector.unregister(listener)
+
+    for key in __get_connections():
+        data = key.data
+
+        # The connections are closed after their current request
+        data.keep_alive = False
+        data.requests_left = min(data.requests_left, 1)
+
+        if __is_idle(data) and (data.parser is None or not data.parser.has_partial_request()):
+            __close_connection(key.fileobj, data, verbose)
+
+
+# Get the selector keys of the client connections (copied since closing them changes the selector map)
+def __get_connections():
+    return [key for key in selector.get_map().values() if key.data is not None and key.data is not io_pool] + \
+        list(unwatched.values())
+
+
+# Determine if a connection has no response being built or sent
+def __is_idle(data):
+    return not data.output and not data.pending
+
+
+# Run a number of worker processes and restart them when they exit, until the server is asked to stop
+def __supervise_workers(host, port, path, workers, settings, verbose):
+    # Every worker listens on its own socket if the platform supports it, otherwise they share a single one
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    if reuse_port:
+        # Reserve the port without listening, so the supervisor never receives connections
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((host, port))
+    else:
+        listener = __open_listener(host, port, False)
+
+    if verbose:
+        # noinspection HttpUrlsUsage
+        print(f'[INIT] HTTP File System server is listening at http://{host}:{port} with {workers} workers '
+              f'({"SO_REUSEPORT" if reuse_port else "shared listener"})')
+
+    # Forward the shutdown to the workers, they exit once their connections are drained
+    children = {}
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+        for child in children:
+            os.kill(child, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while True:
+            # Start the missing workers
+            while not stopping.is_set() and len(children) < workers:
+                pid = __spawn_worker(listener, host, port, reuse_port, path, settings, verbose)
+                children[pid] = time.monotonic()
+                if verbose:
+                    print(f'[WORKER] Started worker {pid}')
+
+            if not children:
+                break
+
+            # Wait for a worker to exit
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = children.pop(pid, None)
+
+            if not stopping.is_set():
+                if verbose:
+                    print(f'[WORKER] Worker {pid} exited with status {status}, restarting it')
+                # Don't restart a worker that keeps crashing in a tight loop
+                if started is not None and time.monotonic() - started < __WORKER_RESTART_DELAY:
+                    time.sleep(__WORKER_RESTART_DELAY)
+
+    finally:
+        listener.close()
+
+
+# Fork a worker process serving the connections, return its process id
+def __spawn_worker(listener, host, port, reuse_port, path, settings, verbose):
+    global selector
+
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # The worker never returns to the caller
+    status = 0
+    try:
+        # The supervisor handles the interruptions and forwards them as SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Every process needs its own selector
+        selector = selectors.DefaultSelector()
+
+        if reuse_port:
+            listener.close()
+            listener = __open_listener(host, port, True)
+
+        __serve(listener, path, settings, verbose)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
 
 
 # Accept a client connection through the selector
-def __accept_connection(listener, verbose):
-    (conn, address) = listener.accept()
+def __accept_connection(listener, path, max_requests, verbose):
+    # Another worker sharing the listener may have accepted the connection first
+    try:
+        (conn, address) = listener.accept()
+    except BlockingIOError:
+        return
 
     if verbose:
-        print("[CONNECTION] Accepted connection from", address)
+        __log(f'[CONNECTION] Accepted connection from {address}')
 
     # Setup Service Connection
     conn.setblocking(False)
-    data = types.SimpleNamespace(addr=address, inb=b"", outb=b"")
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    selector.register(conn, events, data=data)
+    # The headers and the body are sent separately, don't hold the last segment until the previous one is acknowledged
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data = types.SimpleNamespace(
+        addr=address,
+        parser=HttpRequestParser(functools.partial(__create_request_body, path)),
+        output=ResponseQueue(__BUFFER_SIZE),
+        pending=collections.deque(),
+        closed=False,
+        requests_left=max_requests,
+        keep_alive=True,
+        last_active=time.monotonic(),
+        parse_time=0.0,
+        send_started=None
+    )
+    # Generate the chunks of the streamed responses in the I/O pool
+    if io_pool is not None:
+        data.output.generate = functools.partial(__generate_chunk, conn, data)
+    metrics.connections += 1
+    metrics.connections_accepted += 1
+    # Only wait for writes when there is a response to send back
+    selector.register(conn, selectors.EVENT_READ, data=data)
 
 
 # Accept a service connection (Read or Write data)
 def __service_connection(key, mask, path, verbose):
     sock = key.fileobj
     data = key.data
+    data.last_active = time.monotonic()
+
+    # Read the requests from the client (unless the connection is closing)
+    if mask & selectors.EVENT_READ and data.parser is not None:
+        try:
+            # Queue the responses to the requests completed by this read
+            received = __receive_connection(sock, data, path, verbose)
+        except ValueError as e:
+            # The request can't be parsed so reply with an error and stop reading
+            data.keep_alive = False
+            __queue_bytes(data, __build_error_response(HttpStatus.BAD_REQUEST, 'The request could not be parsed.', str(e)))
+            data.parser.close()
+            data.parser = None
+            received = True
+        if not received:
+            __close_connection(sock, data, verbose)
+            return
+
+    # Send the responses to the client, starting as soon as they are queued
+    if mask & selectors.EVENT_WRITE or data.output:
+        __send_responses(sock, data, verbose)
+    # Stop reading once the connection is closing (the level-triggered selector would report the socket forever)
+    elif data.parser is None:
+        __watch_connection(sock, data)
+
+
+# Send the queued responses and wait for the socket to be writable if they don't fit in its buffer
+def __send_responses(sock, data, verbose):
+    if data.send_started is None:
+        data.send_started = time.perf_counter()
+
+    try:
+        metrics.bytes_sent += data.output.send(sock)
+    except ConnectionError:
+        __close_connection(sock, data, verbose)
+        return
+
+    if not data.output:
+        metrics.observe(ConnectionMetrics.SEND, time.perf_counter() - data.send_started)
+        data.send_started = None
+        if verbose:
+            __log('[RESPONSE] Response sent to client')
+
+        # Close the connection once the last response is sent back
+        if not data.keep_alive and not data.pending:
+            __close_connection(sock, data, verbose)
+            return
+
+    # Wait for the socket to accept more data, or for the next request
+    __watch_connection(sock, data)
 
-    # Read the request from the client
-    if mask & selectors.EVENT_READ:
-        # Get the response data from the request
-        recv_data = __receive_connection(sock, path)
-        if recv_data:
-            data.outb += recv_data
-
-    # Send the response to the client
-    if mask & selectors.EVENT_WRITE:
-        if data.outb:
-            sent = sock.send(data.outb)
-            data.outb = data.outb[sent:]
-            if verbose and not data.outb:
-                print('[RESPONSE] Response sent to client')
-
-    # Close the connection if there is no more data to read or send back
-    if mask & selectors.EVENT_READ and not data.outb:
+
+# Watch a connection for reads while it receives requests and for writes while it has bytes ready to send
+# A connection with neither (waiting for the I/O pool after its last request) is removed from the selector
+def __watch_connection(sock, data):
+    events = 0
+    if data.parser is not None:
+        events |= selectors.EVENT_READ
+    if data.output.is_ready():
+        events |= selectors.EVENT_WRITE
+
+    if sock in unwatched:
+        if events:
+            del unwatched[sock]
+            selector.register(sock, events, data=data)
+    elif not events:
         selector.unregister(sock)
-        sock.close()
+        unwatched[sock] = selectors.SelectorKey(sock, sock.fileno(), 0, data)
+    elif selector.get_key(sock).events != events:
+        selector.modify(sock, events, data=data)
+
+
+# Generate the next chunk of a streamed response in the I/O pool
+def __generate_chunk(sock, data, stream):
+    io_pool.submit(functools.partial(next, stream, None), (sock, data, None))
+
+
+# Queue the chunk of a streamed response generated by the I/O pool and send it
+def __resume_stream(sock, data, result, verbose):
+    try:
+        data.output.resume(result)
+    except ConnectionError:
+        if not data.closed:
+            __close_connection(sock, data, verbose)
+        return
+
+    if not data.closed:
+        __send_responses(sock, data, verbose)
+
+
+# Queue bytes after the responses being built for a connection
+def __queue_bytes(data, content):
+    if data.pending:
+        slot = types.SimpleNamespace(output=ResponseQueue(__BUFFER_SIZE), keep_alive=data.keep_alive, done=True,
+                                     discarded=False)
+        slot.output.append_bytes(content)
+        data.pending.append(slot)
+    else:
+        data.output.append_bytes(content)
+
+
+# Build a response in the I/O pool, it is queued on the connection once it and the previous ones are done
+# Return False if the connection must be closed after the response
+def __dispatch_request(sock, data, request, path, keep_alive, verbose):
+    slot = types.SimpleNamespace(output=ResponseQueue(__BUFFER_SIZE), keep_alive=keep_alive, done=False,
+                                 discarded=False)
+    data.pending.append(slot)
+
+    # Ask the client to come back later instead of queueing without limit
+    if io_pool.is_full():
+        io_pool.rejected += 1
+        metrics.io_rejected += 1
+        request['body'].discard()
+        __log_access(request, HttpStatus.SERVICE_UNAVAILABLE.value, None)
+        slot.output.append_bytes(__build_error_response(
+            HttpStatus.SERVICE_UNAVAILABLE, 'The server is too busy to handle the request.', 'Retry later.'))
+        slot.keep_alive = False
+        slot.done = True
+        return False
+
+    io_pool.submit(functools.partial(__build_response, request, path, keep_alive, slot.output, verbose),
+                   (sock, data, slot))
+    return keep_alive
+
+
+# Queue the responses built by the I/O pool on their connections
+def __complete_requests(verbose):
+    for (sock, data, slot), result in io_pool.drain():
+        # Chunk of a streamed response
+        if slot is None:
+            __resume_stream(sock, data, result, verbose)
+            continue
+
+        slot.done = True
+
+        # An unexpected error occurred while handling the request
+        if isinstance(result, Exception):
+            slot.output.close()
+            slot.output.append_bytes(__build_error_response(
+                HttpStatus.INTERNAL_SERVER_ERROR, 'An unknown error occurred while handling the request.', str(result)))
+            slot.keep_alive = False
+        else:
+            slot.keep_alive = result
+
+        # The client left before the response was built, or it follows the last response of the connection
+        if data.closed or slot.discarded:
+            slot.output.close()
+            continue
+
+        __flush_responses(data)
+        if verbose:
+            __log(f'[IO] Response built by the I/O pool {io_pool.stats()}')
+        if data.output:
+            __send_responses(sock, data, verbose)
+        else:
+            __watch_connection(sock, data)
+
+
+# Move the responses that are done to the output of the connection, in the order of the requests
+def __flush_responses(data):
+    while data.pending and data.pending[0].done:
+        slot = data.pending.popleft()
+        data.output.extend(slot.output)
+
+        # Ignore the responses following the last one
+        if not slot.keep_alive:
+            data.keep_alive = False
+            if data.parser is not None:
+                data.parser.close()
+                data.parser = None
+            for ignored in data.pending:
+                ignored.discarded = True
+                if ignored.done:
+                    ignored.output.close()
+            data.pending.clear()
+            break
+
+
+# Close the connections that didn't send or receive anything since a given time
+def __close_idle_connections(deadline, verbose):
+    for key in __get_connections():
+        data = key.data
+        if __is_idle(data) and data.last_active < deadline:
+            if verbose:
+                __log(f'[CONNECTION] Idle timeout reached for {data.addr}')
+            __close_connection(key.fileobj, data, verbose)
+
+
+# Stop watching a connection and close its socket
+def __close_connection(sock, data, verbose):
+    if unwatched.pop(sock, None) is None:
+        selector.unregister(sock)
+    sock.close()
+    metrics.connections -= 1
+    data.closed = True
+    data.output.close()
+    for slot in data.pending:
+        if slot.done:
+            slot.output.close()
+    if data.parser is not None:
+        data.parser.close()
+    if verbose:
+        __log(f'[CONNECTION] Closed connection to {data.addr}')
+
+
+# Handler for client connections
+def __receive_connection(sock, data, path, verbose):
+    parser = data.parser
+
+    # Receive the byte array
+    if not __receive_data(sock, parser):
+        return False
+    start = time.perf_counter()
+
+    # Queue a proper HTTP response for every request completed by the received bytes, in order
+    while True:
+        request = parser.next_request()
+        now = time.perf_counter()
+        data.parse_time += now - start
+        if request is None:
+            break
+        metrics.observe(ConnectionMetrics.PARSE, data.parse_time)
+        data.parse_time = 0.0
+        request['peer'] = data.addr
+        request['received'] = now
+        if verbose:
+            __log('[CONNECTION] Request received')
+
+        # Keep the connection open if the client wants to and the request limit isn't reached
+        data.requests_left -= 1
+        keep_alive = __is_keep_alive(request) and data.requests_left > 0
+
+        # Build the response in the I/O pool, or right away if there is none
+        if io_pool is not None:
+            keep_alive = __dispatch_request(sock, data, request, path, keep_alive, verbose)
+        else:
+            keep_alive = __build_response(request, path, keep_alive, data.output, verbose)
+
+        # Ignore the pipelined requests following the last one
+        if not keep_alive:
+            data.keep_alive = False
+            data.parser.close()
+            data.parser = None
+            break
+        start = time.perf_counter()
+
+    # Let the client know it can send the body of the request being received
+    if parser.expect_continue:
+        parser.expect_continue = False
+        __queue_bytes(data, b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    return True
+
+
+# Determine if the client wants to keep the connection open after a request
+def __is_keep_alive(request):
+    # The body a client still sends after its request was refused can't be told apart from a next request
+    if request['body_skipped']:
+        return False
+
+    connection = request['headers'].get('connection', '').lower()
+
+    # HTTP/1.1 connections are persistent by default, HTTP/1.0 ones must ask for it
+    if request['version'] == '1.0':
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+
+# Receive the available bytes from the client connection into the request parser
+def __receive_data(sock, parser):
+    # Read a large chunk at once, the parser keeps track of partial requests
+    try:
+        chunk = sock.recv(__BUFFER_SIZE)
+    except BlockingIOError:
+        return True
+    except ConnectionError:
+        return False
+
+    # An empty read means the client closed the connection
+    if not chunk:
+        return False
+
+    metrics.bytes_received += len(chunk)
+    parser.feed(chunk)
+    return True
+
+
+# Build a proper HTTP response and queue it on the connection output
+def __build_response(request, path, keep_alive, output, verbose):
+    start = time.perf_counter()
+
+    # Handle the request appropriately (the metrics are served without touching the file system)
+    if request['path'] == __METRICS_PATH:
+        response = __build_metrics_response(request)
+    elif request['path'].startswith(__INDEX_PATH + '/'):
+        response = __build_index_response(request)
+    else:
+        response = __handle_request(request, request['body'], path, verbose)
+    # Delete the received body if it wasn't used
+    request['body'].discard()
+    metrics.count_request(request['verb'], response['response_status'])
+
+    # Bodies generated on the fly have no known length, they are sent in chunks (or until the connection closes)
+    stream = response.get('response_stream')
+    if stream is not None and request['version'] == '1.0':
+        keep_alive = False
+
+    # File contents are streamed from the disk instead of being loaded in memory
+    file = response.get('response_file')
+    parts = response['response_parts'] if 'response_parts' in response else [response.get('response_body', b'')]
+    content_length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+    dt = datetime.datetime.utcnow()
+
+    # Build the text-based part of the request
+    content_string = f'HTTP/1.1 {response["response_status"][0]} {response["response_status"][1]}\r\n' \
+              f'Content-Type: {response["content_type"]}\r\n' \
+              f'Content-Disposition: {response["content_disposition"]}\r\n' \
+              f'Connection: {"keep-alive" if keep_alive else "close"}\r\n' \
+              f'Date: {format_date_time(dt.timestamp())}\r\n'
+    if stream is not None:
+        if keep_alive:
+            content_string += 'Transfer-Encoding: chunked\r\n'
+    # A 304 response has no body and must not announce a length different from the file's
+    elif response["response_status"] != HttpStatus.NOT_MODIFIED.value:
+        content_string += f'Content-Length: {content_length}\r\n'
+    # Add the headers specific to the response
+    for name, value in response.get('headers', {}).items():
+        content_string += f'{name}: {value}\r\n'
+    content_string += '\r\n'
+
+    # Queue the headers followed by the binary parts of the request, as bytes or (offset, count) file ranges
+    output.append_bytes(content_string.encode())
+    if stream is not None:
+        output.append_stream(__encode_chunks(stream) if keep_alive else stream)
+    last_range = max((i for i, part in enumerate(parts) if not isinstance(part, bytes)), default=-1)
+    for i, part in enumerate(parts):
+        if isinstance(part, bytes):
+            output.append_bytes(part)
+        else:
+            output.append_file(file, part[0], part[1], close=i == last_range)
+    if file and last_range == -1:
+        file.close()
+
+    if verbose:
+        __log('[RESPONSE] Response created')
+
+    metrics.observe(ConnectionMetrics.HANDLE, time.perf_counter() - start)
+    __log_access(request, response['response_status'], None if stream is not None else content_length)
+    return keep_alive
+
+
+# Write the debug messages to the log, or to the standard output in the processes without one
+def __log(message):
+    if access_log is not None:
+        access_log.debug(message)
+    else:
+        print(message)
+
+
+# Log a request answered (the time is counted from the end of its reception)
+def __log_access(request, status, size):
+    if access_log is not None:
+        access_log.access(request.get('peer'), request['verb'], request['path'], status[0], size,
+                          time.perf_counter() - request.get('received', time.perf_counter()))
+
+
+# Write the last records of the log of the process
+def __close_log():
+    global access_log
+
+    if access_log is not None:
+        access_log.close()
+        access_log = None
+
+
+# Stop updating the index of the process
+def __close_index():
+    global tree_index
+
+    if tree_index is not None:
+        tree_index.close()
+        tree_index = None
+
+
+# Serve the metrics of the process
+def __build_metrics_response(request):
+    if request['verb'] != HttpVerb.GET.value:
+        return {
+            'content_type': 'application/json;charset=utf-8',
+            'content_disposition': 'inline',
+            'response_status': HttpStatus.BAD_REQUEST.value,
+            'response_body': json.dumps({
+                'error': 'The metrics can only be read with GET.'
+            }).encode()
+        }
+
+    # Counters of the caches and of the I/O pool, when they are enabled
+    extra = []
+    for prefix, component in (('file_cache', file_cache), ('listing_cache', listing_cache),
+                              ('compression_cache', compression_cache)):
+        if component is not None:
+            stats = component.stats()
+            extra += [
+                (f'httpfs_{prefix}_hits_total', 'counter', 'Lookups answered by the cache.', stats['hits']),
+                (f'httpfs_{prefix}_misses_total', 'counter', 'Lookups not answered by the cache.', stats['misses']),
+                (f'httpfs_{prefix}_evictions_total', 'counter', 'Entries evicted from the cache.', stats['evictions'])
+            ]
+    if tree_index is not None:
+        extra.append(('httpfs_index_entries', 'gauge', 'Files and directories in the tree index.',
+                      tree_index.stats()['entries']))
+    if compression_cache is not None:
+        extra.append(('httpfs_compression_over_budget_total', 'counter',
+                      'Bodies sent uncompressed because the CPU budget of the compression was spent.',
+                      compression_cache.stats()['over_budget']))
+    if blob_store is not None:
+        stats = blob_store.stats()
+        extra += [
+            ('httpfs_blobs_stored_total', 'counter', 'Uploaded bodies added to the blob store.', stats['stored']),
+            ('httpfs_blobs_deduplicated_total', 'counter', 'Files written as a link to a blob already stored.',
+             stats['deduplicated']),
+            ('httpfs_blobs_saved_bytes_total', 'counter', 'Bytes not stored again thanks to the blob store.',
+             stats['saved_bytes'])
+        ]
+    if access_log is not None:
+        stats = access_log.stats()
+        extra += [
+            ('httpfs_log_dropped_total', 'counter', 'Log records dropped because the buffer was full.',
+             stats['dropped']),
+            ('httpfs_log_sampled_out_total', 'counter', 'Requests not logged because of the sampling.',
+             stats['sampled_out'])
+        ]
+    if io_pool is not None:
+        stats = io_pool.stats()
+        extra.append(('httpfs_io_queued', 'gauge', 'File system operations submitted and not completed.',
+                      stats['queued']))
+
+    return {
+        'content_type': 'text/plain; version=0.0.4;charset=utf-8',
+        'content_disposition': 'inline',
+        'response_status': HttpStatus.OK.value,
+        'response_body': metrics.render(extra)
+    }
+
+
+# Answer the search, modified-since and stat queries from the tree index
+def __build_index_response(request):
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline',
+        'response_status': HttpStatus.BAD_REQUEST.value
+    }
+
+    if request['verb'] != HttpVerb.GET.value:
+        response['response_body'] = json.dumps({
+            'error': 'The index can only be queried with GET.'
+        }).encode()
+        return response
+
+    if tree_index is None:
+        response['response_status'] = HttpStatus.NOT_FOUND.value
+        response['response_body'] = json.dumps({
+            'error': 'The index is disabled.'
+        }).encode()
+        return response
+
+    if not tree_index.ready.is_set():
+        response['response_status'] = HttpStatus.SERVICE_UNAVAILABLE.value
+        response['headers'] = {'Retry-After': 1}
+        response['response_body'] = json.dumps({
+            'error': 'The index is being built.',
+            'details': 'Retry later.'
+        }).encode()
+        return response
+
+    query = request['query']
+    operation = request['path'][len(__INDEX_PATH) + 1:]
+    # The queries apply to the tree of a path of the shared directory (all of it by default)
+    relative = posixpath.normpath('/' + query.get('path', '')).strip('/')
+    try:
+        limit = int(query.get('limit', __INDEX_QUERY_LIMIT))
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        response['response_body'] = json.dumps({
+            'error': 'The limit must be a strictly positive integer.'
+        }).encode()
+        return response
+
+    # Files and directories whose name (or path, when the pattern has a /) match comma-separated glob patterns
+    if operation == 'search':
+        globs = __compile_globs(query.get('glob', ''))
+        if not globs:
+            response['response_body'] = json.dumps({
+                'error': 'At least one glob pattern is required.'
+            }).encode()
+            return response
+
+        prefix = len(relative) + 1 if relative else 0
+        matches = sorted((path, entry) for path, entry in tree_index.list(relative)
+                         if path != relative and __matches_globs(path[prefix:], globs))
+        body = {
+            'matches': [__describe_index_entry(path, entry) for path, entry in matches[:limit]],
+            'truncated': len(matches) > limit
+        }
+
+    # Files and directories modified or removed after a time (a Unix timestamp or an HTTP date)
+    elif operation == 'modified':
+        try:
+            since = float(query['since'])
+        except (KeyError, ValueError):
+            since = __parse_http_date(query.get('since'))
+        if since is None:
+            response['response_body'] = json.dumps({
+                'error': 'The since parameter must be a Unix timestamp or an HTTP date.'
+            }).encode()
+            return response
+
+        modified, removed = tree_index.modified_since(relative, int(since * 1e9), limit)
+        body = {
+            'modified': [__describe_index_entry(path, entry) for path, entry in modified[:limit]],
+            'removed': [{'path': '/' + path, 'removed_timestamp': time_removed / 1e9}
+                        for path, time_removed in removed[:limit]],
+            'truncated': len(modified) > limit or len(removed) > limit
+        }
+
+    # Entry of a path, with the totals of its tree for the directories
+    elif operation == 'stat':
+        result = tree_index.get(relative)
+        if result is None:
+            response['response_status'] = HttpStatus.NOT_FOUND.value
+            response['response_body'] = json.dumps({
+                'error': 'The requested path is not in the index.'
+            }).encode()
+            return response
+
+        entry, totals = result
+        body = __describe_index_entry(relative, entry)
+        if totals is not None:
+            body.update({'total_size': totals[0], 'total_files': totals[1], 'total_directories': totals[2]})
+
+    else:
+        response['response_status'] = HttpStatus.NOT_FOUND.value
+        response['response_body'] = json.dumps({
+            'error': 'The supported index queries are search, modified, stat.'
+        }).encode()
+        return response
+
+    response['response_status'] = HttpStatus.OK.value
+    response['response_body'] = json.dumps(body).encode()
+    return response
+
+
+# Get the JSON object describing an entry of the tree index
+def __describe_index_entry(path, entry):
+    return {
+        'path': '/' + path,
+        'is_directory': entry[2],
+        'size': entry[0],
+        'modified': format_date_time(entry[1] / 1e9),
+        'modified_timestamp': entry[1] / 1e9
+    }
+
+
+# Frame the chunks of a generated body with the chunked transfer encoding
+def __encode_chunks(stream):
+    for chunk in stream:
+        # File ranges stay ranges, between the size line and the end of their chunk
+        if isinstance(chunk, tuple):
+            yield f'{chunk[2]:x}\r\n'.encode()
+            yield chunk
+            yield b'\r\n'
+        elif chunk:
+            yield f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n'
+    yield b'0\r\n\r\n'
+
+
+# Build a response for a request that couldn't be handled
+def __build_error_response(status, error, details):
+    dt = datetime.datetime.utcnow()
+    metrics.count_request(None, status.value)
+
+    body = json.dumps({
+        'error': error,
+        'details': details
+    }).encode()
+
+    content_string = f'HTTP/1.1 {status.value[0]} {status.value[1]}\r\n' \
+              f'Content-Type: application/json;charset=utf-8\r\n' \
+              f'Content-Disposition: inline\r\n' \
+              f'Content-Length: {len(body)}\r\n' \
+              f'Connection: close\r\n' \
+              f'Date: {format_date_time(dt.timestamp())}\r\n\r\n'
+
+    return content_string.encode() + body
+
+
+def __handle_request(request, body, path, verbose):
+    # Default Values
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline',
+        'response_status': HttpStatus.BAD_REQUEST.value,
+        'response_body': json.dumps({
+            'error': 'Unknown HTTP verb received. The supported verbs are GET, POST, PUT, PATCH.'
+        }).encode()
+    }
+
+    # Get the full request path by merging the base path and the request
+    full_path = __get_full_path(path, request['path'])
+
+    # Make sure the use doesn't go out of the base path
+    if full_path is None:
+        response['response_status'] = HttpStatus.FORBIDDEN.value
+        response['response_body'] = json.dumps({
+            'error': 'The requested path is not accessible.'
+        }).encode()
+        return response
+
+    # Read a given file or list the directory
+    if request['verb'] == HttpVerb.GET.value:
+        if 'upload' in request['query']:
+            return __describe_upload(full_path)
+        if full_path.is_dir():
+            if 'archive' in request['query']:
+                return __archive_directory(full_path, request['query'], verbose)
+            return __list_directory(full_path, request['query'], request['headers'], verbose)
+        else:
+            return __read_file(full_path, request['headers'], verbose)
+
+    # Write/Create a given file, write a range of it or append to it
+    if request['verb'] in __WRITE_VERBS:
+        if full_path.is_dir():
+            response['response_body'] = json.dumps({
+                'error': 'The requested path represents a directory. The path must represent a file to work correctly.'
+            }).encode()
+            return response
+
+        # The range writes are refused as soon as their headers are received
+        if isinstance(body, DiscardedBody) and body.status is not None:
+            response['response_status'] = body.status
+            response['response_body'] = json.dumps({
+                'error': str(body.error)
+            }).encode()
+            return response
+
+        if request['verb'] == HttpVerb.POST.value or \
+                (request['verb'] == HttpVerb.PUT.value and 'content-range' not in request['headers']):
+            return __write_file(full_path, body, request['headers'], verbose)
+        if request['verb'] == HttpVerb.PUT.value:
+            return __write_upload_range(full_path, body, verbose)
+        if 'content-range' in request['headers']:
+            return __write_file_range(full_path, body, request['headers'], verbose)
+        return __append_file(full_path, body, request['headers'], verbose)
+
+    return response
+
+
+# Merge the base path and the request path, return None if the result is outside the base path
+def __get_full_path(path, request_path):
+    full_path = pathlib.Path(os.path.normpath(pathlib.Path(str(path) + request_path)))
+
+    if str(path) not in str(full_path):
+        return None
+    return full_path
+
+
+# Create the destination of a request body once its headers are received
+def __create_request_body(path, request):
+    full_path = __get_full_path(path, request['path'])
+
+    # Only the files being written keep their body, in a temporary file next to their destination
+    if request['verb'] not in __WRITE_VERBS or request['path'] == __METRICS_PATH or \
+            request['path'].startswith(__INDEX_PATH + '/') or full_path is None or full_path.is_dir():
+        return DiscardedBody()
+
+    try:
+        # The ranges are written in place as they are received
+        content_range = request['headers'].get('content-range')
+        if content_range is not None and request['verb'] != HttpVerb.POST.value:
+            try:
+                return __create_range_body(full_path, content_range, request['headers'],
+                                           request['verb'] == HttpVerb.PUT.value)
+            # The ranges are refused before they are received when their file can't be opened
+            except (NotADirectoryError, FileNotFoundError, FileExistsError):
+                return DiscardedBody(IOError('The file can not be created, a parent of its path is not a directory.'),
+                                     HttpStatus.CONFLICT.value)
+            except IOError:
+                return DiscardedBody(IOError('The file could not be opened to write the range.'),
+                                     HttpStatus.INTERNAL_SERVER_ERROR.value)
+        # The bodies are hashed for the blob store, or to be checked against the Repr-Digest they declare
+        hashed = blob_store is not None or 'repr-digest' in request['headers']
+        return TemporaryFileBody(full_path, hashed=hashed and request['verb'] != HttpVerb.PATCH.value)
+    except IOError as e:
+        return DiscardedBody(e)
+
+
+# Create the destination of a body written at an offset, or refuse the write before the body is received
+def __create_range_body(path, content_range, headers, upload):
+    try:
+        start, end, total = __parse_content_range(content_range)
+    except ValueError as e:
+        return DiscardedBody(e, HttpStatus.BAD_REQUEST.value)
+    length = end - start + 1
+
+    if 'content-length' in headers and int(headers['content-length']) != length:
+        return DiscardedBody(ValueError('The Content-Length must be the length of the Content-Range.'),
+                             HttpStatus.BAD_REQUEST.value)
+    # The headers are received on the event loop, so the file isn't hashed to check the content hash tags
+    if not __is_write_allowed(path, headers, hash_contents=False):
+        return DiscardedBody(IOError('The file was modified or the precondition of the request is not met.'),
+                             HttpStatus.PRECONDITION_FAILED.value)
+
+    # The ranges of an upload go to a hidden file, renamed to the destination once all of them are received
+    if upload:
+        if total is None:
+            return DiscardedBody(ValueError('The Content-Range of an upload must give the size of the file.'),
+                                 HttpStatus.BAD_REQUEST.value)
+        if end >= total:
+            return DiscardedBody(ValueError('The range ends after the end of the file.'),
+                                 HttpStatus.RANGE_NOT_SATISFIABLE.value)
+
+        upload_path, record_path = __get_upload_paths(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        upload = __start_upload(record_path, total)
+        if upload is None:
+            return DiscardedBody(IOError('The upload in progress of this file could not be read.'),
+                                 HttpStatus.CONFLICT.value)
+        if upload['size'] != total:
+            message = f'An upload of this file with a size of {upload["size"]} bytes is in progress.'
+            return DiscardedBody(IOError(message), HttpStatus.CONFLICT.value)
+        return RangeBody(upload_path, start, length, functools.partial(__add_upload_range, record_path), __run_io)
+
+    # Other ranges are written in place, inside or right after the end of an existing file
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return DiscardedBody(IOError('The file does not exist, it must be created before a range of it is written.'),
+                             HttpStatus.NOT_FOUND.value)
+    if start > stat.st_size:
+        return DiscardedBody(ValueError('The range starts after the end of the file.'),
+                             HttpStatus.RANGE_NOT_SATISFIABLE.value)
+    # A file with other links (e.g. in the blob store) is copied before it is written, in the I/O threads, so the range
+    # is received in a temporary file first
+    if stat.st_nlink > 1:
+        return TemporaryFileBody(path)
+    return RangeBody(path, start, length)
+
+
+def __list_directory(path, query, headers, verbose):
+    # Common response values
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline'
+    }
+
+    # Get the listing options from the query string
+    try:
+        offset = int(query.get('offset', 0))
+        limit = int(query['limit']) if 'limit' in query else None
+        if offset < 0 or (limit is not None and limit <= 0):
+            raise ValueError
+    except ValueError:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The offset must be a positive integer and the limit a strictly positive integer.'
+        }).encode()
+        return response
+
+    # The cursor is the name of the last child of the previous page
+    cursor = query.get('cursor')
+    # Include the size and the modification time of every child
+    details = query.get('details', '').lower() in ['1', 'true', 'yes']
+    # Send a JSON array, or stream a JSON object per line
+    output_format = query.get('format', 'json')
+    if output_format not in ['json', 'jsonl']:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The supported listing formats are json, jsonl.'
+        }).encode()
+        return response
+
+    try:
+        listing = __get_listing(path, verbose)
+
+        # Select the requested page of children (sorted by name)
+        start = bisect.bisect_right(listing.names, cursor) if cursor is not None else 0
+        start = min(start + offset, len(listing.children))
+        end = len(listing.children) if limit is None else min(start + limit, len(listing.children))
+        paginated = cursor is not None or offset > 0 or limit is not None
+
+        response['headers'] = {'X-Total-Count': len(listing.children)}
+        if end < len(listing.children):
+            # Let the client know where the next page starts
+            next_query = urllib.parse.urlencode({**query, 'cursor': listing.names[end - 1], 'offset': 0})
+            response['headers']['X-Next-Cursor'] = urllib.parse.quote(listing.names[end - 1])
+            response['headers']['Link'] = f'<?{next_query}>; rel="next"'
+
+        # Stream the children by batches instead of encoding the whole listing at once
+        if output_format == 'jsonl':
+            response['content_type'] = 'application/x-ndjson;charset=utf-8'
+            response['response_stream'] = __stream_listing(listing.children[start:end], details)
+
+        # The encoded listing of the whole directory is kept with the cached listing
+        elif not paginated and not details:
+            if listing.body is None:
+                listing.body = json.dumps([__describe_child(child, False) for child in listing.children]).encode()
+            response['response_body'] = listing.body
+
+        else:
+            response['response_body'] = json.dumps([
+                __describe_child(child, details) for child in listing.children[start:end]
+            ]).encode()
+
+        if output_format == 'json':
+            __compress_listing(response, listing if not paginated and not details else None, headers)
+        response['response_status'] = HttpStatus.OK.value
+
+    # If an exception occurs set the response status as Internal Server Error
+    except IOError as e:
+        response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
+        response['response_body'] = json.dumps({
+            'error': 'An unknown error occurred while listing the directory contents.',
+            'details': str(e)
+        }).encode()
+
+    return response
+
+
+# Get the children of a directory, sorted by name, from the cache or the disk
+def __get_listing(path, verbose):
+    key = str(path)
+    # Get the modification time before reading the children, so a change made meanwhile invalidates the listing
+    stat = os.stat(path)
+
+    listing = listing_cache.get(key, stat) if listing_cache is not None else None
+    if listing is not None:
         if verbose:
-            print("[CONNECTION] Closed connection to", data.addr)
+            __log(f'[CACHE] Listing cache hit for {key} {listing_cache.stats()}')
+        return listing
+
+    # The type of the children comes from the directory entries, without an extra stat per child
+    # The hidden temporary files of the server (bodies being received and uploads in progress) are skipped
+    with os.scandir(path) as iterator:
+        children = [child for child in iterator if not (child.name.startswith('.') and child.name.endswith('.part'))]
+    children.sort(key=lambda child: child.name)
+    for child in children:
+        child.is_dir()
+
+    listing = types.SimpleNamespace(
+        children=children,
+        names=[child.name for child in children],
+        mtime=stat.st_mtime_ns,
+        body=None,
+        # Compressed versions of the body by content encoding
+        encoded={}
+    )
+    if listing_cache is not None:
+        listing_cache.put(key, listing)
+
+    return listing
+
+
+# Compress the JSON body of a listing response when the client accepts it
+# The compressed versions of a whole directory listing are kept with the cached listing
+def __compress_listing(response, listing, headers):
+    if compression_cache is None:
+        return
+
+    response['headers']['Vary'] = 'Accept-Encoding'
+    body = response['response_body']
+    encoding = __choose_encoding(headers, __ENCODERS)
+    if encoding is None or not __COMPRESSION_MIN_SIZE <= len(body) <= compression_cache.max_entry_size:
+        return
+
+    compressed = listing.encoded.get(encoding) if listing is not None else None
+    if compressed is None:
+        compressed = __compress(body, encoding)
+        if compressed is None:
+            return
+        if listing is not None:
+            listing.encoded[encoding] = compressed
+
+    response['response_body'] = compressed
+    response['headers']['Content-Encoding'] = encoding
+
+
+# Get the JSON object describing a child of a directory
+def __describe_child(child, details):
+    description = {'name': child.name, 'is_directory': child.is_dir()}
+
+    # The children are stat again for every page, the listing cache only tells when they are added or removed
+    if details:
+        try:
+            stat = os.stat(child.path)
+            description['size'] = stat.st_size
+            description['modified'] = format_date_time(stat.st_mtime)
+        except FileNotFoundError:
+            description['size'] = None
+            description['modified'] = None
+
+    return description
+
+
+# Generate a listing as JSON lines, by batches of children
+def __stream_listing(children, details):
+    for i in range(0, len(children), __LISTING_BATCH_SIZE):
+        lines = [json.dumps(__describe_child(child, details)) + '\n' for child in children[i:i + __LISTING_BATCH_SIZE]]
+        yield ''.join(lines).encode()
+
+
+# Stream a tar or zip archive of the files of a directory tree
+def __archive_directory(path, query, verbose):
+    # Common response values
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline'
+    }
+
+    # Get the archive options from the query string
+    archive_format = query['archive'] or 'tar'
+    if archive_format not in __ARCHIVE_FORMATS:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The supported archive formats are tar, zip.'
+        }).encode()
+        return response
+
+    # Levels of subdirectories included (all of them by default)
+    try:
+        depth = int(query['depth']) if 'depth' in query else None
+        if depth is not None and depth < 0:
+            raise ValueError
+    except ValueError:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The depth must be a positive integer.'
+        }).encode()
+        return response
+
+    # Comma-separated glob patterns of the files included (all of them by default)
+    globs = __compile_globs(query.get('glob', ''))
+
+    # The files are found and read while the archive is sent, a few at a time
+    files = __walk_archive(path, depth, globs)
+    name = path.name or 'shared'
+    response['content_type'] = __ARCHIVE_FORMATS[archive_format]
+    response['content_disposition'] = f'attachment; filename="{name}.{archive_format}"'
+    response['response_status'] = HttpStatus.OK.value
+    response['response_stream'] = __stream_tar(files) if archive_format == 'tar' else __stream_zip(files)
+
+    if verbose:
+        __log(f'[RESPONSE] Streaming a {archive_format} archive of {path}')
+
+    return response
+
+
+# Find the files of a directory tree to archive, as (path relative to the directory, full path) tuples
+# The directories are read one at a time and their children sorted by name, the symbolic links to directories are
+# never followed
+def __walk_archive(path, depth, globs):
+    directories = [(path, '', 0)]
+
+    while directories:
+        directory, prefix, level = directories.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                children = sorted(iterator, key=lambda child: child.name)
+        except OSError:
+            continue
+
+        subdirectories = []
+        for child in children:
+            relative = prefix + child.name
+            if child.is_dir(follow_symlinks=False):
+                if depth is None or level < depth:
+                    subdirectories.append((child.path, relative + '/', level + 1))
+            # Skip the uploads in progress
+            elif child.name.startswith('.') and child.name.endswith('.part'):
+                continue
+            elif child.is_file() and __matches_globs(relative, globs):
+                yield relative, child.path
+
+        directories.extend(reversed(subdirectories))
+
+
+# Compile comma-separated glob patterns, matched on the name of a file or on its relative path if they have a /
+def __compile_globs(value):
+    return [('/' in pattern, re.compile(fnmatch.translate(pattern)).match) for pattern in value.split(',') if pattern]
+
+
+# Determine if a file matches one of the compiled glob patterns (every file matches when there is none)
+def __matches_globs(relative, globs):
+    if not globs:
+        return True
+
+    name = relative[relative.rfind('/') + 1:]
+    for on_path, match in globs:
+        if match(relative if on_path else name):
+            return True
+    return False
+
+
+# Generate a tar archive of files, the large files are sent straight from the disk as file ranges
+def __stream_tar(files):
+    buffer = ArchiveBuffer()
+
+    for relative, file_path in files:
+        # The files removed since they were found are skipped
+        try:
+            file = open(file_path, 'rb')
+        except OSError:
+            continue
+
+        try:
+            stat = os.fstat(file.fileno())
+            info = tarfile.TarInfo(relative)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = stat.st_mode & 0o7777
+            buffer.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+            # The small files are copied with the headers around them, so they are sent together
+            if stat.st_size <= __BUFFER_SIZE:
+                buffer.write(file.read(stat.st_size).ljust(stat.st_size, b'\0'))
+                file.close()
+            elif stat.st_size:
+                yield buffer.take()
+                yield file, 0, stat.st_size
+            else:
+                file.close()
+        except OSError:
+            file.close()
+            raise
+
+        # Pad the contents to a whole block
+        buffer.write(bytes(-stat.st_size % tarfile.BLOCKSIZE))
+        if buffer.size >= __BUFFER_SIZE:
+            yield buffer.take()
+
+    # The archive ends with two empty blocks
+    buffer.write(bytes(2 * tarfile.BLOCKSIZE))
+    yield buffer.take()
+
+
+# Generate a zip archive of files (stored without compression), read by chunks to compute their checksums
+def __stream_zip(files):
+    buffer = ArchiveBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for relative, file_path in files:
+            # The files removed since they were found are skipped
+            try:
+                file = open(file_path, 'rb')
+            except OSError:
+                continue
+
+            with file:
+                stat = os.fstat(file.fileno())
+                # Zip dates start in 1980
+                info = zipfile.ZipInfo(relative, max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+                info.external_attr = (stat.st_mode & 0xFFFF) << 16
+                info.file_size = stat.st_size
 
+                with archive.open(info, 'w') as member:
+                    remaining = stat.st_size
+                    while remaining > 0:
+                        chunk = file.read(min(remaining, __BUFFER_SIZE))
+                        if not chunk:
+                            break
+                        member.write(chunk)
+                        remaining -= len(chunk)
+                        if buffer.size >= __BUFFER_SIZE:
+                            yield buffer.take()
 
-# Handler for client connections
-def __receive_connection(sock, path, verbose):
-    # Receive the byte array
-    headers, body = __receive_data(sock)
-    # Build a proper HTTP response from the request
-    response = __build_response(headers, body, path)
-    # Return the response back to the client
-    if verbose:
-        print("[CONNECTION] Connection received")
-    return response
+    # The central directory is written when the archive is closed
+    yield buffer.take()
 
 
-# Receive the byte array from the client connection
-def __receive_data(sock):
-    # Read the socket data byte by byte until we reach the end of the headers
-    headers = b''
-    while b'\r\n\r\n' not in headers:
-        headers += sock.recv(__BUFFER_SIZE)
+def __read_file(path, headers, verbose):
+    # Common response values
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline'
+    }
 
-    # Get a string from the header bytes without the empty lines
-    header_data = headers[:-4].decode()
+    # If the path doesn't exist we're trying to read a file that doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        response['response_status'] = HttpStatus.NOT_FOUND.value
+        response['response_body'] = json.dumps({
+            'error': 'The requested file was not found.'
+        }).encode()
+        return response
+    except OSError:
+        stat = None
 
-    # Ignore the HTTP Version and Request Status
-    header_strings = header_data.splitlines()[1:]
+    try:
+        # Serve the file from memory if it didn't change since it was cached
+        key = str(path)
+        entry = file_cache.get(key, stat) if file_cache is not None and stat is not None else None
+        if entry is not None:
+            if verbose:
+                __log(f'[CACHE] Cache hit for {key} {file_cache.stats()}')
+            source = entry.body
+        else:
+            # Open the file, its contents are sent straight from the disk with the response
+            file = open(path, 'rb')
+            try:
+                stat = os.fstat(file.fileno())
+                # Guess the Mime Type from the file extension
+                mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+                # Get the content disposition based on the Mime Type
+                entry = types.SimpleNamespace(
+                    body=None,
+                    mime_type=mime_type,
+                    content_disposition=__get_content_disposition(mime_type, path),
+                    headers={
+                        'Accept-Ranges': 'bytes',
+                        'ETag': __get_stat_etag(stat),
+                        'Last-Modified': format_date_time(stat.st_mtime)
+                    },
+                    missing_variants=set()
+                )
 
-    # Build a dictionary from the string
-    header_dictionary = {}
-    for string in header_strings:
-        header = string.split(': ')
-        header_dictionary[header[0]] = header[1]
+                # Load the small files in the cache, their validator is a hash of their contents
+                if file_cache is not None and stat.st_size <= file_cache.max_entry_size:
+                    body = file.read()
+                    entry.headers['ETag'] = __get_content_etag(body)
+                    entry = file_cache.put(key, stat, body, entry.mime_type, entry.content_disposition, entry.headers)
+                    file.close()
+                    source = entry.body
+                else:
+                    source = file
+            except OSError:
+                file.close()
+                raise
 
-    # Create a dictionary from the headers
-    content_length = None
-    if 'Content-Length' in header_dictionary:
-        content_length = int(header_dictionary.get('Content-Length'))
+        size = len(source) if isinstance(source, bytes) else stat.st_size
+        response['content_disposition'] = entry.content_disposition
+        response['content_type'] = entry.mime_type
+        response['headers'] = dict(entry.headers)
 
-    # Receive the rest of the request
-    body = b''
-    if content_length:
-        body += sock.recv(content_length)
+        # Ignore the Range header if the part of the file the client has is outdated
+        range_header = headers.get('range')
+        if not __is_range_current(headers.get('if-range'), entry.headers['ETag'], stat.st_mtime):
+            range_header = None
 
-    return headers, body
+        # Send a compressed version of the whole file if the client accepts one, with its own entity tag
+        vary, variant = __get_encoded_variant(path, stat, source, entry, headers, range_header is None)
+        if vary:
+            response['headers']['Vary'] = 'Accept-Encoding'
+        if variant is not None:
+            if not isinstance(source, bytes):
+                source.close()
+            encoding, source, size, version = variant
+            response['headers']['Content-Encoding'] = encoding
+            response['headers']['ETag'] = f'{entry.headers["ETag"][:-1]}{version}-{encoding}"'
 
+        # Answer with a 304 if the client already has the current version of the file
+        if __is_not_modified(headers, response['headers']['ETag'], stat.st_mtime):
+            if not isinstance(source, bytes):
+                source.close()
+            response['response_status'] = HttpStatus.NOT_MODIFIED.value
+            response['response_body'] = b''
+            return response
 
-# Build a proper HTTP response
-def __build_response(headers, body, path, verbose):
-    # Get a request dictionary from the raw request
-    request = __parse_request(headers.decode())
-    # Handle the request appropriately
-    response = __handle_request(request, body, path)
+        # Only read the requested parts of the file
+        ranges = __parse_range(range_header, size)
+        if ranges is None:
+            ranges = [(0, size - 1)]
+            response['response_status'] = HttpStatus.OK.value
 
-    dt = datetime.datetime.utcnow()
+        # None of the requested ranges overlap the file
+        elif not ranges:
+            if not isinstance(source, bytes):
+                source.close()
+            response['content_type'] = 'application/json;charset=utf-8'
+            response['content_disposition'] = 'inline'
+            response['headers']['Content-Range'] = f'bytes */{size}'
+            response['response_status'] = HttpStatus.RANGE_NOT_SATISFIABLE.value
+            response['response_body'] = json.dumps({
+                'error': 'The requested range is not satisfiable.'
+            }).encode()
+            return response
 
-    # Build the text-based part of the request
-    content_string = f'HTTP/1.1 {response["response_status"][0]} {response["response_status"][1]}\r\n' \
-              f'Content-Type: {response["content_type"]}\r\n' \
-              f'Content-Disposition: {response["content_disposition"]}\r\n' \
-              f'Content-Length: {len(response["response_body"])}\r\n' \
-              f'Date: {format_date_time(dt.timestamp())}\r\n\r\n'
+        else:
+            response['response_status'] = HttpStatus.PARTIAL_CONTENT.value
 
-    # Convert to a byte array
-    content = bytearray(content_string.encode())
-    # Add the binary part of the request
-    content += response["response_body"]
-    if verbose:
-        print("[RESPONSE] Response created")
+        # File ranges are (offset, count) tuples read from the file, cached files are sliced
+        if isinstance(source, bytes):
+            parts = [source[start:end + 1] for start, end in ranges]
+        else:
+            response['response_file'] = source
+            parts = [(start, end - start + 1) for start, end in ranges]
+
+        # A single range is sent as is
+        if len(ranges) == 1 and response['response_status'] == HttpStatus.PARTIAL_CONTENT.value:
+            start, end = ranges[0]
+            response['headers']['Content-Range'] = f'bytes {start}-{end}/{size}'
 
-    return content
+        # Multiple ranges are sent as the parts of a multipart body
+        elif len(ranges) > 1:
+            boundary = uuid.uuid4().hex
+            multipart = []
+            for (start, end), part in zip(ranges, parts):
+                multipart.append(f'\r\n--{boundary}\r\n'
+                                 f'Content-Type: {entry.mime_type}\r\n'
+                                 f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode())
+                multipart.append(part)
+            multipart.append(f'\r\n--{boundary}--\r\n'.encode())
+            response['content_type'] = f'multipart/byteranges; boundary={boundary}'
+            parts = multipart
 
+        response['response_parts'] = parts
 
-def __parse_request(request, verbose):
-    lines = request.splitlines()
+    # If an error occurs return an Internal Server Error
+    except IOError as e:
+        response['content_disposition'] = 'inline'
+        response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
+        response['response_body'] = json.dumps({
+            'error': 'An unknown error occurred while reading the file contents.',
+            'details': str(e)
+        }).encode()
+        return response
 
-    # Use REGEX to parse the request pattern
-    match = re.search('^([A-Z]+) (.+) HTTP/\d\.?\d?$', lines[0])
     if verbose:
-        print("[REQUEST] Request parsed ")
+        __log('[RESPONSE] Response has been created')
 
-    return {
-        'verb': match.group(1),
-        'path': match.group(2)
-    }
+    return response
 
 
-def __handle_request(request, body, path):
-    # Default Values
+def __write_file(path, content, headers, verbose):
+    # Common response values
     response = {
         'content_type': 'application/json;charset=utf-8',
-        'content_disposition': 'inline',
-        'response_status': HttpStatus.BAD_REQUEST.value,
-        'response_body': json.dumps({
-            'error': 'Unknown HTTP verb received. The supported verbs are GET, POST.'
-        }).encode()
+        'content_disposition': 'inline'
     }
 
-    # Get the full request path by merging the base path and the request
-    full_path = pathlib.Path(os.path.normpath(pathlib.Path(str(path) + request['path'])))
-
-    # Make sure the use doesn't go out of the base path
-    if str(path) not in str(full_path):
-        response['response_status'] = HttpStatus.FORBIDDEN.value
+    # Only write the file if the version the client has seen is still the current one
+    if not __is_write_allowed(path, headers):
+        content.discard()
+        response['response_status'] = HttpStatus.PRECONDITION_FAILED.value
         response['response_body'] = json.dumps({
-            'error': 'The requested path is not accessible.'
+            'error': 'The file was modified or the precondition of the request is not met.'
         }).encode()
         return response
 
-    # Read a given file or list the directory
-    if request['verb'] == HttpVerb.GET.value:
-        if full_path.is_dir():
-            return __list_directory(full_path)
-        else:
-            return __read_file(full_path)
+    try:
+        # Determine if the file will be overwritten or created
+        created = not path.exists()
+        # Create all the parent directories required
+        path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Write/Create a given file
-    if request['verb'] == HttpVerb.POST.value:
-        if not full_path.is_dir():
-            return __write_file(full_path, body)
+        # Move the received body in place, so readers never see a partially written file
+        deduplicated = False
+        if content.hash is None:
+            content.commit(path)
         else:
-            response['response_body'] = json.dumps({
-                'error': 'The requested path represents a directory. The path must represent a file to work correctly.'
-            }).encode()
-            return response
+            digest = content.hash.hexdigest()
+            declared = __parse_repr_digest(headers.get('repr-digest'))
+            if declared is not None and declared != digest:
+                content.discard()
+                # An empty body with the digest of contents already stored is a link to them
+                if content.size == 0 and blob_store is not None and blob_store.link(declared, path):
+                    digest = declared
+                    deduplicated = True
+                elif content.size == 0:
+                    response['response_status'] = HttpStatus.PRECONDITION_FAILED.value
+                    response['response_body'] = json.dumps({
+                        'error': 'The contents of the Repr-Digest are not stored, send the request with its body.'
+                    }).encode()
+                    return response
+                else:
+                    response['response_status'] = HttpStatus.BAD_REQUEST.value
+                    response['response_body'] = json.dumps({
+                        'error': 'The body does not match the Repr-Digest of the request.'
+                    }).encode()
+                    return response
+            elif blob_store is not None:
+                deduplicated = blob_store.commit(content, digest, path)
+            else:
+                content.commit(path)
+            response['headers'] = {'Repr-Digest': __format_repr_digest(digest)}
+
+        __invalidate_file(path)
+        response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
+        response['response_body'] = json.dumps({
+            'success': f'The file was {"created" if created else "overwritten"}.',
+            **({'deduplicated': True} if deduplicated else {})
+        }).encode()
+
+    # If an error occurs return an Internal Server Error
+    except IOError as e:
+        response['content_disposition'] = 'inline'
+        response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
+        response['response_body'] = json.dumps({
+            'error': 'An unknown error occurred while writing the file contents.',
+            'details': str(e)
+        }).encode()
+        return response
+    if verbose:
+        __log('[RESPONSE] File has been written')
 
     return response
 
 
-def __list_directory(path):
+# Write a range of an existing file, whose body was written in place as it was received
+def __write_file_range(path, content, headers, verbose):
     # Common response values
     response = {
         'content_type': 'application/json;charset=utf-8',
         'content_disposition': 'inline'
     }
 
+    start, end, _ = __parse_content_range(headers['content-range'])
     try:
-        children = []
-        # For every child int the directory
-        for child in path.iterdir():
-            # Add an object with the name and type of the child
-            children.append({'name': child.name, 'is_directory': child.is_dir()})
-        # Add these values to the response
-        response['response_body'] = json.dumps(children).encode()
-        response['response_status'] = HttpStatus.OK.value
+        # The ranges of the files with other links were received in a temporary file, the others were written in place
+        if isinstance(content, TemporaryFileBody):
+            if content.error is not None:
+                raise content.error
+            if content.size == end - start + 1:
+                __write_linked_range(path, content, start)
+        else:
+            content.close()
+            if content.error is not None:
+                raise content.error
 
-    # If an exception occurs set the response status as Internal Server Error
+    # If an error occurs return an Internal Server Error
     except IOError as e:
         response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
         response['response_body'] = json.dumps({
-            'error': 'An unknown error occurred while listing the directory contents.',
+            'error': 'An unknown error occurred while writing the file contents.',
             'details': str(e)
         }).encode()
+        return response
+    finally:
+        __invalidate_file(path)
+
+    if content.size != end - start + 1:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The body is not the length of the Content-Range, only the bytes received were written.'
+        }).encode()
+        return response
+
+    response['response_status'] = HttpStatus.OK.value
+    response['response_body'] = json.dumps({
+        'success': 'The range was written.',
+        'size': os.stat(path).st_size
+    }).encode()
+    if verbose:
+        __log('[RESPONSE] Range has been written')
 
     return response
 
 
-def __read_file(path, verbose):
+# Record a range of a resumable upload, and move the upload to its destination once all of its ranges are received
+def __write_upload_range(path, content, verbose):
     # Common response values
     response = {
         'content_type': 'application/json;charset=utf-8',
         'content_disposition': 'inline'
     }
 
-    # If the path doesn't exist we're trying to read a file that doesn't exist
-    if not path.exists():
-        response['response_status'] = HttpStatus.NOT_FOUND.value
+    # Record the bytes written
+    content.close()
+    if content.error is not None:
+        response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
         response['response_body'] = json.dumps({
-            'error': 'The requested file was not found.'
+            'error': 'An unknown error occurred while writing the file contents.',
+            'details': str(content.error)
+        }).encode()
+        return response
+    if content.size != content.length:
+        response['response_status'] = HttpStatus.BAD_REQUEST.value
+        response['response_body'] = json.dumps({
+            'error': 'The body is not the length of the Content-Range, only the bytes received were kept.'
         }).encode()
         return response
 
     try:
-        # Guess the Mime Type from the file extension
-        mime_type = mimetypes.guess_type(path)[0]
-
-        # Read the file
-        with open(path, 'rb') as file:
-            file_content = file.read()
-            # Get the content disposition based on the Mime Type
-            response['content_disposition'] = __get_content_disposition(mime_type, path)
-            response['response_body'] = file_content
-            response['content_type'] = mime_type
-            response['response_status'] = HttpStatus.OK.value
+        created = not path.exists()
+        upload = __complete_upload(path)
+        if upload is not None:
+            response['response_status'] = HttpStatus.ACCEPTED.value
+            response['response_body'] = json.dumps({
+                'success': 'The range was written.',
+                **__describe_upload_ranges(upload)
+            }).encode()
+            return response
+        __invalidate_file(path)
 
     # If an error occurs return an Internal Server Error
     except IOError as e:
-        response['content_disposition'] = 'inline'
         response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
         response['response_body'] = json.dumps({
-            'error': 'An unknown error occurred while reading the file contents.',
+            'error': 'An unknown error occurred while writing the file contents.',
             'details': str(e)
         }).encode()
         return response
 
+    response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
+    response['response_body'] = json.dumps({
+        'success': f'The upload is complete, the file was {"created" if created else "overwritten"}.'
+    }).encode()
     if verbose:
-        print("[RESPONSE] Response has been created")
+        __log('[RESPONSE] Upload has been completed')
+
+    return response
+
+
+# Get the ranges received of the resumable upload of a file
+def __describe_upload(path):
+    # Common response values
+    response = {
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline'
+    }
+
+    upload = __read_upload(__get_upload_paths(path)[1])
+    if upload is None:
+        response['response_status'] = HttpStatus.NOT_FOUND.value
+        response['response_body'] = json.dumps({
+            'error': 'There is no upload in progress for this file.'
+        }).encode()
+        return response
 
+    response['response_status'] = HttpStatus.OK.value
+    response['response_body'] = json.dumps(__describe_upload_ranges(upload)).encode()
     return response
 
 
-def __write_file(path, content, verbose):
+# Get the size of an upload and its ranges received and missing, as (first, last) byte positions like Content-Range
+def __describe_upload_ranges(upload):
+    if upload is None:
+        return {}
+
+    missing = []
+    position = 0
+    for start, end in upload['ranges'] + [[upload['size'], upload['size']]]:
+        if start > position:
+            missing.append([position, start - 1])
+        position = end
+    return {
+        'size': upload['size'],
+        'received': [[start, end - 1] for start, end in upload['ranges']],
+        'missing': missing
+    }
+
+
+# Append the body to a file (created if it doesn't exist), the appends of the workers never interleave
+def __append_file(path, content, headers, verbose):
     # Common response values
     response = {
         'content_type': 'application/json;charset=utf-8',
         'content_disposition': 'inline'
     }
 
+    # Only write the file if the version the client has seen is still the current one
+    if not __is_write_allowed(path, headers):
+        content.discard()
+        response['response_status'] = HttpStatus.PRECONDITION_FAILED.value
+        response['response_body'] = json.dumps({
+            'error': 'The file was modified or the precondition of the request is not met.'
+        }).encode()
+        return response
+
     try:
-        # Determine if the file will be overwritten or created
-        created = not path.exists()
-        # Create all the parent directories required
-        path.parent.mkdir(parents=True, exist_ok=True)
+        if content.error is not None:
+            raise content.error
 
-        # Start writing the file
-        with open(path, 'wb') as file:
-            file.write(content)
-            response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
-            response['response_body'] = json.dumps({
-                'success': f'The file was {"created" if created else "overwritten"}.'
-            }).encode()
+        created = not path.exists()
 
+        # The body was received in a temporary file, it is copied at the end of the file under an exclusive lock
+        file = __open_locked(path, 'ab')
+        try:
+            if os.fstat(file.fileno()).st_nlink > 1:
+                file = __break_link(path, file, 'ab')
+            offset = os.fstat(file.fileno()).st_size
+            with open(content.temp_path, 'rb') as source:
+                shutil.copyfileobj(source, file, __BUFFER_SIZE)
+        finally:
+            file.close()
+        content.discard()
+        __invalidate_file(path)
 
     # If an error occurs return an Internal Server Error
     except IOError as e:
-        response['content_disposition'] = 'inline'
         response['response_status'] = HttpStatus.INTERNAL_SERVER_ERROR.value
         response['response_body'] = json.dumps({
             'error': 'An unknown error occurred while writing the file contents.',
             'details': str(e)
         }).encode()
         return response
+
+    response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
+    response['response_body'] = json.dumps({
+        'success': f'The body was appended to the {"new " if created else ""}file.',
+        'offset': offset,
+        'size': offset + content.size
+    }).encode()
     if verbose:
-        print("[")
+        __log('[RESPONSE] Body has been appended')
 
     return response
 
 
+# Forget the cached versions of a file written
+def __invalidate_file(path):
+    if file_cache is not None:
+        file_cache.invalidate(str(path))
+    if compression_cache is not None:
+        compression_cache.invalidate(str(path))
+    if tree_index is not None:
+        tree_index.refresh(path)
+    if listing_cache is not None:
+        listing_cache.invalidate(str(path.parent))
+
+
+# Run a file system operation in the I/O threads, or right away when there are none
+def __run_io(function):
+    if io_executor is not None:
+        io_executor.submit(function)
+    else:
+        function()
+
+
+# Open a file under an exclusive lock shared by the workers, opened again if it was replaced while waiting for the lock
+def __open_locked(path, mode):
+    while True:
+        file = open(path, mode)
+        if fcntl is None:
+            return file
+
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                return file
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            file.close()
+            raise
+        file.close()
+
+
+# Write a range received in a temporary file into a file, copied first if it still has other links
+def __write_linked_range(path, content, start):
+    file = __open_locked(path, 'r+b')
+    try:
+        if os.fstat(file.fileno()).st_nlink > 1:
+            file = __break_link(path, file, 'r+b')
+        with open(content.temp_path, 'rb') as source:
+            offset = start
+            for chunk in iter(functools.partial(source.read, __BUFFER_SIZE), b''):
+                os.pwrite(file.fileno(), chunk, offset)
+                offset += len(chunk)
+    finally:
+        file.close()
+    content.discard()
+
+
+# Replace a file locked by __open_locked() with a copy of its own, so writing it in place doesn't change its other
+# links (e.g. the blob store), return the copy opened and locked in its place
+# The copy is locked before it replaces the file, so the workers waiting for the lock open it and wait again
+def __break_link(path, file, mode):
+    temp_path = path.parent.joinpath(f'.{path.name}.{uuid.uuid4().hex[:16]}.part')
+    copy = None
+    try:
+        shutil.copy2(path, temp_path)
+        copy = open(temp_path, mode)
+        if fcntl is not None:
+            fcntl.flock(copy.fileno(), fcntl.LOCK_EX)
+        os.replace(temp_path, path)
+    except OSError:
+        if copy is not None:
+            copy.close()
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    file.close()
+    return copy
+
+
+# Paths of the hidden files of the resumable upload of a file: its contents and the record of the ranges received
+def __get_upload_paths(path):
+    return path.parent.joinpath(f'.{path.name}.upload.part'), path.parent.joinpath(f'.{path.name}.ranges.part')
+
+
+# Read the record of a resumable upload, as {'size': ..., 'ranges': [[start, end], ...]}, or None without an upload
+# The records are always replaced by a complete one, so they are read without a lock
+def __read_upload(record_path):
+    try:
+        with open(record_path, 'rb') as file:
+            return json.loads(file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Write the record of a resumable upload to a temporary file first, then replace the record with it (or only create
+# the record if there is none, FileExistsError is raised otherwise)
+def __write_upload(record_path, upload, replace = True):
+    temp_path = record_path.parent.joinpath(f'{record_path.name}.{uuid.uuid4().hex[:16]}.part')
+    with open(temp_path, 'w') as file:
+        json.dump(upload, file)
+
+    try:
+        if replace:
+            os.replace(temp_path, record_path)
+        else:
+            os.link(temp_path, record_path)
+    finally:
+        if not replace or os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# Get the upload in progress of a file, started with the given size if there is none (None if it can't be read)
+def __start_upload(record_path, size):
+    upload = __read_upload(record_path)
+    if upload is None:
+        try:
+            __write_upload(record_path, {'size': size, 'ranges': []}, replace=False)
+        except FileExistsError:
+            pass
+        upload = __read_upload(record_path)
+    return upload
+
+
+# Record the [start, end) bytes of an upload written to its file, under the lock of the file shared by the workers
+def __add_upload_range(record_path, fd, start, end):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        # The upload was completed in the meantime
+        upload = __read_upload(record_path)
+        if upload is not None:
+            __write_upload(record_path, __merge_upload_range(start, end, upload))
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+# Move an upload to its destination once all of its ranges are received, return its record if it is still incomplete
+def __complete_upload(path):
+    upload_path, record_path = __get_upload_paths(path)
+
+    # The last ranges of an upload can be received at the same time, the first one moves the file
+    try:
+        fd = os.open(upload_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    except FileNotFoundError:
+        return None
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        upload = __read_upload(record_path)
+        if upload is None or upload['ranges'] != [[0, upload['size']]]:
+            return upload
+
+        # Without the bytes left by an earlier upload of a larger file
+        os.ftruncate(fd, upload['size'])
+        os.replace(upload_path, path)
+        os.remove(record_path)
+        return None
+    finally:
+        os.close(fd)
+
+
+def __merge_upload_range(start, end, upload):
+    ranges = []
+    for range_start, range_end in sorted(upload['ranges'] + [[start, end]]):
+        if ranges and range_start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], range_end)
+        else:
+            ranges.append([range_start, range_end])
+    upload['ranges'] = ranges
+    return upload
+
+
+# Get a strong entity tag from the identity, size and modification time of a file
+def __get_stat_etag(stat):
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+# Get a strong entity tag from the contents of a file
+def __get_content_etag(body):
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+# Get the content hash entity tag of a file, the same one as for its cached body
+def __get_file_etag(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(functools.partial(file.read, __BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
+
+
+# Get the entity tags listed in an If-Match or If-None-Match header
+def __parse_etags(header):
+    return [tag.strip() for tag in header.split(',')]
+
+
+# Get the entity tag of a file from the one of a compressed version of it (e.g. "...-gzip")
+def __strip_etag_encoding(tag):
+    for encoding in CompressionCache.ENCODINGS:
+        if tag.endswith(f'-{encoding}"'):
+            # The tags of the precompressed files also carry the version of the precompressed file after a "+"
+            return f'{tag[:-len(encoding) - 2].partition("+")[0]}"'
+    return tag
+
+
+# Get the SHA-256 (in hex) of a Repr-Digest header (RFC 9530), or None if it has none
+def __parse_repr_digest(header):
+    if not header:
+        return None
+    for item in header.split(','):
+        algorithm, _, value = item.partition('=')
+        if algorithm.strip().lower() != 'sha-256':
+            continue
+        try:
+            digest = base64.b64decode(value.strip().strip(':'), validate=True)
+        except ValueError:
+            return None
+        return digest.hex() if len(digest) == 32 else None
+    return None
+
+
+# Get the Repr-Digest header of a SHA-256 (in hex)
+def __format_repr_digest(digest):
+    return f'sha-256=:{base64.b64encode(bytes.fromhex(digest)).decode()}:'
+
+
+# Get the timestamp of an HTTP date, or None if it is invalid
+def __parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+# Determine if a conditional GET can be answered with 304 Not Modified
+def __is_not_modified(headers, etag, mtime):
+    # If-None-Match takes precedence and uses the weak comparison (the W/ prefix is ignored)
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.removeprefix('W/') for tag in __parse_etags(if_none_match)]
+        return '*' in tags or etag in tags
+
+    # HTTP dates have a precision of one second
+    if_modified_since = __parse_http_date(headers.get('if-modified-since'))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+# Determine if the ranges of an If-Range request can be served
+def __is_range_current(if_range, etag, mtime):
+    if not if_range:
+        return True
+
+    # Entity tags use the strong comparison, dates must match the modification time exactly
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return __parse_http_date(if_range) == int(mtime)
+
+
+# Get the weight of every content coding of an Accept-Encoding header
+def __parse_accept_encoding(header):
+    weights = {}
+    for item in header.split(','):
+        coding, _, parameters = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        weight = 1.0
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights['gzip' if coding == 'x-gzip' else coding] = weight
+
+    return weights
+
+
+# Choose the content coding the client prefers among the ones available (by order of preference), None for none
+def __choose_encoding(headers, encodings):
+    header = headers.get('accept-encoding')
+    if not header:
+        return None
+
+    weights = __parse_accept_encoding(header)
+    default = weights.get('*', 0.0)
+    # The identity is acceptable unless it is excluded explicitly
+    identity = weights.get('identity', default if '*' in weights else 1.0)
+
+    encoding = max(encodings, key=lambda name: weights.get(name, default), default=None)
+    if encoding is None or weights.get(encoding, default) <= 0 or weights.get(encoding, default) < identity:
+        return None
+    return encoding
+
+
+# Determine if the bodies of a MIME type are worth compressing
+def __is_compressible(mime_type):
+    return mime_type in __INLINE_MIME_TYPES or mime_type.startswith('text/')
+
+
+# Find the compressed version of a file to send, from a precompressed file next to it or compressed on the fly
+# Return whether the response depends on Accept-Encoding and the version as (encoding, source, size, tag suffix), or
+# None
+def __get_encoded_variant(path, stat, source, entry, headers, whole):
+    # Only the precompressed files in an encoding the client accepts are looked for, the ones older than the file are
+    # outdated
+    precompressed = {}
+    if headers.get('accept-encoding'):
+        for encoding, extension in __PRECOMPRESSED_EXTENSIONS.items():
+            if encoding in entry.missing_variants or __choose_encoding(headers, (encoding,)) is None:
+                continue
+            try:
+                if os.stat(f'{path}{extension}').st_mtime_ns >= stat.st_mtime_ns:
+                    precompressed[encoding] = extension
+            except FileNotFoundError:
+                entry.missing_variants.add(encoding)
+            except OSError:
+                pass
+
+    compressible = compression_cache is not None and __is_compressible(entry.mime_type) and \
+        __COMPRESSION_MIN_SIZE <= stat.st_size <= compression_cache.max_entry_size
+    if not precompressed and not compressible:
+        return False, None
+    # Ranges are always served from the file itself
+    if not whole:
+        return True, None
+
+    encoding = __choose_encoding(headers, precompressed)
+    if encoding is not None:
+        try:
+            file = open(f'{path}{precompressed[encoding]}', 'rb')
+        except OSError:
+            return True, None
+        # The tag changes with the precompressed file, even when it is generated again with the modification time of the
+        # file (e.g. by gzip), hence the change time
+        variant_stat = os.fstat(file.fileno())
+        version = f'+{variant_stat.st_ino:x}-{variant_stat.st_size:x}-{variant_stat.st_ctime_ns:x}'
+        return True, (encoding, file, variant_stat.st_size, version)
+
+    encoding = __choose_encoding(headers, __ENCODERS) if compressible else None
+    if encoding is None:
+        return True, None
+
+    key = str(path)
+    body = compression_cache.get(key, encoding, stat)
+    if body is None:
+        body = __compress(source if isinstance(source, bytes) else source.read(), encoding)
+        if body is None:
+            return True, None
+        compression_cache.put(key, encoding, stat, body)
+
+    # Already compressed contents don't get any smaller
+    if len(body) >= stat.st_size:
+        return True, None
+    return True, (encoding, body, len(body), '')
+
+
+# Compress a body within the CPU budget of the compression, return None when the budget is spent
+def __compress(body, encoding):
+    if not compression_cache.has_budget():
+        return None
+
+    start = time.thread_time()
+    compressed = __ENCODERS[encoding](body)
+    compression_cache.charge(time.thread_time() - start)
+    return compressed
+
+
+# Check the If-Match and If-None-Match preconditions of a write
+# The file is only hashed in the I/O threads (hash_contents), elsewhere the write is refused when it would have to be
+def __is_write_allowed(path, headers, hash_contents = True):
+    if_match = headers.get('if-match')
+    if_none_match = headers.get('if-none-match')
+    if if_match is None and if_none_match is None:
+        return True
+
+    # The tags of the compressed versions are the ones of the file
+    match_tags, none_match_tags = [], []
+    if if_match is not None:
+        match_tags = [__strip_etag_encoding(tag) for tag in __parse_etags(if_match)]
+    if if_none_match is not None:
+        none_match_tags = [__strip_etag_encoding(tag.removeprefix('W/')) for tag in __parse_etags(if_none_match)]
+
+    # The current tags of the file, the cached files also match their content hash
+    try:
+        stat = os.stat(path)
+        etags = {__get_stat_etag(stat)}
+        entry = file_cache.peek(str(path), stat) if file_cache is not None else None
+        if entry is not None:
+            etags.add(entry.headers['ETag'])
+        # The content hash tags of files evicted or cached by another worker are checked by hashing the file, only the
+        # files small enough to be cached can have one
+        elif file_cache is not None and stat.st_size <= file_cache.max_entry_size and \
+                any(__CONTENT_ETAG.fullmatch(tag) for tag in match_tags + none_match_tags):
+            if not hash_contents:
+                return False
+            etags.add(__get_file_etag(path))
+    except FileNotFoundError:
+        stat = None
+        etags = set()
+
+    # The file must exist and match one of the tags (strong comparison)
+    if if_match is not None:
+        if stat is None or ('*' not in match_tags and not etags.intersection(match_tags)):
+            return False
+
+    # The file must not exist or not match any of the tags (weak comparison)
+    if if_none_match is not None:
+        if stat is not None and ('*' in none_match_tags or etags.intersection(none_match_tags)):
+            return False
+
+    return True
+
+
+# Get the (first, last, size) of a Content-Range header (e.g. "bytes 0-499/1234"), the size is None if it is "*"
+def __parse_content_range(header):
+    unit, _, value = header.strip().partition(' ')
+    positions, _, size = value.partition('/')
+    first, dash, last = positions.partition('-')
+    try:
+        if unit.lower() != 'bytes' or not dash:
+            raise ValueError
+        first, last = int(first), int(last)
+        size = None if size.strip() == '*' else int(size)
+        if first < 0 or last < first or (size is not None and size < 0):
+            raise ValueError
+    except ValueError:
+        raise ValueError(f'Invalid Content-Range: {header!r}, it must be "bytes first-last/size" or '
+                         f'"bytes first-last/*".')
+    return first, last, size
+
+
+# Get the (first, last) byte positions requested by a Range header
+# Return None if the header should be ignored, or an empty list if no range is satisfiable
+def __parse_range(range_header, size):
+    if not range_header:
+        return None
+
+    unit, _, range_set = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    specs = range_set.split(',')
+    if len(specs) > __MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+
+        try:
+            # Suffix range (e.g. "-500" for the last 500 bytes)
+            if not first:
+                length = int(last)
+                if length < 0:
+                    return None
+                if length > 0 and size > 0:
+                    ranges.append((max(0, size - length), size - 1))
+                continue
+
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+
+        # Invalid ranges make the whole header invalid
+        if first < 0 or (last is not None and last < first):
+            return None
+        # Ranges starting after the end of the file are not satisfiable
+        if first < size:
+            ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+
+    return ranges
+
+
 def __get_content_disposition(mime, path):
     # Only return a given subset of Mime Types inline
     if mime in __INLINE_MIME_TYPES:
@@ -395,6 +4238,38 @@ def __parse_flags(path):
     parser.add_argument("-v", "--verbose", help="Activate verbose mode", action="store_true")
     parser.add_argument("-p", "--port", help="Port to open the server on", type=int, default=1773)
     parser.add_argument("-d", "--dir", help="Path to shared directory", type=pathlib.Path, default=path)
+    parser.add_argument("--keep-alive-timeout", help="Seconds an idle persistent connection is kept open",
+                        type=float, default=__KEEP_ALIVE_TIMEOUT)
+    parser.add_argument("--max-requests", help="Maximum number of requests served per connection",
+                        type=int, default=__MAX_KEEP_ALIVE_REQUESTS)
+    parser.add_argument("--cache-size", help="Bytes of file contents cached in memory (0 to disable)",
+                        type=int, default=0)
+    parser.add_argument("--cache-entry-size", help="Largest file kept in the cache (in bytes)",
+                        type=int, default=__CACHE_ENTRY_SIZE)
+    parser.add_argument("--listing-cache-size", help="Number of directory listings cached in memory (0 to disable)",
+                        type=int, default=__LISTING_CACHE_SIZE)
+    parser.add_argument("--workers", help="Number of server processes", type=int, default=1)
+    parser.add_argument("--io-threads", help="Threads running the file system operations (0 to disable)",
+                        type=int, default=__IO_THREADS)
+    parser.add_argument("--io-queue-depth", help="Maximum number of file system operations waiting for a thread",
+                        type=int, default=__IO_QUEUE_DEPTH)
+    parser.add_argument("--engine", help="Event loop driving the connections", choices=['selectors', 'asyncio'],
+                        default='selectors')
+    parser.add_argument("--access-log", help="File the requests are logged to (- for the standard output)")
+    parser.add_argument("--log-level", help="Lowest level of the records logged (verbose mode logs everything)",
+                        choices=list(AccessLog.LEVELS), default='info')
+    parser.add_argument("--log-sample-rate", help="Fraction of the requests logged", type=float, default=1.0)
+    parser.add_argument("--compression-cache-size", help="Bytes of compressed files cached in memory (0 to disable the "
+                        "compression on the fly)", type=int, default=__COMPRESSION_CACHE_SIZE)
+    parser.add_argument("--compression-cpu-share", help="Seconds of CPU per second the compression on the fly may use",
+                        type=float, default=__COMPRESSION_CPU_SHARE)
+    parser.add_argument("--index", help="Keep an index of the shared directory up to date with inotify (auto), by "
+                        "scanning it periodically (poll) or not at all (off)", choices=['auto', 'poll', 'off'],
+                        default='auto')
+    parser.add_argument("--index-poll-interval", help="Seconds between two scans of the shared directory when polling",
+                        type=float, default=TreeIndex.POLL_INTERVAL)
+    parser.add_argument("--blob-store", help="Directory the uploaded files are stored in once per contents and linked "
+                        "from (must be on the file system of the shared directory)")
 
     return parser.parse_args()
 
@@ -409,4 +4284,21 @@ if __name__ == "__main__":
     if flags.verbose:
         print(f"[ARGS] Arguments: {flags}")
 
-    start_server(__SERVER_HOST, flags.port, flags.dir, flags.verbose)
+    start_server(__SERVER_HOST, flags.port, flags.dir, flags.verbose,
+                 keep_alive_timeout=flags.keep_alive_timeout,
+                 max_requests=flags.max_requests,
+                 cache_size=flags.cache_size,
+                 cache_entry_size=flags.cache_entry_size,
+                 listing_cache_size=flags.listing_cache_size,
+                 workers=flags.workers,
+                 io_threads=flags.io_threads,
+                 io_queue_depth=flags.io_queue_depth,
+                 engine=flags.engine,
+                 access_log_path=flags.access_log,
+                 log_level=flags.log_level,
+                 log_sample_rate=flags.log_sample_rate,
+                 compression_cache_size=flags.compression_cache_size,
+                 compression_cpu_share=flags.compression_cpu_share,
+                 index=flags.index,
+                 index_poll_interval=flags.index_poll_interval,
+                 blob_store_path=flags.blob_store)
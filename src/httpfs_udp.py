@@ -7,17 +7,27 @@
 
 import argparse
 import datetime
+import functools
 import json
+import math
 import mimetypes
+import mmap
 import os
 import pathlib
+import random
 import re
 import selectors
 import socket
+import struct
 import sys
-from enum import Enum
+import time
+import types
+import uuid
+from enum import Enum, IntEnum
 from wsgiref.handlers import format_date_time
 
+from httpfs_metrics import AccessLog, Metrics
+
 
 #############################################################################################
 # Library Implementation
@@ -31,6 +41,7 @@ class HttpStatus(Enum):
     FORBIDDEN = (403, "Forbidden")
     BAD_REQUEST = (400, "Bad Request")
     NOT_FOUND = (404, "Not Found")
+    PAYLOAD_TOO_LARGE = (413, "Payload Too Large")
     INTERNAL_SERVER_ERROR = (500, "Internal Server Error")
 
 
@@ -40,10 +51,652 @@ class HttpVerb(Enum):
     POST = "POST"
 
 
+# Types of the router packets
+class PacketType(IntEnum):
+    DATA = 0
+    ACK = 1
+    SYN = 2
+    SYN_ACK = 3
+    FIN = 4
+
+
+# Datagram I/O of the router packets: the datagrams are read in batches into a ring of preallocated buffers, and the
+# packets sent are built in place in a second ring and sent in bursts
+class PacketIO:
+    # Router header: type, sequence number, peer IPv4 address and peer port (big endian)
+    HEADER = struct.Struct('!BI4sH')
+    # Largest packet accepted by the router
+    PACKET_SIZE = 1024
+    MAX_PAYLOAD = PACKET_SIZE - HEADER.size
+
+    def __init__(self, sock, batch_size):
+        self.sock = sock
+        self.receive_buffers = [memoryview(bytearray(self.PACKET_SIZE)) for _ in range(batch_size)]
+
+        # Packets built but not sent yet, as views of their send buffer and the address of the router to send them to
+        self.send_buffers = [memoryview(bytearray(self.PACKET_SIZE)) for _ in range(batch_size)]
+        self.pending = []
+
+        # Traffic counters
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+
+    # Read the datagrams waiting on the socket, up to a batch, without blocking
+    # Return (type, sequence number, peer, payload, router address) tuples, the payloads are only valid until the
+    # next call since they are views of the receive buffers
+    def receive(self):
+        packets = []
+        receive_into = self.sock.recvfrom_into
+        unpack_from = self.HEADER.unpack_from
+        header_size = self.HEADER.size
+
+        for buffer in self.receive_buffers:
+            try:
+                size, address = receive_into(buffer)
+            except BlockingIOError:
+                break
+
+            self.packets_received += 1
+            self.bytes_received += size
+            if size < header_size:
+                continue
+            packet_type, seq, peer_ip, peer_port = unpack_from(buffer)
+            packets.append((packet_type, seq, (peer_ip, peer_port), buffer[header_size:size], address))
+
+        return packets
+
+    # Build a packet in the next send buffer, it is sent with the next burst
+    def send(self, address, peer, packet_type, seq, payload):
+        if len(self.pending) == len(self.send_buffers):
+            self.flush()
+
+        buffer = self.send_buffers[len(self.pending)]
+        size = self.HEADER.size + len(payload)
+        self.HEADER.pack_into(buffer, 0, packet_type, seq, peer[0], peer[1])
+        buffer[self.HEADER.size:size] = payload
+        self.pending.append((buffer[:size], address))
+        self.packets_sent += 1
+        self.bytes_sent += size
+
+    # Send the packets built since the last burst
+    def flush(self):
+        send_to = self.sock.sendto
+        for packet, address in self.pending:
+            try:
+                send_to(packet, address)
+            except BlockingIOError:
+                # A full socket buffer is a loss the transport recovers from
+                pass
+        self.pending.clear()
+
+
+# Selective repeat ARQ over the router packets, each side sends one message (a request, then its response)
+# The connection doesn't do any I/O: the packets are given to receive() and sent through the transmit callback,
+# called with the type, sequence number and payload of each packet
+class ReliableConnection:
+    MAX_PAYLOAD = PacketIO.MAX_PAYLOAD
+    # Payloads of the handshake and acknowledgements: the receive window advertised, the acknowledgement of the SYN,
+    # the packet the ACK answers (to sample the RTT) and the selective ACK blocks of out-of-order packets received
+    # (first and last sequence numbers)
+    # A first block below the cumulative acknowledgement or inside another block reports a duplicate (D-SACK)
+    SYN_PAYLOAD = struct.Struct('!H')
+    SYN_ACK_PAYLOAD = struct.Struct('!IH')
+    ACK_PAYLOAD = struct.Struct('!HI')
+    SACK_BLOCK = struct.Struct('!II')
+    MAX_SACK_BLOCKS = 64
+    # Number of packets buffered out of order by the receiver
+    RECEIVE_WINDOW = 256
+    # Congestion window bounds in packets
+    INITIAL_CWND = 10
+    MIN_CWND = 2
+    # Retransmission timeout bounds in seconds, and the weights of the RTT estimator (RFC 6298)
+    INITIAL_RTO = 0.25
+    MIN_RTO = 0.05
+    MAX_RTO = 2.0
+    RTT_ALPHA = 0.125
+    RTT_BETA = 0.25
+    # Number of packets sent after a packet and acknowledged before it is considered lost (duplicate ACKs)
+    # The threshold grows up to MAX_REORDERING when packets sent again turn out to have been reordered
+    DUPLICATE_ACKS = 3
+    MAX_REORDERING = 128
+    # A packet is also lost when a packet sent after it was acknowledged and it is late by a quarter of the smoothed
+    # RTT, scaled up to MAX_REORDER_SCALE quarters when packets sent again turn out to have been reordered (RACK)
+    MAX_REORDER_SCALE = 16
+    # Number of times a packet is sent again before the peer is considered gone
+    MAX_RETRANSMITS = 20
+
+    def __init__(self, peer, transmit, rtt_estimate = None, receive_window = RECEIVE_WINDOW, max_message_size = None):
+        # Address of the application at the other end of the router and callback sending a packet
+        self.peer = peer
+        self.transmit = transmit
+        self.established = False
+        self.last_received = None
+
+        # Sending side: packets sent but not acknowledged by sequence number,
+        # as [(type, sequence number, payload), deadline, transmissions, time of the last transmission]
+        self.next_seq = random.getrandbits(31)
+        self.unacked = {}
+        self.outgoing = None
+        self.outgoing_offset = 0
+        self.sent = False
+
+        # Flow control: highest cumulative acknowledgement and window advertised by the peer
+        self.peer_ack = self.next_seq
+        self.peer_window = self.MIN_CWND
+
+        # Congestion control: window in packets, slow start threshold and the sequence number ending the current
+        # recovery (the window is only reduced once for the losses of a same window of packets)
+        self.cwnd = self.INITIAL_CWND
+        self.ssthresh = receive_window
+        self.recovery_seq = 0
+        # Loss detection: duplicate ACK threshold and reordering window scale, time of the last transmission of the
+        # latest packet acknowledged, packets fast retransmitted (reported by the peer if they were received twice)
+        # and the window before the last reduction
+        self.reordering = self.DUPLICATE_ACKS
+        self.reorder_scale = 1
+        self.latest_delivered = 0
+        self.fast_retransmitted = {}
+        self.undo = None
+
+        # RTT estimation, starting from the estimate of a previous connection to the same peer if there is one
+        # Karn's rule: only the packets sent once give an unambiguous sample, their send time is kept until answered
+        self.send_times = {}
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.INITIAL_RTO
+        if rtt_estimate is not None:
+            self.srtt, self.rttvar = rtt_estimate
+            self.__update_rto()
+
+        # Counters to tune the transport
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.fast_retransmits = 0
+        self.spurious_retransmits = 0
+        self.timeouts = 0
+
+        # Receiving side: next sequence number expected in order and packets received out of order
+        self.receive_window = receive_window
+        self.expected = None
+        self.out_of_order = {}
+        self.message = bytearray()
+        self.message_complete = False
+        # The message received is dropped past this size (the segments are still acknowledged)
+        self.max_message_size = max_message_size
+        self.message_too_large = False
+
+    # Start the handshake as the client
+    def connect(self, now):
+        self.last_received = now
+        self.__send_reliably(PacketType.SYN, self.SYN_PAYLOAD.pack(self.receive_window), now)
+
+    # Answer the handshake of a client as the server
+    def accept(self, seq, payload, now):
+        self.last_received = now
+        self.expected = seq + 1
+        self.established = True
+        if len(payload) >= self.SYN_PAYLOAD.size:
+            self.peer_window = self.SYN_PAYLOAD.unpack_from(payload)[0]
+        self.__send_reliably(PacketType.SYN_ACK, self.SYN_ACK_PAYLOAD.pack(self.expected, self.receive_window), now)
+
+    # Send a message of any size, segmented into packets and terminated by a FIN packet
+    # The message is given as a list of buffers (the packets never span two of them), whose views are sent as they are
+    def send_message(self, parts, now):
+        self.outgoing = [memoryview(part) for part in parts if len(part)]
+        self.outgoing_offset = 0
+        self.__fill_window(now)
+
+    # Determine if the whole message sent was acknowledged by the peer
+    def is_acknowledged(self):
+        return self.sent and not self.unacked
+
+    # Forget the packets not acknowledged and the rest of the message, so the buffers they are views of can be released
+    def close(self):
+        for part in self.outgoing or ():
+            part.release()
+        self.outgoing = None
+        self.unacked.clear()
+
+    # Smoothed RTT and its variation, to start the next connection to the peer with
+    def rtt_estimate(self):
+        return None if self.srtt is None else (self.srtt, self.rttvar)
+
+    # Congestion control and retransmission state of the connection
+    def stats(self):
+        return {
+            'cwnd': round(self.cwnd, 2),
+            'ssthresh': round(self.ssthresh, 2),
+            'peer_window': self.peer_window,
+            'srtt': None if self.srtt is None else round(self.srtt, 4),
+            'rttvar': None if self.rttvar is None else round(self.rttvar, 4),
+            'rto': round(self.rto, 4),
+            'packets_sent': self.packets_sent,
+            'retransmits': self.retransmits,
+            'fast_retransmits': self.fast_retransmits,
+            'spurious_retransmits': self.spurious_retransmits,
+            'reordering': self.reordering,
+            'reorder_scale': self.reorder_scale,
+            'timeouts': self.timeouts
+        }
+
+    # Handle a packet received from the peer
+    def receive(self, packet_type, seq, payload, now):
+        self.last_received = now
+
+        if packet_type == PacketType.ACK:
+            if len(payload) >= self.ACK_PAYLOAD.size:
+                self.__acknowledge(seq, *self.ACK_PAYLOAD.unpack_from(payload), payload, now)
+
+        elif packet_type == PacketType.DATA or packet_type == PacketType.FIN:
+            if self.expected is not None:
+                self.__receive_segment(packet_type, seq, payload)
+
+        elif packet_type == PacketType.SYN_ACK:
+            # The SYN was received, the server stream starts after the SYN-ACK sequence number
+            if self.expected is None and len(payload) >= self.SYN_ACK_PAYLOAD.size:
+                self.expected = seq + 1
+                ack, window = self.SYN_ACK_PAYLOAD.unpack_from(payload)
+                self.__acknowledge(ack, window, ack - 1, b'', now)
+            self.__send_ack(seq)
+            if not self.established:
+                self.established = True
+                self.__fill_window(now)
+
+        elif packet_type == PacketType.SYN:
+            # The SYN-ACK was lost, send it again right away
+            syn_ack_seq = next(iter(self.unacked), None)
+            if seq + 1 == self.expected and syn_ack_seq is not None:
+                self.__retransmit(syn_ack_seq, self.unacked[syn_ack_seq], now)
+
+    # Send the packets again when their acknowledgement takes too long
+    def on_timer(self, now):
+        for seq, entry in self.unacked.items():
+            if entry[1] > now:
+                continue
+            if entry[2] > self.MAX_RETRANSMITS:
+                raise ConnectionError(f'No acknowledgement received from {self.peer} for packet {seq}')
+
+            # Packets sent after it were acknowledged in the meantime, it was lost rather than delayed
+            if entry[3] < self.latest_delivered:
+                self.__retransmit_lost(seq, entry, 0, now)
+                continue
+
+            # Restart from slow start and back off the timeout (Karn's rule keeps it until a new sample)
+            if seq >= self.recovery_seq:
+                self.recovery_seq = self.next_seq
+                self.ssthresh = max(len(self.unacked) / 2, self.MIN_CWND)
+                self.cwnd = 1
+                self.rto = min(self.rto * 2, self.MAX_RTO)
+                self.undo = None
+                self.timeouts += 1
+
+            self.__retransmit(seq, entry, now)
+
+    # Time at which the next packet must be sent again (None when everything is acknowledged)
+    def next_deadline(self):
+        return min((entry[1] for entry in self.unacked.values()), default=None)
+
+    # Send a packet that will be sent again until it is acknowledged
+    def __send_reliably(self, packet_type, payload, now):
+        packet = (packet_type, self.next_seq, payload)
+        self.unacked[self.next_seq] = [packet, now + self.rto, 1, now]
+        self.send_times[self.next_seq] = now
+        if len(self.send_times) > 2 * self.RECEIVE_WINDOW:
+            del self.send_times[next(iter(self.send_times))]
+        self.next_seq += 1
+        self.packets_sent += 1
+        self.transmit(*packet)
+
+    def __retransmit(self, seq, entry, now):
+        self.send_times.pop(seq, None)
+        entry[1] = now + self.rto
+        entry[2] += 1
+        entry[3] = now
+        self.packets_sent += 1
+        self.retransmits += 1
+        self.transmit(*entry[0])
+
+    # Send the next segments of the message while the congestion and receive windows allow it
+    def __fill_window(self, now):
+        if not self.established:
+            return
+
+        while self.outgoing is not None:
+            if len(self.unacked) >= self.cwnd or self.next_seq >= self.peer_ack + self.peer_window:
+                break
+
+            # The end of the message is marked by an empty FIN packet
+            if self.outgoing:
+                part = self.outgoing[0]
+                segment = part[self.outgoing_offset:self.outgoing_offset + self.MAX_PAYLOAD]
+                self.outgoing_offset += len(segment)
+                if self.outgoing_offset == len(part):
+                    self.outgoing.pop(0).release()
+                    self.outgoing_offset = 0
+                self.__send_reliably(PacketType.DATA, segment, now)
+            else:
+                self.__send_reliably(PacketType.FIN, b'', now)
+                self.outgoing = None
+                self.sent = True
+
+    # Forget the packets acknowledged cumulatively (below seq) or selectively (in the SACK blocks)
+    def __acknowledge(self, seq, window, answered, payload, now):
+        # Sample the RTT with the packet the ACK answers, even when an ACK overtaking this one acknowledged it
+        sent_at = self.send_times.pop(answered, None)
+        if sent_at is not None:
+            self.__sample_rtt(now - sent_at)
+
+        # Ignore the acknowledgements overtaken by more recent ones
+        if seq < self.peer_ack:
+            return
+        self.peer_ack = seq
+        self.peer_window = window
+
+        blocks = [self.SACK_BLOCK.unpack_from(payload, offset) for offset in
+                  range(self.ACK_PAYLOAD.size, len(payload) - self.SACK_BLOCK.size + 1, self.SACK_BLOCK.size)]
+
+        # The peer received a packet twice, the fast retransmission was caused by reordering and not by a loss
+        if blocks and (blocks[0][1] < seq or any(first <= blocks[0][0] <= last for first, last in blocks[1:])):
+            self.__undo_retransmit(blocks.pop(0)[0])
+
+        acknowledged = 0
+        for sent_seq in list(self.unacked):
+            if sent_seq < seq or any(first <= sent_seq <= last for first, last in blocks):
+                entry = self.unacked.pop(sent_seq)
+                acknowledged += 1
+                self.latest_delivered = max(self.latest_delivered, entry[3])
+
+        # Grow the window exponentially in slow start, then by one packet per window (AIMD)
+        for _ in range(acknowledged):
+            self.cwnd += 1 if self.cwnd < self.ssthresh else 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.RECEIVE_WINDOW)
+
+        self.__detect_losses(now)
+        self.__fill_window(now)
+
+    # Send again the lost packets without waiting for their timeout
+    def __detect_losses(self, now):
+        remaining = len(self.unacked)
+        rtt = self.srtt or self.rto
+        # The reordering window never waits past the retransmission timeout
+        reorder_window = min(self.reorder_scale * rtt / 4, max(self.rto - rtt, 0))
+
+        for index, (seq, entry) in enumerate(self.unacked.items()):
+            # Only the packets sent before a packet that was acknowledged can be lost
+            if entry[3] >= self.latest_delivered:
+                continue
+
+            # Packets sent after this one that aren't waiting for an acknowledgement anymore (duplicate ACKs)
+            acknowledged_after = self.next_seq - seq - remaining + index
+            deadline = entry[3] + rtt + reorder_window
+
+            if (entry[2] == 1 and acknowledged_after >= self.reordering) or deadline <= now:
+                self.__retransmit_lost(seq, entry, acknowledged_after, now)
+            elif deadline < entry[1]:
+                # Check again once the packets sent around it had the time to arrive
+                entry[1] = deadline
+
+    def __retransmit_lost(self, seq, entry, acknowledged_after, now):
+        # Halve the window (multiplicative decrease) once per window of packets
+        if seq >= self.recovery_seq:
+            self.undo = (seq, self.cwnd, self.ssthresh)
+            self.recovery_seq = self.next_seq
+            self.ssthresh = max(len(self.unacked) / 2, self.MIN_CWND)
+            self.cwnd = self.ssthresh
+
+        if entry[2] == 1:
+            self.fast_retransmitted[seq] = acknowledged_after
+            if len(self.fast_retransmitted) > self.receive_window:
+                del self.fast_retransmitted[next(iter(self.fast_retransmitted))]
+
+        self.fast_retransmits += 1
+        self.__retransmit(seq, entry, now)
+
+    # Wait for more packets before considering one lost, and restore the window if it was reduced because of it
+    def __undo_retransmit(self, seq):
+        acknowledged_after = self.fast_retransmitted.pop(seq, None)
+        if acknowledged_after is None:
+            return
+
+        self.spurious_retransmits += 1
+        self.reordering = min(max(self.reordering, acknowledged_after + 1), self.MAX_REORDERING)
+        self.reorder_scale = min(self.reorder_scale + 1, self.MAX_REORDER_SCALE)
+
+        if self.undo is not None and self.undo[0] == seq:
+            self.cwnd = max(self.cwnd, self.undo[1])
+            self.ssthresh = max(self.ssthresh, self.undo[2])
+            self.undo = None
+
+    # Update the smoothed RTT and its variation (Jacobson/Karels)
+    def __sample_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - self.RTT_BETA) * self.rttvar + self.RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - self.RTT_ALPHA) * self.srtt + self.RTT_ALPHA * sample
+        self.__update_rto()
+
+    def __update_rto(self):
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    # Buffer a segment and deliver the segments received in order
+    def __receive_segment(self, packet_type, seq, payload):
+        # Report the segments received twice so the peer can tell reordering from losses
+        if seq < self.expected or seq in self.out_of_order:
+            self.__send_ack(seq, True)
+            return
+
+        if seq < self.expected + self.receive_window and not self.message_complete:
+            self.out_of_order[seq] = (packet_type, bytes(payload))
+
+            while self.expected in self.out_of_order:
+                packet_type, payload = self.out_of_order.pop(self.expected)
+                self.expected += 1
+                if packet_type == PacketType.FIN:
+                    self.message_complete = True
+                    self.out_of_order.clear()
+                    break
+
+                if self.max_message_size is not None and len(self.message) + len(payload) > self.max_message_size:
+                    self.message_too_large = True
+                    self.message = bytearray()
+                if not self.message_too_large:
+                    self.message += payload
+
+        # Acknowledge every segment, duplicates included since the previous ACK may have been lost
+        self.__send_ack(seq)
+
+    # Send the cumulative acknowledgement, the free space of the receive buffer and the ranges received out of order
+    def __send_ack(self, answered, duplicate = False):
+        blocks = [[answered, answered]] if duplicate else []
+        for seq in sorted(self.out_of_order):
+            if len(blocks) > duplicate and blocks[-1][1] == seq - 1:
+                blocks[-1][1] = seq
+            elif len(blocks) < self.MAX_SACK_BLOCKS:
+                blocks.append([seq, seq])
+
+        payload = self.ACK_PAYLOAD.pack(self.receive_window - len(self.out_of_order), answered) + \
+            b''.join(self.SACK_BLOCK.pack(first, last) for first, last in blocks)
+        self.transmit(PacketType.ACK, self.expected, payload)
+
+
+# Counters and latency histograms of the server, with the sessions and the traffic of its transport
+class SessionMetrics(Metrics):
+    # Stages of a session: receiving the request, building its response and sending the response until acknowledged
+    STAGES = ('receive', 'handle', 'send')
+    STAGES_HELP = 'Time spent receiving requests, building and sending responses.'
+    RECEIVE = 0
+    HANDLE = 1
+    SEND = 2
+    # Labels of the request counters, the unknown verbs are counted together
+    VERBS = tuple(verb.value for verb in HttpVerb) + ('OTHER',)
+    STATUSES = tuple(status.value[0] for status in HttpStatus)
+
+    def __init__(self):
+        super().__init__()
+        self.sessions = 0
+        self.sessions_opened = 0
+        self.sessions_dropped = 0
+        # Transport counters of the closed sessions
+        self.retransmits = 0
+        self.fast_retransmits = 0
+        self.spurious_retransmits = 0
+        # Datagram I/O of the server, for its traffic counters
+        self.packet_io = None
+        # Log of the server, for its drop counters
+        self.access_log = None
+
+    # Add the transport counters of a closed session
+    def count_transport(self, stats):
+        self.retransmits += stats['retransmits']
+        self.fast_retransmits += stats['fast_retransmits']
+        self.spurious_retransmits += stats['spurious_retransmits']
+
+    def values(self):
+        values = [
+            ('httpfs_open_sessions', 'gauge', 'Transfers in progress.', self.sessions),
+            ('httpfs_sessions_total', 'counter', 'Transfers started.', self.sessions_opened),
+            ('httpfs_sessions_dropped_total', 'counter', 'Transfers dropped after the client went silent.',
+             self.sessions_dropped),
+            ('httpfs_retransmits_total', 'counter', 'Packets sent again by the closed sessions.', self.retransmits),
+            ('httpfs_fast_retransmits_total', 'counter', 'Packets sent again before their timeout by the closed '
+             'sessions.', self.fast_retransmits),
+            ('httpfs_spurious_retransmits_total', 'counter', 'Packets sent again needlessly by the closed sessions.',
+             self.spurious_retransmits)
+        ]
+        if self.packet_io is not None:
+            values += [
+                ('httpfs_received_packets_total', 'counter', 'Datagrams received.', self.packet_io.packets_received),
+                ('httpfs_received_bytes_total', 'counter', 'Bytes of the datagrams received.',
+                 self.packet_io.bytes_received),
+                ('httpfs_sent_packets_total', 'counter', 'Datagrams sent.', self.packet_io.packets_sent),
+                ('httpfs_sent_bytes_total', 'counter', 'Bytes of the datagrams sent.', self.packet_io.bytes_sent)
+            ]
+        if self.access_log is not None:
+            stats = self.access_log.stats()
+            values += [
+                ('httpfs_log_dropped_total', 'counter', 'Log records dropped because the buffer was full.',
+                 stats['dropped']),
+                ('httpfs_log_sampled_out_total', 'counter', 'Requests not logged because of the sampling.',
+                 stats['sampled_out'])
+            ]
+        return values
+
+
+# Read-only memory maps of the files sent, shared by the sessions sending the same version of a file
+# The packets are views of the mapping, so sending them again never reads or copies the file
+class FileMappings:
+    def __init__(self):
+        # Mappings by file version (path, inode, modification time and size) and by id of the mapping,
+        # as [version, mapping, references]
+        self.entries = {}
+        self.mapped = {}
+
+    # Map a file, or share the mapping of the sessions already sending it
+    def acquire(self, path):
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            # Empty files can't be mapped
+            if not stat.st_size:
+                return b''
+
+            version = (str(path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            entry = self.entries.get(version)
+            if entry is None:
+                entry = [version, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), 0]
+                self.entries[version] = entry
+                self.mapped[id(entry[1])] = entry
+
+        entry[2] += 1
+        return entry[1]
+
+    # Give back a mapping, it is unmapped once no session uses it anymore
+    def release(self, mapping):
+        entry = self.mapped[id(mapping)]
+        entry[2] -= 1
+        if entry[2]:
+            return
+
+        del self.entries[entry[0]]
+        del self.mapped[id(mapping)]
+        try:
+            mapping.close()
+        except BufferError:
+            # Views of the mapping are still alive, it is unmapped when the last one is freed
+            pass
+
+
+# Hashed timing wheel: the items scheduled are stored in the slot of their tick and expire when the wheel reaches it
+# Scheduling and expiring are O(1) per item whatever the number of sessions waiting for a timeout
+class TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+        self.count = 0
+
+    # Schedule an item to expire at the given time (rounded up to the next tick)
+    def schedule(self, item, deadline):
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+
+    # Remove and return the items whose tick has been reached
+    def expire(self, now):
+        target = int(now / self.tick)
+        expired = []
+
+        # Items more than one turn ahead stay in their slot until their own turn
+        for step in range(1, min(target - self.current, len(self.slots)) + 1):
+            index = (self.current + step) % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+
+            remaining = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[index] = remaining
+
+        self.current = max(self.current, target)
+        self.count -= len(expired)
+        return expired
+
+    # Seconds until the next tick, or None when nothing is scheduled
+    def timeout(self, now):
+        if not self.count:
+            return None
+        return max((self.current + 1) * self.tick - now, 0)
+
+
 # Default server host
 __SERVER_HOST = 'localhost'
-# Socket buffer size
-__BUFFER_SIZE = 1024
+# Default address of the router relaying the packets
+__ROUTER_HOST = 'localhost'
+__ROUTER_PORT = 3000
+# Seconds without any packet from the peer before a session is dropped
+__SESSION_TIMEOUT = 10
+# Maximum number of transfers in progress, and size of the request buffered by each of them
+__MAX_SESSIONS = 512
+__MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# Size of the socket buffers shared by all the sessions
+__SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Number of datagrams read from the socket before the timers are checked (and of packets sent in a burst)
+__RECEIVE_BATCH = 256
+__CLIENT_BATCH = 64
+# Resolution in seconds and number of slots of the retransmission timer wheel
+__TIMER_TICK = 0.005
+__TIMER_SLOTS = 1024
+# Number of client hosts whose RTT estimate is kept between connections
+__MAX_RTT_ESTIMATES = 1024
+# Reserved path of the metrics of the server, served without touching the file system
+__METRICS_PATH = '/_metrics'
 # Mime types to return inline
 __INLINE_MIME_TYPES = [
     'text/css',
@@ -59,91 +712,366 @@ __INLINE_MIME_TYPES = [
 
 # Allow multi-connections
 selector = selectors.DefaultSelector()
+# Counters and histograms of the server
+metrics = SessionMetrics()
+# Log of the requests written in the background (None when disabled)
+access_log = None
 
 
 # Initialize the server on the sockets
-def start_server(host, port, path, verbose = False):
+def start_server(host, port, path, verbose = False, max_sessions = __MAX_SESSIONS,
+                 max_request_size = __MAX_REQUEST_SIZE, session_timeout = __SESSION_TIMEOUT, access_log_path = None,
+                 log_level = 'info', log_sample_rate = 1.0):
+    global access_log
+
     # Open the socket
     listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     try:
         # Start the server
         listener.bind((host, port))
+        listener.setblocking(False)
+        # Absorb the bursts of every session between two reads (the kernel caps it to net.core.*mem_max)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, __SOCKET_BUFFER_SIZE)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, __SOCKET_BUFFER_SIZE)
+        selector.register(listener, selectors.EVENT_READ)
 
         if verbose:
             # noinspection HttpUrlsUsage
             print(f'[INIT] HTTP File System server is listening at http://{host}:{port}\n')
 
-        # Listen to connections
+        # The verbose messages go through the log too, to the standard output unless a file is given
+        access_log_path = access_log_path or ('-' if verbose else None)
+        if access_log_path is not None:
+            stream = sys.stdout if access_log_path == '-' else open(access_log_path, 'a')
+            access_log = AccessLog(stream, AccessLog.DEBUG if verbose else AccessLog.LEVELS[log_level],
+                                   log_sample_rate)
+            metrics.access_log = access_log
+
+        # Every transfer in progress is a session of the table, keyed by the address of its client
+        server = types.SimpleNamespace(
+            io=PacketIO(listener, __RECEIVE_BATCH),
+            mappings=FileMappings(),
+            path=path,
+            verbose=verbose,
+            sessions={},
+            timers=TimerWheel(__TIMER_TICK, __TIMER_SLOTS),
+            rtt_estimates={},
+            max_sessions=max_sessions,
+            max_request_size=max_request_size,
+            session_timeout=session_timeout
+        )
+        metrics.packet_io = server.io
+
         while True:
-            response, connection = __receive_connection(listener, path, verbose)
+            events = selector.select(timeout=server.timers.timeout(time.monotonic()))
+            if events:
+                __receive_packets(server)
 
-            listener.sendto(response, connection)
+            # Send the packets again and drop the idle sessions
+            now = time.monotonic()
+            for session, deadline in server.timers.expire(now):
+                if not session.closed and session.deadline == deadline:
+                    __expire_session(server, session, now)
 
-            if verbose:
-                # noinspection HttpUrlsUsage
-                print(f'[CLIENT] Response sent to {connection}\n')
+            # Send everything the sessions built in one burst
+            server.io.flush()
 
     finally:
         # Always close the socket
+        selector.close()
         listener.close()
+        # Write the last records of the log
+        if access_log is not None:
+            access_log.close()
 
-# Handler for client connections
-def __receive_connection(sock, path, verbose):
-    # Receive the byte array
-    headers, body, connection = __receive_data(sock, verbose)
-    # Build a proper HTTP response from the request
-    response = __build_response(headers, body, path, verbose)
-    # Return the response back to the client
-    if verbose:
-        print("[CONNECTION] Connection received")
-    return response, connection
 
+# Send a request to a server through the router and return its response
+def send_request(request, host, port, router_host = __ROUTER_HOST, router_port = __ROUTER_PORT,
+                 timeout = __SESSION_TIMEOUT):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    readable = selectors.DefaultSelector()
+    readable.register(sock, selectors.EVENT_READ)
 
-# Receive the byte array from the client connection
-def __receive_data(sock, verbose):
-    # Read the socket data byte by byte until we reach the end of the headers
-    data, address = sock.recvfrom(__BUFFER_SIZE)
+    try:
+        router = (socket.gethostbyname(router_host), router_port)
+        address = (socket.gethostbyname(host), port)
+        peer = (socket.inet_aton(address[0]), port)
 
-    body_index = 0
-    headers_buffer = b''
-    for byte in data:
-        if b'\r\n\r\n' in headers_buffer:
-            break
-        headers_buffer += byte.to_bytes(1, sys.byteorder)
-        body_index += 1
+        packet_io = PacketIO(sock, __CLIENT_BATCH)
+        connection = ReliableConnection(address, functools.partial(packet_io.send, router, peer))
 
-    # Get the request body
-    body_buffer = b''
-    if len(data) > body_index:
-        body_buffer = data[body_index:]
+        now = time.monotonic()
+        connection.connect(now)
+        connection.send_message([request], now)
+        packet_io.flush()
 
-    # Get a string from the header bytes without the empty lines
-    header_data = headers_buffer[:-4].decode()
+        while not connection.message_complete:
+            __exchange_packets(packet_io, readable, peer, connection, timeout)
 
-    # Ignore the HTTP Version and Request Status
-    header_strings = header_data.splitlines()[1:]
+        # Acknowledge the FIN again if the server didn't get the last ACK
+        while readable.select(connection.rto):
+            __receive_from_peer(packet_io, peer, connection)
+            packet_io.flush()
 
-    # Build a dictionary from the string
-    header_dictionary = {}
-    for string in header_strings:
-        header = string.split(': ')
-        header_dictionary[header[0]] = header[1]
+        return bytes(connection.message)
 
-    if verbose:
-        # noinspection HttpUrlsUsage
-        print(f'[DATA] Data received from {address}')
+    finally:
+        readable.close()
+        sock.close()
+
+
+# Read the datagrams waiting on the socket and hand them to their sessions
+def __receive_packets(server):
+    now = time.monotonic()
+    updated = {}
+
+    # Read a bounded batch so the timers of the other sessions are not delayed by a flood
+    for packet_type, seq, peer, payload, router in server.io.receive():
+        session = server.sessions.get(peer)
+        if session is not None:
+            session.connection.receive(packet_type, seq, payload, now)
+            updated[peer] = session
+
+        # Only a handshake opens a session, the other packets belong to sessions already closed
+        elif packet_type == PacketType.SYN:
+            session = __open_session(server, peer, router, seq, payload, now)
+            if session is not None:
+                updated[peer] = session
+
+    for session in updated.values():
+        if not session.closed:
+            __advance_session(server, session, now)
+
+
+# Add a session for a new client (unless the table is full, the client will try again)
+def __open_session(server, peer, router, seq, payload, now):
+    if len(server.sessions) >= server.max_sessions:
+        if server.verbose:
+            __log(f'[CONNECTION] Too many sessions, connection from {socket.inet_ntoa(peer[0])}:{peer[1]} ignored')
+        return None
+
+    # Reply through the router the packet came from
+    address = (socket.inet_ntoa(peer[0]), peer[1])
+    connection = ReliableConnection(address, functools.partial(server.io.send, router, peer),
+                                    server.rtt_estimates.get(address[0]), max_message_size=server.max_request_size)
+    connection.accept(seq, payload, now)
+
+    # The table is keyed by the raw address from the packet header
+    session = types.SimpleNamespace(
+        key=peer,
+        peer=address,
+        connection=connection,
+        responding=False,
+        response=[],
+        closed=False,
+        deadline=math.inf,
+        opened=now,
+        response_started=None,
+        # Request answered and status of its response, for the access log
+        request=None,
+        status=None
+    )
+    server.sessions[peer] = session
+    metrics.sessions += 1
+    metrics.sessions_opened += 1
+
+    if server.verbose:
+        __log(f'[CONNECTION] Connection received from {address}')
+    return session
+
+
+# Move a session forward after it received packets or its timer expired
+def __advance_session(server, session, now):
+    connection = session.connection
+
+    # Reply once the whole request was received (or as soon as it is too large to be buffered)
+    if not session.responding and (connection.message_complete or connection.message_too_large):
+        session.responding = True
+        metrics.observe(SessionMetrics.RECEIVE, now - session.opened)
+        start = time.perf_counter()
+        if connection.message_too_large:
+            session.status = HttpStatus.PAYLOAD_TOO_LARGE.value
+            response = __build_error_response(HttpStatus.PAYLOAD_TOO_LARGE, 'The request is too large.',
+                                              f'The limit is {server.max_request_size} bytes.')
+        else:
+            if server.verbose:
+                __log(f'[DATA] Data received from {session.peer}')
+            session.request, session.status, response = __respond(connection.message, server.path, server.mappings,
+                                                                  server.verbose)
+        metrics.observe(SessionMetrics.HANDLE, time.perf_counter() - start)
+        session.response = response
+        session.response_started = now
+        connection.send_message(response, now)
+
+    # The client got the whole response
+    if session.responding and connection.is_acknowledged():
+        metrics.observe(SessionMetrics.SEND, now - session.response_started)
+        if server.verbose:
+            __log(f'[CLIENT] Response sent to {session.peer}')
+        # The transfer is logged once acknowledged, from the handshake of the client
+        if access_log is not None:
+            request = session.request or {}
+            access_log.access(session.peer, request.get('verb'), request.get('path'), session.status[0],
+                              len(session.response[1]), now - session.opened)
+        __close_session(server, session)
+        return
+
+    # Wake up for the next retransmission, or when the client has been silent for too long
+    deadline = min(connection.next_deadline() or math.inf, connection.last_received + server.session_timeout)
+    if deadline < session.deadline:
+        session.deadline = deadline
+        server.timers.schedule((session, deadline), deadline)
+
+
+# Handle the timer of a session: drop it if the client is gone, otherwise send its packets again
+def __expire_session(server, session, now):
+    connection = session.connection
+    session.deadline = math.inf
+
+    try:
+        if now >= connection.last_received + server.session_timeout:
+            raise ConnectionError(f'Nothing received for {server.session_timeout} seconds')
+        connection.on_timer(now)
+    except ConnectionError as e:
+        if server.verbose:
+            __log(f'[CONNECTION] Connection to {session.peer} dropped: {e}')
+        metrics.sessions_dropped += 1
+        __close_session(server, session)
+        return
+
+    __advance_session(server, session, now)
 
-    return headers_buffer, body_buffer, address
 
+# Remove a session from the table, remembering the RTT of the client for its next connection
+def __close_session(server, session):
+    session.closed = True
+    del server.sessions[session.key]
+    metrics.sessions -= 1
+    metrics.count_transport(session.connection.stats())
 
-# Build a proper HTTP response
-def __build_response(headers, body, path, verbose):
+    # Release the mapped files once the connection dropped its views of them
+    session.connection.close()
+    for part in session.response:
+        if isinstance(part, mmap.mmap):
+            server.mappings.release(part)
+
+    if server.verbose:
+        __log(f'[TRANSPORT] {session.peer}: {session.connection.stats()}')
+
+    estimate = session.connection.rtt_estimate()
+    if estimate is not None:
+        if len(server.rtt_estimates) >= __MAX_RTT_ESTIMATES:
+            del server.rtt_estimates[next(iter(server.rtt_estimates))]
+        server.rtt_estimates[session.peer[0]] = estimate
+
+
+# Handle the next packets of the peer, or send the packets again when nothing arrives in time
+def __exchange_packets(packet_io, readable, peer, connection, timeout):
+    now = time.monotonic()
+    idle_deadline = connection.last_received + timeout
+    if now >= idle_deadline:
+        raise ConnectionError(f'Nothing received from {connection.peer} for {timeout} seconds')
+
+    # Wait until the next retransmission is due at most
+    deadline = connection.next_deadline()
+    wait = min(idle_deadline, deadline or idle_deadline) - now
+
+    if wait > 0 and readable.select(wait):
+        __receive_from_peer(packet_io, peer, connection)
+
+    connection.on_timer(time.monotonic())
+    packet_io.flush()
+
+
+# Read the datagrams waiting on the socket and give the ones from the peer to the connection
+def __receive_from_peer(packet_io, peer, connection):
+    now = time.monotonic()
+    for packet_type, seq, sender, payload, _ in packet_io.receive():
+        if sender == peer:
+            connection.receive(packet_type, seq, payload, now)
+
+
+# Split a request message into its headers and its body
+def __split_request(message):
+    body_index = message.find(b'\r\n\r\n')
+    if body_index < 0:
+        return bytes(message), b''
+
+    return bytes(message[:body_index + 4]), bytes(message[body_index + 4:])
+
+
+# Write the debug messages to the log, or to the standard output without one
+def __log(message):
+    if access_log is not None:
+        access_log.debug(message)
+    else:
+        print(message)
+
+
+# Build the response of a request message, or an error response if it can't be parsed
+# Return the request (None if it can't be parsed), the status of the response and the parts of the response
+def __respond(message, path, mappings, verbose):
+    headers, body = __split_request(message)
+
+    try:
+        return __build_response(headers, body, path, mappings, verbose)
+    except (ValueError, UnicodeDecodeError) as e:
+        return None, HttpStatus.BAD_REQUEST.value, __build_error_response(
+            HttpStatus.BAD_REQUEST, 'The request could not be parsed.', str(e))
+
+
+# Build a proper HTTP response, return the request, the status and the parts of the response
+def __build_response(headers, body, path, mappings, verbose):
     # Get a request dictionary from the raw request
     request = __parse_request(headers.decode(), verbose)
-    # Handle the request appropriately
-    response = __handle_request(request, body, path)
+    # Handle the request appropriately (the metrics are served without touching the file system)
+    if request['path'] == __METRICS_PATH:
+        response = __build_metrics_response(request)
+    else:
+        response = __handle_request(request, body, path, mappings, verbose)
+    metrics.count_request(request['verb'], response['response_status'])
+
+    return request, response['response_status'], __encode_response(response, verbose)
+
+
+# Serve the metrics of the server
+def __build_metrics_response(request):
+    if request['verb'] != HttpVerb.GET.value:
+        return {
+            'content_type': 'application/json;charset=utf-8',
+            'content_disposition': 'inline',
+            'response_status': HttpStatus.BAD_REQUEST.value,
+            'response_body': json.dumps({
+                'error': 'The metrics can only be read with GET.'
+            }).encode()
+        }
+
+    return {
+        'content_type': 'text/plain; version=0.0.4;charset=utf-8',
+        'content_disposition': 'inline',
+        'response_status': HttpStatus.OK.value,
+        'response_body': metrics.render()
+    }
 
+
+# Build a JSON error response
+def __build_error_response(status, error, details):
+    metrics.count_request(None, status.value)
+    return __encode_response({
+        'content_type': 'application/json;charset=utf-8',
+        'content_disposition': 'inline',
+        'response_status': status.value,
+        'response_body': json.dumps({
+            'error': error,
+            'details': details
+        }).encode()
+    }, False)
+
+
+# Serialize the status line and headers of a response, return them with the body as the parts of the message
+def __encode_response(response, verbose):
     dt = datetime.datetime.utcnow()
 
     # Build the text-based part of the request
@@ -153,24 +1081,22 @@ def __build_response(headers, body, path, verbose):
               f'Content-Length: {len(response["response_body"])}\r\n' \
               f'Date: {format_date_time(dt.timestamp())}\r\n\r\n'
 
-    # Convert to a byte array
-    content = bytearray(content_string.encode())
-    # Add the binary part of the request
-    content += response["response_body"]
-
     if verbose:
-        print("[RESPONSE] Response created")
+        __log('[RESPONSE] Response created')
 
-    return content
+    # The body isn't copied, mapped files are sent straight from the mapping
+    return [content_string.encode(), response["response_body"]]
 
 
 def __parse_request(request, verbose):
     lines = request.splitlines()
 
     # Use REGEX to parse the request pattern
-    match = re.search('^([A-Z]+) (.+) HTTP/\d\.?\d?$', lines[0])
+    match = re.search('^([A-Z]+) (.+) HTTP/\d\.?\d?$', lines[0]) if lines else None
+    if match is None:
+        raise ValueError('Invalid request line')
     if verbose:
-        print("[REQUEST] Request parsed ")
+        __log('[REQUEST] Request parsed')
 
     return {
         'verb': match.group(1),
@@ -178,7 +1104,7 @@ def __parse_request(request, verbose):
     }
 
 
-def __handle_request(request, body, path):
+def __handle_request(request, body, path, mappings, verbose):
     # Default Values
     response = {
         'content_type': 'application/json;charset=utf-8',
@@ -205,12 +1131,12 @@ def __handle_request(request, body, path):
         if full_path.is_dir():
             return __list_directory(full_path)
         else:
-            return __read_file(full_path)
+            return __read_file(full_path, mappings, verbose)
 
     # Write/Create a given file
     if request['verb'] == HttpVerb.POST.value:
         if not full_path.is_dir():
-            return __write_file(full_path, body)
+            return __write_file(full_path, body, verbose)
         else:
             response['response_body'] = json.dumps({
                 'error': 'The requested path represents a directory. The path must represent a file to work correctly.'
@@ -248,7 +1174,7 @@ def __list_directory(path):
     return response
 
 
-def __read_file(path, verbose):
+def __read_file(path, mappings, verbose):
     # Common response values
     response = {
         'content_type': 'application/json;charset=utf-8',
@@ -267,14 +1193,13 @@ def __read_file(path, verbose):
         # Guess the Mime Type from the file extension
         mime_type = mimetypes.guess_type(path)[0]
 
-        # Read the file
-        with open(path, 'rb') as file:
-            file_content = file.read()
-            # Get the content disposition based on the Mime Type
-            response['content_disposition'] = __get_content_disposition(mime_type, path)
-            response['response_body'] = file_content
-            response['content_type'] = mime_type
-            response['response_status'] = HttpStatus.OK.value
+        # Map the file, the sessions downloading it share the mapping
+        file_content = mappings.acquire(path)
+        # Get the content disposition based on the Mime Type
+        response['content_disposition'] = __get_content_disposition(mime_type, path)
+        response['response_body'] = file_content
+        response['content_type'] = mime_type
+        response['response_status'] = HttpStatus.OK.value
 
     # If an error occurs return an Internal Server Error
     except IOError as e:
@@ -287,7 +1212,7 @@ def __read_file(path, verbose):
         return response
 
     if verbose:
-        print("[RESPONSE] Response has been created")
+        __log('[RESPONSE] Response has been created')
 
     return response
 
@@ -305,13 +1230,21 @@ def __write_file(path, content, verbose):
         # Create all the parent directories required
         path.parent.mkdir(parents=True, exist_ok=True)
 
-        # Start writing the file
-        with open(path, 'wb') as file:
-            file.write(content)
-            response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
-            response['response_body'] = json.dumps({
-                'success': f'The file was {"created" if created else "overwritten"}.'
-            }).encode()
+        # Write a hidden file next to it and rename it, the file is replaced and not truncated since sessions
+        # may still be sending its previous contents from a mapping
+        temp_path = path.parent.joinpath(f'.{path.name}.{uuid.uuid4().hex[:16]}.part')
+        try:
+            with open(temp_path, 'xb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except IOError:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        response['response_status'] = HttpStatus.CREATED.value if created else HttpStatus.OK.value
+        response['response_body'] = json.dumps({
+            'success': f'The file was {"created" if created else "overwritten"}.'
+        }).encode()
 
 
     # If an error occurs return an Internal Server Error
@@ -324,7 +1257,7 @@ def __write_file(path, content, verbose):
         }).encode()
         return response
     if verbose:
-        print("[")
+        __log('[RESPONSE] File has been written')
 
     return response
 
@@ -350,6 +1283,16 @@ def __parse_flags(path):
     parser.add_argument("-v", "--verbose", help="Activate verbose mode", action="store_true")
     parser.add_argument("-p", "--port", help="Port to open the server on", type=int, default=1773)
     parser.add_argument("-d", "--dir", help="Path to shared directory", type=pathlib.Path, default=path)
+    parser.add_argument("--max-sessions", help="Maximum number of transfers in progress", type=int,
+                        default=__MAX_SESSIONS)
+    parser.add_argument("--max-request-size", help="Maximum size in bytes of a request", type=int,
+                        default=__MAX_REQUEST_SIZE)
+    parser.add_argument("--session-timeout", help="Seconds of silence before a client is dropped", type=float,
+                        default=__SESSION_TIMEOUT)
+    parser.add_argument("--access-log", help="File the requests are logged to (- for the standard output)")
+    parser.add_argument("--log-level", help="Lowest level of the records logged (verbose mode logs everything)",
+                        choices=list(AccessLog.LEVELS), default='info')
+    parser.add_argument("--log-sample-rate", help="Fraction of the requests logged", type=float, default=1.0)
 
     return parser.parse_args()
 
@@ -364,4 +1307,6 @@ if __name__ == "__main__":
     if flags.verbose:
         print(f"[ARGS] Arguments: {flags}")
 
-    start_server(__SERVER_HOST, flags.port, flags.dir, flags.verbose)
+    start_server(__SERVER_HOST, flags.port, flags.dir, flags.verbose, max_sessions=flags.max_sessions,
+                 max_request_size=flags.max_request_size, session_timeout=flags.session_timeout,
+                 access_log_path=flags.access_log, log_level=flags.log_level, log_sample_rate=flags.log_sample_rate)